@@ -0,0 +1,79 @@
+import os, zipfile, logging
+
+log = logging.getLogger(__name__)
+chunk_size = 64 * 1024
+
+
+class _ZipSink():
+  """Write-only file zipfile writes to, whatever it wrote is picked up with drain().
+
+  It has no seek(), so zipfile streams: sizes and CRCs go in a data descriptor
+  after each file instead of being patched into the header afterwards.
+  """
+
+  def __init__(self):
+    self.chunks = []
+    self.offset = 0
+
+  def write(self, data):
+    self.chunks.append(bytes(data))
+    self.offset += len(data)
+    return len(data)
+
+  def tell(self):
+    return self.offset
+
+  def flush(self):
+    pass
+
+  def drain(self):
+    data = b''.join(self.chunks)
+    self.chunks = []
+    return data
+
+
+def _safe_name(name):
+  # Names come from video titles. Keep them from making folders in the
+  # archive or pointing out of it ('AC/DC', '../x') when it is extracted.
+  name = name.replace('/', '_').replace('\\', '_').lstrip('. ')
+  return name or 'untitled'
+
+def _unique_name(name, taken):
+  base, ext = os.path.splitext(name)
+  count = 1
+  while name in taken:
+    count += 1
+    name = '{} ({}){}'.format(base, count, ext)
+  taken.add(name)
+  return name
+
+def _zip_chunks(files):
+  sink = _ZipSink()
+  taken = set()
+  with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+    for name, path in files:
+      try:
+        f = open(path, 'rb')
+      except OSError as e:
+        log.warning('Leaving %s out of the archive: %s', path, e)
+        continue
+      with f:
+        info = zipfile.ZipInfo.from_file(path, _unique_name(_safe_name(name), taken))
+        with archive.open(info, 'w') as dest:
+          for chunk in iter(lambda: f.read(chunk_size), b''):
+            dest.write(chunk)
+            yield sink.drain()
+      yield sink.drain()
+  # Closing wrote the central directory.
+  yield sink.drain()
+
+def stream_zip(files):
+  """Generate a ZIP of files, [(<name in the archive>, <path>), ...], chunk by chunk.
+
+  Files are stored as they are (mp3s don't compress) and read chunk_size bytes
+  at a time, so memory use doesn't depend on how many or how big the files
+  are. Files that can't be opened are left out, slashes in names are replaced
+  and names that repeat get a ' (2)' and so on.
+  """
+  # Some servers take an empty chunk for the end of the response.
+  return (data for data in _zip_chunks(files) if data)
@@ -0,0 +1,236 @@
+import os, json, time, hmac, hashlib
+from collections import OrderedDict
+from datetime import datetime
+from threading import RLock
+
+
+class OutputCache():
+  """Class used to remember which videos have already been ripped.
+
+  Entries are keyed by video id and output format and point at a file inside
+  <directory>. The index is kept in memory and written through to a json file
+  so it survives restarts. If an entry's file is gone, locate(v_id, label, fmt)
+  gets a chance to find where it was moved to before the entry is dropped.
+
+  Overall this is the structure:
+  entries = {
+    '<v_id>.<fmt>': {
+      'v_id': <v_id>,
+      'label': <label>,
+      'filename': <filename relative to directory>,
+      'timestamp': <time the entry was added>
+    },
+    ...
+  }
+
+  """
+
+  def __init__(self, directory, index_path, locate=None):
+    self.directory = directory
+    self.index_path = index_path
+    self.locate = locate
+    self.entries = {}
+    self.lock = RLock()
+    self.load()
+
+  def _key(self, v_id, fmt):
+    return '{}.{}'.format(v_id, fmt)
+
+  def load(self):
+    with self.lock:
+      try:
+        with open(self.index_path) as f:
+          self.entries = json.load(f)
+      except (OSError, ValueError):
+        self.entries = {}
+      return len(self.entries)
+
+  def save(self):
+    with self.lock:
+      # Write to a temp file first so a crash never leaves a broken index.
+      tmp_path = self.index_path + '.tmp'
+      with open(tmp_path, 'w') as f:
+        json.dump(self.entries, f)
+      os.replace(tmp_path, self.index_path)
+
+  def path(self, entry):
+    return os.path.join(self.directory, entry['filename'])
+
+  def get(self, v_id, fmt='mp3'):
+    with self.lock:
+      entry = self.entries.get(self._key(v_id, fmt), None)
+      if entry is None:
+        return None
+      if not os.path.isfile(self.path(entry)):
+        filename = self.locate(v_id, entry['label'], fmt) if self.locate else None
+        if filename is None:
+          # File was removed behind our back, forget about it.
+          self.remove(v_id, fmt)
+          return None
+        entry['filename'] = filename
+        self.save()
+      return entry
+
+  def put(self, v_id, label, filename, fmt='mp3'):
+    with self.lock:
+      key = self._key(v_id, fmt)
+      entry = self.entries.get(key, None)
+      if entry is not None and entry['filename'] == filename and entry['label'] == label:
+        return entry
+      entry = {
+        'v_id': v_id,
+        'label': label,
+        'filename': filename,
+        'timestamp': datetime.utcnow().timestamp()
+      }
+      self.entries[key] = entry
+      self.save()
+      return entry
+
+  def remove(self, v_id, fmt='mp3'):
+    with self.lock:
+      entry = self.entries.pop(self._key(v_id, fmt), None)
+      if entry is not None:
+        self.save()
+      return entry
+
+
+class CredentialCache():
+  """Class used to remember credentials that were recently verified.
+
+  Checking a password means a db lookup plus a deliberately slow hash, which
+  adds up when clients poll. Successful checks are cached for <ttl> seconds,
+  keyed by an HMAC of the username and password so neither is kept around in
+  plain text. At most <max_size> entries are kept, least recently used ones
+  are dropped first.
+
+  Overall this is the structure:
+  entries = OrderedDict({
+    <digest>: (<u_id>, <username>, <expiry>),
+    ...
+  })
+  by_user = {<u_id>: set([<digest>, ...])}
+
+  """
+
+  def __init__(self, secret, ttl=300, max_size=1024):
+    if isinstance(secret, str):
+      secret = secret.encode('utf-8')
+    self.secret = secret
+    self.ttl = ttl
+    self.max_size = max_size
+    self.entries = OrderedDict()
+    self.by_user = {}
+    self.lock = RLock()
+
+  def _digest(self, username, password):
+    msg = username.encode('utf-8') + b'\0' + password.encode('utf-8')
+    return hmac.new(self.secret, msg, hashlib.sha256).digest()
+
+  def _drop(self, digest):
+    u_id, username, expiry = self.entries.pop(digest)
+    digests = self.by_user.get(u_id, None)
+    if digests is not None:
+      digests.discard(digest)
+      if not digests:
+        del self.by_user[u_id]
+
+  def get(self, username, password):
+    """Return (u_id, username) if these credentials were verified recently."""
+    digest = self._digest(username, password)
+    with self.lock:
+      entry = self.entries.get(digest, None)
+      if entry is None:
+        return None
+      if entry[2] < time.time():
+        self._drop(digest)
+        return None
+      self.entries.move_to_end(digest)
+      return entry[0], entry[1]
+
+  def put(self, username, password, u_id):
+    digest = self._digest(username, password)
+    with self.lock:
+      if digest in self.entries:
+        self._drop(digest)
+      self.entries[digest] = (u_id, username, time.time() + self.ttl)
+      self.by_user.setdefault(u_id, set()).add(digest)
+      while len(self.entries) > self.max_size:
+        self._drop(next(iter(self.entries)))
+
+  def invalidate(self, u_id):
+    """Forget every cached credential of a user."""
+    with self.lock:
+      for digest in list(self.by_user.get(u_id, ())):
+        self._drop(digest)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.by_user.clear()
+
+
+class MetadataCache():
+  """Class used to remember what a video resolved to, e.g. its audio streams.
+
+  Least recently used entries are dropped once there are more than <max_size>,
+  and every entry expires after <ttl> seconds or at its own expiry, whichever
+  comes first. Hits and misses are counted so the hit rate can be reported.
+
+  Overall this is the structure:
+  entries = OrderedDict({
+    <key>: (<value>, <expiry>),
+    ...
+  })
+
+  """
+
+  def __init__(self, ttl=3600, max_size=1024):
+    self.ttl = ttl
+    self.max_size = max_size
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.lock = RLock()
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key, None)
+      if entry is not None and entry[1] < time.time():
+        del self.entries[key]
+        entry = None
+      if entry is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.entries.move_to_end(key)
+      return entry[0]
+
+  def put(self, key, value, expiry=None):
+    expiry = min(time.time() + self.ttl, expiry or float('inf'))
+    with self.lock:
+      self.entries[key] = (value, expiry)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_size:
+        self.entries.popitem(last=False)
+
+  def remove(self, key):
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      return None if entry is None else entry[0]
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.hits = 0
+      self.misses = 0
+
+  def stats(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        'size': len(self.entries),
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': self.hits / lookups if lookups else 0.0
+      }
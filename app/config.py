@@ -1,10 +1,16 @@
-import os
+import os, logging
 from flask import Flask
 from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
 
 host='0.0.0.0'
 port=5000
+worker_count=16
 basedir = os.path.abspath(os.path.dirname(__file__))
+# Signs auth tokens and keys the credential cache. Every process serving the
+# API has to share it, or tokens stop working across restarts and workers.
+secret_key = os.environ.get('INFINOTE_SECRET_KEY')
 
 infinote_app = Flask('infinote')
 infinote_app.config.update(
@@ -12,9 +18,95 @@ infinote_app.config.update(
   PORT=port,
   SERVER_NAME=host+':'+str(port),
   DOWNLOAD_DIR='/output',
+  WORKER_COUNT=worker_count, # Number of download worker threads.
+  MAX_ACTIVE_JOBS=16, # Max number of jobs downloading at once, across all users.
+  MAX_ACTIVE_JOBS_PER_USER=4, # Max number of jobs downloading at once for one user.
+  USER_WEIGHTS={}, # {<u_id>: <weight>} -- jobs started per round-robin turn, default 1.
+  TRANSCODE_WORKERS=os.cpu_count() or 1, # Max number of ffmpeg processes at once.
+  STREAM_CONVERT=False, # Pipe downloads straight into ffmpeg on the download workers instead.
+  MAX_BULK_JOBS=1000, # Max number of jobs in one bulk request.
+  PLAYLIST_PAGE_SIZE=50, # Playlist entries listed (and queued) at a time, 50 is the most YouTube hands out.
+  PLAYLIST_MAX_ENTRIES=5000, # Playlists are only expanded up to this many videos.
+  DOWNLOAD_SEGMENTS=1, # Max connections per download for big files, 1 turns segmenting off.
+  STREAM_INTERVAL=1.0, # Min seconds between batches of job updates on event streams.
+  FILE_OFFLOAD=None, # 'x-accel-redirect' (nginx) or 'x-sendfile' (apache, lighttpd) to let the front proxy send files.
+  FILE_OFFLOAD_PREFIX='/protected/output/', # Internal proxy location DOWNLOAD_DIR is served at, for X-Accel-Redirect.
+  STREAM_KEEPALIVE=15, # Seconds between keep-alive comments on idle event streams.
+  STREAM_TOMBSTONE_TTL=60, # Seconds deleted jobs are remembered for event streams that fell behind.
+  CACHE_INDEX=os.path.join(basedir, 'cache_index.json'), # Index of already ripped videos.
+  STORAGE_LAYOUT='sharded', # 'flat' puts every file in DOWNLOAD_DIR, 'sharded' in subdirectories by v_id hash.
+  STORAGE_SHARD_DEPTH=2, # Levels of subdirectories, each named by STORAGE_SHARD_WIDTH hex digits.
+  STORAGE_SHARD_WIDTH=2,
+  STORAGE_BUDGET=20 * 1024**3, # Max bytes of finished files kept, least recently downloaded go first. None for no limit.
+  STORAGE_INDEX=os.path.join(basedir, 'storage_index.json'), # Sizes and access times of finished files, read on startup.
+  STORAGE_SWEEP_INTERVAL=6 * 3600, # Seconds between background checks of DOWNLOAD_DIR, the first one right at startup.
+  STORAGE_PART_TTL=24 * 3600, # Seconds untouched before a partial download or unconverted source is deleted.
+  META_CACHE_TTL=3600, # Max seconds a resolved video is reused, stream urls may expire sooner.
+  META_CACHE_SIZE=4096, # Max number of resolved videos kept.
+  SECRET_KEY=secret_key or os.urandom(32), # Set with the INFINOTE_SECRET_KEY environment variable.
+  AUTH_CACHE_TTL=300, # Seconds a verified password is trusted without checking again.
+  AUTH_CACHE_SIZE=4096, # Max number of verified credentials kept.
+  TOKEN_EXPIRATION=3600, # Seconds an auth token from /token is valid for.
+  DB_WRITE_BATCH=256, # Max number of job row changes per commit.
+  DB_WRITE_LATENCY=0.05, # Max seconds a job row change waits for others to share its commit.
+  JOURNAL_DIR=os.path.join(basedir, 'journal'), # Journal and snapshot of live job state.
+  JOURNAL_SNAPSHOT_EVERY=10000, # Journal records between compacted snapshots.
   #OPT_SECRET='THISISASECRETKEY',
   OPT_SECRET='THISISATESTPASS2',
   SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'infinote.db'),
-  SQLALCHEMY_MIGRATE_REPO = os.path.join(basedir, 'db_repository')
+  SQLALCHEMY_MIGRATE_REPO = os.path.join(basedir, 'db_repository'),
+  SQLALCHEMY_POOL_SIZE=worker_count, # Pooled connections, one per worker.
+  SQLALCHEMY_POOL_TIMEOUT=10, # Seconds to wait for a pooled connection.
+  SQLITE_PRAGMAS={
+    'journal_mode': 'WAL', # Readers don't block the writer and vice versa.
+    'synchronous': 'NORMAL', # Only fsync at checkpoints, safe in WAL mode.
+    'busy_timeout': 5000 # Milliseconds to wait on a lock before 'database is locked'.
+  }
 )
-db = SQLAlchemy(infinote_app)
+
+if not secret_key:
+  logging.getLogger(__name__).warning('INFINOTE_SECRET_KEY is not set! Using a random key, auth tokens will '
+      'not survive a restart or work across processes.')
+
+
+def require_secret_key():
+  """Refuse to serve without INFINOTE_SECRET_KEY, called before the server starts."""
+  if not secret_key:
+    raise SystemExit('INFINOTE_SECRET_KEY must be set to serve the API, e.g. to the output of: '
+        'python -c "import os; print(os.urandom(32).hex())"')
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas):
+  cursor = dbapi_connection.cursor()
+  for name, value in pragmas.items():
+    cursor.execute('PRAGMA {}={}'.format(name, value))
+  cursor.close()
+
+def _on_sqlite_connect(dbapi_connection, connection_record):
+  apply_sqlite_pragmas(dbapi_connection, infinote_app.config['SQLITE_PRAGMAS'])
+
+
+class TunedSQLAlchemy(SQLAlchemy):
+  """Class used to apply SQLITE_PRAGMAS to every new sqlite connection."""
+
+  def apply_driver_hacks(self, app, info, options):
+    super().apply_driver_hacks(app, info, options)
+    if info.drivername != 'sqlite':
+      return
+    if options.get('poolclass') is None and options.get('pool_size'):
+      # sqlite files default to one new connection per checkout, pool them.
+      # Pooled connections are handed to whichever thread asks next.
+      options['poolclass'] = QueuePool
+      options.setdefault('connect_args', {})['check_same_thread'] = False
+    elif options.get('poolclass') is not QueuePool:
+      # In-memory databases get a StaticPool, which takes no sizing.
+      for key in ('pool_size', 'pool_timeout', 'max_overflow'):
+        options.pop(key, None)
+
+  def get_engine(self, app=None, bind=None):
+    engine = super().get_engine(app, bind)
+    if engine.dialect.name == 'sqlite' and not event.contains(engine, 'connect', _on_sqlite_connect):
+      event.listen(engine, 'connect', _on_sqlite_connect)
+    return engine
+
+
+db = TunedSQLAlchemy(infinote_app)
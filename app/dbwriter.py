@@ -0,0 +1,175 @@
+import logging, time
+from collections import deque
+from threading import Thread, Condition
+
+log = logging.getLogger(__name__)
+
+
+class DBWriter():
+  """Class used to write rows of one model from a single background thread.
+
+  Callers only queue up operations, which returns right away. The writer
+  thread waits at most <max_latency> seconds for more operations to show up
+  (or until <max_batch> are queued) and commits them together, so a whole
+  batch of jobs shares the cost of one commit. Rows are referred to by a key
+  chosen by the caller; the writer remembers which row a key was inserted as.
+
+  Overall this is the structure:
+  queue = deque([(<op>, <key>, <fields>, <forget>), ...]) -- op is 'insert', 'update', 'delete' or 'relink'
+    -- or ('insert_many', None, [(<key>, <fields>), ...], False) for rows that must go in together
+  rows = {<key>: <primary key of the row>}
+
+  """
+
+  def __init__(self, db, model, max_batch=256, max_latency=0.05):
+    self.db = db
+    self.model = model
+    self.max_batch = max_batch
+    self.max_latency = max_latency
+    self.queue = deque()
+    self.rows = {}
+    self.cond = Condition()
+    self.submitted = 0
+    self.written = 0
+    self.running = False
+    self.thread = None
+
+  def start(self):
+    with self.cond:
+      if self.running:
+        return False
+      self.running = True
+      self.thread = Thread(target=self._work, name='infinote-db-writer')
+      self.thread.daemon = True
+      self.thread.start()
+      return True
+
+  def stop(self, wait=True):
+    """Stop the writer thread once everything queued so far is written."""
+    with self.cond:
+      self.running = False
+      self.cond.notify_all()
+    if wait and self.thread is not None:
+      self.thread.join()
+
+  def insert(self, key, fields):
+    return self._submit('insert', key, fields)
+
+  def insert_many(self, rows):
+    """Insert [(<key>, <fields>), ...] in one transaction."""
+    return self._submit('insert_many', None, rows)
+
+  def update(self, key, fields, forget=False):
+    """Update the row inserted as <key>, forget=True drops the key afterwards."""
+    return self._submit('update', key, fields, forget)
+
+  def delete(self, key):
+    return self._submit('delete', key)
+
+  def relink(self, key, fields):
+    """Point key at the newest existing row matching fields, for keys of rows written before a restart."""
+    return self._submit('relink', key, fields)
+
+  def flush(self, timeout=None):
+    """Block until everything queued so far is committed."""
+    with self.cond:
+      if not self.running:
+        batch = list(self.queue)
+        self.queue.clear()
+      else:
+        target = self.submitted
+        return self.cond.wait_for(lambda: self.written >= target, timeout)
+    self._write(batch)
+    with self.cond:
+      self.written += len(batch)
+    return True
+
+  def _submit(self, op, key, fields=None, forget=False):
+    with self.cond:
+      self.queue.append((op, key, fields, forget))
+      self.submitted += 1
+      # Only wake the writer when it has something new to decide on.
+      if len(self.queue) == 1 or len(self.queue) >= self.max_batch:
+        self.cond.notify_all()
+
+  def _next_batch(self):
+    with self.cond:
+      while self.running and not self.queue:
+        self.cond.wait()
+      if not self.queue:
+        return None
+      # Give other operations a moment to join this batch.
+      deadline = time.time() + self.max_latency
+      while self.running and len(self.queue) < self.max_batch:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        self.cond.wait(remaining)
+      count = min(len(self.queue), self.max_batch)
+      return [self.queue.popleft() for i in range(count)]
+
+  def _work(self):
+    while True:
+      batch = self._next_batch()
+      if batch is None:
+        return
+      self._write(batch)
+      with self.cond:
+        self.written += len(batch)
+        self.cond.notify_all()
+
+  def _row(self, session, pending, key):
+    row = pending.get(key, None)
+    if row is None and key in self.rows:
+      row = session.query(self.model).get(self.rows[key])
+    return row
+
+  def _write(self, batch):
+    session = self.db.session
+    pending = {}
+    forgotten = set()
+    try:
+      for op, key, fields, forget in batch:
+        if op == 'insert':
+          pending[key] = self.model(**fields)
+          session.add(pending[key])
+          continue
+        if op == 'insert_many':
+          # One op, so these never end up split across batches.
+          for key, fields in fields:
+            pending[key] = self.model(**fields)
+            session.add(pending[key])
+          continue
+        if op == 'relink':
+          if key not in pending and key not in self.rows:
+            row = session.query(self.model).filter_by(**fields).order_by(self.model.id.desc()).first()
+            if row is not None:
+              self.rows[key] = row.id
+          continue
+        row = self._row(session, pending, key)
+        if row is None:
+          continue
+        if op == 'update':
+          for k, v in fields.items():
+            setattr(row, k, v)
+        elif row in session.new:
+          # Inserted and deleted within one batch, never hits the db at all.
+          session.expunge(row)
+          forget = True
+        else:
+          session.delete(row)
+          forget = True
+        if forget:
+          forgotten.add(key)
+      session.flush()
+      for key, row in pending.items():
+        if key not in forgotten:
+          self.rows[key] = row.id
+      for key in forgotten:
+        self.rows.pop(key, None)
+      session.commit()
+    except Exception:
+      log.exception('Failed to write a batch of %d operations.', len(batch))
+      session.rollback()
+    finally:
+      self.db.session.remove()
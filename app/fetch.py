@@ -0,0 +1,284 @@
+import os, re, json, time, logging
+from http.client import HTTPException
+from threading import Thread, Lock
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError
+
+log = logging.getLogger(__name__)
+chunk_size = 16 * 1024
+retries = 3 # Extra attempts after a dropped connection, each resumes where the last stopped.
+retry_delay = 1.0
+min_segment_size = 4 * 1024 * 1024 # Files are only split into segments of at least this size.
+
+
+class ChangedFileError(Exception):
+  pass
+
+
+
+#####################
+### Partial files ###
+#####################
+class PartialFile():
+  """Class used to keep track of a download that didn't finish yet.
+
+  Bytes go to <filepath>.part and a small sidecar remembers what they belong
+  to, so a later attempt (even after a restart) can ask the server for just
+  the rest. The offset is the size of the .part file, which is always exactly
+  what made it to disk.
+
+  Segmented downloads write into a .part file of the final size instead, and
+  keep track of how far each segment got in the sidecar.
+
+  Overall this is the structure:
+  <filepath>.part -- the first <offset> bytes of the file
+  <filepath>.part.json = {
+    'validator': <ETag or Last-Modified of the response the bytes came from>,
+    'total': <size of the whole file, 0 if unknown>,
+    'segments': [[<first byte>, <last byte>, <bytes done>], ...] or None
+  }
+
+  """
+
+  def __init__(self, filepath):
+    self.filepath = filepath
+    self.part_path = filepath + '.part'
+    self.meta_path = filepath + '.part.json'
+    self.validator = None
+    self.total = 0
+    self.segments = None
+    self.load()
+
+  def load(self):
+    try:
+      with open(self.meta_path) as f:
+        meta = json.load(f)
+      self.validator = meta['validator']
+      self.total = meta['total']
+      self.segments = meta.get('segments', None)
+    except (OSError, ValueError, KeyError):
+      self.validator = None
+      self.total = 0
+      self.segments = None
+
+  def save(self, validator, total, segments=None):
+    self.validator = validator
+    self.total = total
+    self.segments = segments
+    with open(self.meta_path, 'w') as f:
+      json.dump({'validator': validator, 'total': total, 'segments': segments}, f)
+
+  @property
+  def offset(self):
+    # Without a validator there is no telling whether the bytes are still good.
+    if self.validator is None or self.segments is not None:
+      return 0
+    try:
+      return os.path.getsize(self.part_path)
+    except OSError:
+      return 0
+
+  def finish(self):
+    os.replace(self.part_path, self.filepath)
+    if os.path.isfile(self.meta_path):
+      os.remove(self.meta_path)
+
+  def discard(self):
+    for path in (self.part_path, self.meta_path):
+      if os.path.isfile(path):
+        os.remove(path)
+
+
+
+###################
+### Downloading ###
+###################
+def _validator(headers):
+  return headers.get('ETag') or headers.get('Last-Modified')
+
+def _content_range(headers):
+  """Return (start, total) from a Content-Range header, total is 0 if unknown."""
+  match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', headers.get('Content-Range') or '')
+  if not match:
+    return None, 0
+  total = match.group(2)
+  return int(match.group(1)), 0 if total == '*' else int(total)
+
+def _open(url, offset, validator):
+  headers = {}
+  if offset:
+    headers['Range'] = 'bytes={}-'.format(offset)
+    # Only honour the range if the file is still the one we started on.
+    headers['If-Range'] = validator
+  return urlopen(Request(url, headers=headers))
+
+def _fetch(url, part, callback, total_hint):
+  offset = part.offset
+  try:
+    response = _open(url, offset, part.validator)
+  except HTTPError as e:
+    if e.code == 416 and offset and offset == part.total:
+      # Nothing left to fetch, the previous attempt just didn't get to finish.
+      return
+    raise
+
+  with response:
+    if response.status == 206:
+      start, total = _content_range(response.headers)
+      if start != offset:
+        raise Exception('Server resumed at byte {} instead of {}.'.format(start, offset))
+      total = total or part.total
+      mode = 'ab'
+      log.info('RESUMING DOWNLOAD AT %d BYTES', offset)
+    else:
+      # Range ignored or the file changed, start over.
+      offset = 0
+      total = int(response.headers.get('Content-Length') or total_hint or 0)
+      mode = 'wb'
+      part.save(_validator(response.headers), total)
+
+    recvd = offset
+    t0 = time.time()
+    with open(part.part_path, mode) as f:
+      for chunk in iter(lambda: response.read(chunk_size), b''):
+        f.write(chunk)
+        recvd += len(chunk)
+        if callback:
+          elapsed = max(time.time() - t0, 1e-6)
+          rate = (recvd - offset) / 1024 / elapsed
+          ratio = recvd / total if total else 0.0
+          eta = (total - recvd) / 1024 / rate if total and rate else 0.0
+          callback(total, recvd, ratio, rate, eta)
+  if total and recvd < total:
+    raise ConnectionError('Connection closed after {} of {} bytes.'.format(recvd, total))
+
+def resumable_download(url, filepath, callback=None, total=None):
+  """Download url to filepath, picking up any earlier partial download.
+
+  Dropped connections are retried up to <retries> times, each attempt only
+  fetches the bytes still missing. callback gets (total, recvd, ratio, rate,
+  eta) like pafy's download callbacks. If every attempt fails the partial file
+  is kept, so the next call resumes it.
+  """
+  part = PartialFile(filepath)
+  if part.validator is None or part.segments is not None:
+    # Whatever is there can't be resumed safely, or not this way.
+    part.discard()
+  for attempt in range(retries + 1):
+    try:
+      _fetch(url, part, callback, total)
+      break
+    except (OSError, HTTPException) as err:
+      if isinstance(err, HTTPError) or attempt == retries:
+        raise
+      log.warning('Download interrupted (%s), resuming.', err)
+      time.sleep(retry_delay)
+  part.finish()
+
+
+
+#############################
+### Segmented Downloading ###
+#############################
+def _probe(url):
+  """Return (total, validator) if the server serves byte ranges of url, else None."""
+  try:
+    response = urlopen(Request(url, headers={'Range': 'bytes=0-0'}))
+  except HTTPError:
+    return None
+  with response:
+    if response.status != 206:
+      return None
+    start, total = _content_range(response.headers)
+    if not total:
+      return None
+    return total, _validator(response.headers)
+
+def _split(total, max_segments):
+  """Split total bytes into up to max_segments segments of min_segment_size or more."""
+  count = max(1, min(max_segments, total // min_segment_size))
+  size = -(-total // count)
+  return [[start, min(start + size, total) - 1, 0] for start in range(0, total, size)]
+
+def _fetch_segment(url, path, segment, validator, progress):
+  start, end, done = segment
+  for attempt in range(retries + 1):
+    headers = {'Range': 'bytes={}-{}'.format(start + segment[2], end)}
+    if validator:
+      headers['If-Range'] = validator
+    try:
+      with urlopen(Request(url, headers=headers)) as response, open(path, 'r+b') as f:
+        if response.status != 206:
+          raise ChangedFileError('File changed while downloading it.')
+        f.seek(start + segment[2])
+        for chunk in iter(lambda: response.read(chunk_size), b''):
+          f.write(chunk)
+          segment[2] += len(chunk)
+          progress(len(chunk))
+      if start + segment[2] <= end:
+        raise ConnectionError('Segment closed after {} of {} bytes.'.format(segment[2], end - start + 1))
+      return
+    except (OSError, HTTPException) as err:
+      if isinstance(err, HTTPError) or attempt == retries:
+        raise
+      log.warning('Segment at byte %d interrupted (%s), resuming.', start, err)
+      time.sleep(retry_delay)
+
+def segmented_download(url, filepath, callback=None, total=None, max_segments=4):
+  """Download url to filepath over up to max_segments connections at once.
+
+  Every segment is a byte range written in place into <filepath>.part, the
+  number of segments depends on the size of the file. callback gets the
+  aggregate progress of all segments. Falls back to resumable_download() if
+  the server doesn't serve ranges or the file is too small to be worth it.
+  """
+  probe = _probe(url) if max_segments > 1 else None
+  if probe is None or probe[0] < 2 * min_segment_size:
+    return resumable_download(url, filepath, callback, total)
+  total, validator = probe
+
+  part = PartialFile(filepath)
+  if part.segments is None or validator is None or part.validator != validator or part.total != total:
+    part.discard()
+    with open(part.part_path, 'wb') as f:
+      f.truncate(total)
+    part.save(validator, total, _split(total, max_segments))
+
+  lock = Lock()
+  state = {'recvd': sum(s[2] for s in part.segments), 'session': 0}
+  t0 = time.time()
+  def progress(n):
+    with lock:
+      state['recvd'] += n
+      state['session'] += n
+      if callback:
+        elapsed = max(time.time() - t0, 1e-6)
+        rate = state['session'] / 1024 / elapsed
+        eta = (total - state['recvd']) / 1024 / rate if rate else 0.0
+        callback(total, state['recvd'], state['recvd'] / total, rate, eta)
+
+  errors = []
+  def work(segment):
+    try:
+      _fetch_segment(url, part.part_path, segment, validator, progress)
+    except Exception as err:
+      errors.append(err)
+
+  threads = []
+  for segment in part.segments:
+    if segment[0] + segment[2] <= segment[1]:
+      threads.append(Thread(target=work, args=(segment,), name='infinote-segment'))
+  log.info('DOWNLOADING %d BYTES IN %d SEGMENTS', total, len(threads))
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+
+  if errors:
+    if any(isinstance(err, ChangedFileError) for err in errors):
+      part.discard()
+    else:
+      # Remember how far every segment got so the next call can pick up there.
+      part.save(validator, total, part.segments)
+    raise errors[0]
+  part.finish()
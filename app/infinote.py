@@ -1,54 +1,157 @@
-from flask import Flask, jsonify, abort, make_response, request, url_for, current_app, send_from_directory, g
-from flask.ext.httpauth import HTTPBasicAuth
-from app.config import infinote_app
-from app.models import User, Job, RuntimeData, RuntimeDataException
+from flask import Flask, jsonify, abort, make_response, request, url_for, current_app, send_file, safe_join, g, Response, stream_with_context
+from flask.ext.httpauth import HTTPBasicAuth, HTTPTokenAuth, MultiAuth
+from app.config import infinote_app, db, require_secret_key
+from app.models import User, AuthUser, Job, RuntimeData, RuntimeDataException, generate_auth_token, verify_auth_token
+from app.scheduler import JobScheduler
+from app.cache import OutputCache, CredentialCache, MetadataCache
+from app.dbwriter import DBWriter
+from app.journal import JobJournal
+from app.playlist import PlaylistExpander, YouTubePlaylistProvider, extract_list_id
+from app.archive import stream_zip
+from app.storage import StorageManager
+from app.layout import StorageLayout
+from sqlalchemy import event
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from app import ripper
 from datetime import datetime
-import re, pyotp, threading
+from threading import Lock
+from urllib.parse import quote
+import os, re, json, time, pyotp
 
 v_id_len = 11
 download_dir = infinote_app.root_path+infinote_app.config['DOWNLOAD_DIR']
 otp_count = 0
 hotp = pyotp.HOTP(infinote_app.config['OPT_SECRET'])
-auth = HTTPBasicAuth() # Just base64 encodes credentials -- NOT SECURE UNLESS DONE ON HTTPS CONNECTION
+basic_auth = HTTPBasicAuth() # Just base64 encodes credentials -- NOT SECURE UNLESS DONE ON HTTPS CONNECTION
+token_auth = HTTPTokenAuth('Bearer')
+auth = MultiAuth(basic_auth, token_auth) # Either one will do.
 runtime_data = None
+scheduler = None
+transcoder = None
+output_cache = None
+db_writer = None
+journal = None
+playlist_expander = None
+storage = None
+layout = None
+credential_cache = CredentialCache(infinote_app.config['SECRET_KEY'],
+    ttl=infinote_app.config['AUTH_CACHE_TTL'],
+    max_size=infinote_app.config['AUTH_CACHE_SIZE'])
+metadata_cache = MetadataCache(ttl=infinote_app.config['META_CACHE_TTL'],
+    max_size=infinote_app.config['META_CACHE_SIZE'])
+inflight = {} # {<v_id>: <JobTracker of the job ripping it>}
+inflight_lock = Lock()
 
 ##################
 ### Data Model ###
 ##################
 class JobTracker():
-  """ Class used to track a given job's progress"""
+  """ Class used to track a given job's progress
 
-  def __init__(self, u_id, j_id):
+  Jobs for a video that is already being ripped don't get a pipeline of their
+  own, instead their trackers follow the tracker of the job doing the work and
+  mirror every update it records.
+
+  The video's v_id and label are kept on the tracker too, the job they were
+  recorded for may be deleted while its video is still needed by followers.
+
+  Progress callbacks fire on every downloaded chunk, so progress is only
+  written to runtime_data once it moved by at least prog_step and prog_interval
+  seconds went by since the last write. Reaching 100% is always written.
+  """
+  prog_interval = 0.5
+  prog_step = 0.01
+
+  def __init__(self, u_id, j_id, v_id=None, label=''):
     self.u_id = u_id
     self.j_id = j_id
+    self.v_id = v_id
+    self.label = label
+    self.followers = []
+    self.error = None
+    self.lock = Lock()
+    self.last_prog = 0.0
+    self.last_prog_ts = 0.0
+
+  def attach(self, tracker):
+    with self.lock:
+      self.followers.append(tracker)
+      if self.error is not None:
+        tracker.handle_error(self.error)
+        return
+      # Catch up on everything recorded so far.
+      attrs = {}
+      for key in ('label', 'stage', 'prog', 'link', 'timestamp'):
+        value = self.get_attribute(key)
+        if value:
+          attrs[key] = value
+      tracker.set_attributes(attrs)
+
+  def get_attribute(self, key):
+    global runtime_data
+    return runtime_data.get_attribute(self.u_id, self.j_id, key)
 
   def set_attribute(self, key, value):
+    return self.set_attributes({key: value})
+
+  def set_attributes(self, attrs):
     global runtime_data
-    return runtime_data.set_attribute(self.u_id, self.j_id, key, value)
+    with self.lock:
+      if attrs.get('label', None):
+        self.label = attrs['label']
+      for tracker in self.followers:
+        tracker.set_attributes(attrs)
+      return runtime_data.set_attributes(self.u_id, self.j_id, attrs)
 
   def update_stage(self, stage):
-    self.set_attribute('stage', stage) # TODO: sanity check value?
-    self.set_attribute('timestamp', datetime.utcnow().timestamp())
-    if stage is 'done':
+    self.last_prog = 0.0
+    self.last_prog_ts = 0.0
+    attrs = {'stage': stage, 'timestamp': datetime.utcnow().timestamp()} # TODO: sanity check value?
+    if stage == 'done':
+      attrs['prog'] = 1.0
       # Need app context to generate link url.
       with infinote_app.app_context():
-        self.set_attribute('link', url_for('get_file', j_id=self.j_id, _external=True))
+        attrs['link'] = url_for('get_file', j_id=self.j_id, _external=True)
+    self.set_attributes(attrs)
+    if stage == 'done':
+      with self.lock:
+        trackers = [self] + self.followers
+      for tracker in trackers:
+        db_writer.update((tracker.u_id, tracker.j_id), {'ts_complete': datetime.utcnow()}, forget=True)
+      # Remember the output so no one has to rip this video again.
+      label = self.label
+      filename = layout.locate(self.v_id, label) if label else None
+      if filename:
+        output_cache.put(self.v_id, label, filename)
+        storage.add(filename, [(tracker.u_id, tracker.j_id) for tracker in trackers])
+
+  def _update_prog(self, ratio):
+    now = time.time()
+    if ratio < 1.0:
+      if now - self.last_prog_ts < self.prog_interval:
+        return False
+      if abs(ratio - self.last_prog) < self.prog_step:
+        return False
+    self.last_prog = ratio
+    self.last_prog_ts = now
+    return self.set_attributes({'prog': ratio, 'timestamp': datetime.utcnow().timestamp()})
 
   def download_prog(self, total, recvd, ratio, rate, eta):
-    self.set_attribute('prog', ratio)
-    self.set_attribute('timestamp', datetime.utcnow().timestamp())
+    return self._update_prog(ratio)
 
   def convert_prog(self, ratio):
-    self.set_attribute('prog', ratio)
-    self.set_attribute('timestamp', datetime.utcnow().timestamp())
+    return self._update_prog(ratio)
 
   def handle_error(self, exception):
     global runtime_data
     print('GOT AN ERROR!')
     print(exception)
-    j = runtime_data.delJob(self.u_id, self.j_id)
-    db.session.delete(j)
-    db.session.commit()
+    with self.lock:
+      self.error = exception
+      for tracker in self.followers:
+        tracker.handle_error(exception)
+    runtime_data.delJob(self.u_id, self.j_id)
+    db_writer.delete((self.u_id, self.j_id))
 
 
 ##################
@@ -66,18 +169,102 @@ class ProcessException(Exception):
 ### Helper Functions ###
 ########################
 def _make_public_job(u_id, j_id):
-  pub_job = {}
   job = runtime_data.getJob(u_id, j_id)
   if job is None:
     abort(404)
     return {'error': 'Not found'}
+  return _public_view(u_id, j_id, job)
+
+def _public_view(u_id, j_id, job):
+  pub_job = {}
   for field in job:
     if field == 'id':
       pub_job['uri'] = url_for('get_job', j_id=job['id'], _external=True)
     else:
       pub_job[field] = job[field]
+  if job['stage'] == 'init':
+    pos = scheduler.position(u_id, j_id)
+    if pos is not None:
+      pub_job['queue_pos'] = pos
   return pub_job
 
+def _public_playlist(state):
+  pub_playlist = dict(state)
+  pub_playlist['uri'] = url_for('get_playlist', list_id=state['list_id'], _external=True)
+  return pub_playlist
+
+def _job_file(job):
+  """Return (<directory>, <path relative to it>) of a finished job's output."""
+  filename = layout.locate(job['v_id'], job['label'])
+  if filename is None:
+    filename = layout.relpath(job['v_id'], job['label'])
+  return layout.directory, filename
+
+def _locate_output(v_id, label, fmt):
+  return layout.locate(v_id, label, fmt)
+
+def _file_etag(st):
+  # Identity of the file on disk, changes whenever the file is replaced or rewritten.
+  return '{:x}-{:x}-{:x}'.format(st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _send_job_file(directory, filename, name=None):
+  """Send a finished file as <name>, with support for ranges and conditional requests.
+
+  The file object is handed to the WSGI server's file_wrapper, which can use
+  sendfile() to skip copying the bytes through Python. With FILE_OFFLOAD set
+  the app only checks auth and the front proxy sends the file, ranges and all.
+  """
+  path = safe_join(directory, filename)
+  try:
+    st = os.stat(path)
+  except OSError:
+    abort(404)
+  offload = infinote_app.config['FILE_OFFLOAD']
+  if offload == 'x-accel-redirect':
+    rv = Response(mimetype='audio/mpeg')
+    rv.headers['X-Accel-Redirect'] = infinote_app.config['FILE_OFFLOAD_PREFIX'] + quote(filename)
+  elif offload == 'x-sendfile':
+    rv = Response(mimetype='audio/mpeg')
+    rv.headers['X-Sendfile'] = os.path.abspath(path)
+  else:
+    rv = send_file(path, as_attachment=True, attachment_filename=name, add_etags=False)
+    rv.set_etag(_file_etag(st))
+    try:
+      return rv.make_conditional(request, accept_ranges=True, complete_length=st.st_size)
+    except RequestedRangeNotSatisfiable:
+      rv.close()
+      raise
+  rv.headers.add('Content-Disposition', 'attachment', filename=name or os.path.basename(filename))
+  return rv
+
+def _job_events(u_id, j_id=None):
+  """Generate server-sent events for changes to a user's jobs (or just one).
+
+  Starts with the current state, then waits for RuntimeData to report changes.
+  Changes made within STREAM_INTERVAL of each other are sent as one batch, and
+  a comment is sent every STREAM_KEEPALIVE seconds when nothing happens. A
+  stream of just one job ends once that job is deleted.
+  """
+  interval = infinote_app.config['STREAM_INTERVAL']
+  keepalive = infinote_app.config['STREAM_KEEPALIVE']
+  rev = None
+  while True:
+    rev, changed = runtime_data.wait_for_changes(u_id, rev, keepalive)
+    if j_id is not None:
+      changed = {j_id: changed[j_id]} if j_id in changed else {}
+    if not changed:
+      yield ': keep-alive\n\n'
+      continue
+    for c_j_id, job in changed.items():
+      if job is None:
+        data = {'uri': url_for('get_job', j_id=c_j_id, _external=True)}
+        yield 'event: delete\ndata: {}\n\n'.format(json.dumps(data))
+        if j_id is not None:
+          return
+      else:
+        yield 'data: {}\n\n'.format(json.dumps(_public_view(u_id, c_j_id, job)))
+    time.sleep(interval)
+
 # For now we are only interested in youtube.com links.
 def _extract_v_id(link):
   if len(link) == 11:
@@ -87,6 +274,121 @@ def _extract_v_id(link):
     return None
   return match.group('v_id')
 
+def _complete_from_cache(v_id, tracker):
+  entry = output_cache.get(v_id)
+  if entry is None:
+    return False
+  tracker.set_attribute('label', entry['label'])
+  tracker.update_stage('done')
+  return True
+
+def _submit_job(v_id, tracker):
+  """Queue a job, unless v_id is already in flight then just follow that job."""
+  with inflight_lock:
+    primary = inflight.get(v_id, None)
+    if primary is not None:
+      primary.attach(tracker)
+      return False
+    inflight[v_id] = tracker
+  scheduler.submit(tracker.u_id, tracker.j_id, v_id, download_dir, tracker)
+  return True
+
+def _cancel_job(u_id, j_id):
+  """Take a job out of the download or the transcoding queue, whichever it waits in."""
+  v_id = runtime_data.get_attribute(u_id, j_id, 'v_id')
+  filepath = None
+  if not scheduler.cancel(u_id, j_id):
+    args = transcoder.take(u_id, j_id)
+    if args is None:
+      return False
+    v_id, filepath, tracker = args
+  with inflight_lock:
+    tracker = inflight.pop(v_id, None)
+    if tracker is None or not tracker.followers:
+      if filepath is not None:
+        storage.discard(filepath)
+      return True
+    # Hand the video over to the first job that was following this one.
+    primary = tracker.followers[0]
+    with primary.lock:
+      primary.followers.extend(tracker.followers[1:])
+    inflight[v_id] = primary
+  if filepath is not None:
+    # Already downloaded, it only needs converting.
+    transcoder.submit(primary.u_id, primary.j_id, v_id, filepath, primary)
+  else:
+    scheduler.submit(primary.u_id, primary.j_id, v_id, download_dir, primary)
+  return True
+
+def _finish_job(v_id, tracker):
+  with inflight_lock:
+    if inflight.get(v_id, None) is tracker:
+      inflight.pop(v_id)
+
+def _process_job(v_id, directory, tracker):
+  """Download stage, runs on the download workers."""
+  handed_off = False
+  try:
+    # The video may have been ripped while this job sat in the queue.
+    if _complete_from_cache(v_id, tracker):
+      return
+    fetched = ripper.fetchaudio(v_id, directory, tracker,
+        stream=infinote_app.config['STREAM_CONVERT'],
+        segments=infinote_app.config['DOWNLOAD_SEGMENTS'],
+        cache=metadata_cache,
+        name=layout.name(v_id))
+    if fetched is None:
+      return
+    filename, ext, filepath = fetched
+    if ext == 'mp3':
+      tracker.update_stage('done')
+    else:
+      # Conversion is CPU bound, leave it to the transcoding pool.
+      transcoder.submit(tracker.u_id, tracker.j_id, v_id, filepath, tracker)
+      handed_off = True
+  except Exception as e:
+    tracker.handle_error(e)
+  finally:
+    if not handed_off:
+      _finish_job(v_id, tracker)
+
+def _transcode_job(v_id, filepath, tracker):
+  """Conversion stage, runs on the transcoding workers."""
+  try:
+    ripper.transcode(filepath, tracker)
+  except Exception as e:
+    tracker.handle_error(e)
+  finally:
+    # The source is of no use once converted (or if it can't be).
+    storage.discard(filepath)
+    _finish_job(v_id, tracker)
+
+def _expire_jobs(filename, owners):
+  """Called for every file storage evicts, the jobs pointing at it are expired."""
+  for u_id, j_id in owners:
+    job = runtime_data.getJob(u_id, j_id)
+    if job is None or job['stage'] != 'done':
+      continue
+    runtime_data.set_attributes(u_id, j_id, {'stage': 'expired', 'link': '', 'timestamp': datetime.utcnow().timestamp()})
+
+def _resume_jobs():
+  """Queue the jobs that were interrupted by a restart again."""
+  resumed = 0
+  for u_id, j_id, values in runtime_data.dump():
+    job = dict(zip(RuntimeData.valid_keys, values))
+    if job['stage'] in ('done', 'expired'):
+      if job['stage'] == 'done':
+        storage.claim(_job_file(job)[1], (u_id, j_id))
+      continue
+    # Row keys only live in memory, find the row this job was inserted as.
+    db_writer.relink((u_id, j_id), {'user_id': u_id, 'v_id': job['v_id'], 'ts_complete': None})
+    tracker = JobTracker(u_id, j_id, job['v_id'])
+    tracker.set_attributes({'stage': 'init', 'prog': 0.0})
+    if not _complete_from_cache(job['v_id'], tracker):
+      _submit_job(job['v_id'], tracker)
+    resumed += 1
+  return resumed
+
 def _spawn_job(user, link):
   v_id = _extract_v_id(link)
   if v_id is None or len(v_id) != 11:
@@ -97,25 +399,76 @@ def _spawn_job(user, link):
   except RuntimeDataException as e:
     raise ProcessException(e.code, e.msg)
 
-  # Add job to db.
-  j = Job(user=user, v_id=v_id, ts_start=job['timestamp'])
-  db.session.add(j)
-  db.session.commit()
+  # Add job to db, the writer commits it in the background.
+  db_writer.insert((user.id, j_id), {
+    'user_id': user.id,
+    'v_id': v_id,
+    'ts_start': datetime.utcfromtimestamp(ts_start)
+  })
+
+  # Create JobTracker instance to pass to the worker pool.
+  tracker = JobTracker(user.id, j_id, v_id)
+
+  # Already ripped this video? Then there is nothing left to do.
+  if _complete_from_cache(v_id, tracker):
+    return j_id
 
-  # Create JobTracker instance to pass to processing thread.
-  tracker = JobTracker(user.id, j_id)
   try:
-    # Kick off downloading onto another thread.
-    t = threading.Thread(target=ripper.getaudio, args=(v_id, download_dir, tracker))
-    t.start()
+    # Queue the job, it stays in the 'init' stage until a worker is free.
+    _submit_job(v_id, tracker)
   except Exception as e:
     print('GOT EXCEPTION!')
     runtime_data.delJob(user.id, j_id)
-    db.session.delete(j)
-    db.session.commit()
+    db_writer.delete((user.id, j_id))
     raise ProcessException(400, e.args[0])
   return j_id
 
+def _spawn_jobs(user, links):
+  """Like _spawn_job() for a list of links, returns a result for each of them.
+
+  All jobs are created with one RuntimeData call and their rows are written
+  in one transaction. Results are dicts with 'link', 'result' ('created',
+  'duplicate', 'invalid' or 'error') and, unless invalid, 'j_id'.
+  """
+  v_ids = []
+  for link in links:
+    v_id = _extract_v_id(link) if isinstance(link, str) else None
+    v_ids.append(v_id if v_id is not None and len(v_id) == v_id_len else None)
+  created = iter(runtime_data.createJobs(user.id, [v_id for v_id in v_ids if v_id is not None]))
+
+  results = []
+  rows = []
+  for link, v_id in zip(links, v_ids):
+    if v_id is None:
+      results.append({'link': link, 'result': 'invalid'})
+      continue
+    j_id, ts_start = next(created)
+    if ts_start is None:
+      results.append({'link': link, 'result': 'duplicate', 'j_id': j_id})
+      continue
+    results.append({'link': link, 'result': 'created', 'j_id': j_id})
+    rows.append(((user.id, j_id), {
+      'user_id': user.id,
+      'v_id': v_id,
+      'ts_start': datetime.utcfromtimestamp(ts_start)
+    }))
+  if rows:
+    db_writer.insert_many(rows)
+
+  for res, v_id in zip(results, v_ids):
+    if res['result'] != 'created':
+      continue
+    tracker = JobTracker(user.id, res['j_id'], v_id)
+    if _complete_from_cache(v_id, tracker):
+      continue
+    try:
+      _submit_job(v_id, tracker)
+    except Exception:
+      runtime_data.delJob(user.id, res['j_id'])
+      db_writer.delete((user.id, res['j_id']))
+      res['result'] = 'error'
+  return results
+
 
 
 ################
@@ -152,6 +505,10 @@ def not_found(error):
 def request_conflict(error):
   return make_response(jsonify({'error': 'Request conflict', 'desc':error.description}), 409)
 
+@infinote_app.errorhandler(410)
+def gone(error):
+  return make_response(jsonify({'error': 'Gone', 'desc':error.description}), 410)
+
 
 
 #####################
@@ -220,23 +577,51 @@ def register():
 ######################
 ### AUTHENTICATION ###
 ######################
-@auth.verify_password
+@basic_auth.verify_password
 def verify_password(username, password):
   if not username or not password:
     return False
+  cached = credential_cache.get(username, password)
+  if cached is not None:
+    g.user = AuthUser(*cached)
+    return True
   user = User.query.filter_by(username = username).first()
   if not user:
     return False # TODO: error handling for non-existant user?
   if not user.verify_password(password):
     return False # TODO: error handling for incorrect password?
+  credential_cache.put(username, password, user.id)
+  g.user = user
+  return True
+
+# Cached credentials must not outlive a password change or the user.
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_credentials(mapper, connection, target):
+  credential_cache.invalidate(target.id)
+
+@token_auth.verify_token
+def verify_token(token):
+  user = verify_auth_token(token)
+  if user is None:
+    return False
   g.user = user
   return True
 
-@auth.error_handler
+@basic_auth.error_handler
+@token_auth.error_handler
 def unauthorized():
   # TODO: Use 403 instead of 401 to prevent auth pop-ups on client.
   return make_response(jsonify({'error': 'Unauthorized access'}), 401)
 
+# Exchange basic auth credentials for a token.
+@infinote_app.route('/infinote/api/v1.0/token', methods=['GET'])
+@basic_auth.login_required
+def get_token():
+  duration = infinote_app.config['TOKEN_EXPIRATION']
+  token = generate_auth_token(g.user, duration)
+  return jsonify({'token': token, 'duration': duration})
+
 # TODO: do we need this?
 @infinote_app.route('/infinote/api/v1.0/logout', methods=['GET'])
 def logout():
@@ -254,11 +639,43 @@ def logout():
 def create_job():
   if not request.json or not 'v_id' in request.json:
     abort(400)
+  link = request.json['v_id']
+  list_id = extract_list_id(link) if isinstance(link, str) and _extract_v_id(link) is None else None
+  if list_id is not None:
+    # Playlists expand into jobs in the background, page by page.
+    state = playlist_expander.expand(AuthUser(g.user.id, g.user.username), list_id)
+    return jsonify({'playlist': _public_playlist(state)}), 202
   try:
-    j_id = _spawn_job(g.user, request.json['v_id'])
+    j_id = _spawn_job(g.user, link)
   except ProcessException as e:
     abort(e.code, e.msg)
-  return jsonify({'job': _make_public_job(j_id)}), 201
+  return jsonify({'job': _make_public_job(g.user.id, j_id)}), 201
+
+# Create Many
+@infinote_app.route('/infinote/api/v1.0/jobs/bulk', methods=['POST'])
+@auth.login_required
+def create_jobs():
+  if not request.json or not isinstance(request.json.get('v_ids', None), list):
+    abort(400)
+  links = request.json['v_ids']
+  if len(links) > infinote_app.config['MAX_BULK_JOBS']:
+    abort(400, 'Too many jobs at once.')
+  results = _spawn_jobs(g.user, links)
+  for res in results:
+    j_id = res.pop('j_id', None)
+    job = runtime_data.getJob(g.user.id, j_id) if j_id is not None else None
+    if job is not None:
+      res['job'] = _public_view(g.user.id, j_id, job)
+  return jsonify({'results': results})
+
+# Read Playlist
+@infinote_app.route('/infinote/api/v1.0/playlists/<list_id>', methods=['GET'])
+@auth.login_required
+def get_playlist(list_id):
+  state = playlist_expander.get(g.user.id, list_id)
+  if state is None:
+    abort(404)
+  return jsonify({'playlist': _public_playlist(state)})
 
 # Read All
 @infinote_app.route('/infinote/api/v1.0/jobs', methods=['GET'])
@@ -281,6 +698,36 @@ def get_job(j_id):
     abort(404)
   return jsonify({'job': _make_public_job(g.user.id, j_id)})
 
+# Stream All
+@infinote_app.route('/infinote/api/v1.0/jobs/stream', methods=['GET'])
+@auth.login_required
+def stream_jobs():
+  return Response(stream_with_context(_job_events(g.user.id)), mimetype='text/event-stream')
+
+# Stream x
+# j_id is matched as a string, like the RuntimeData keys it is looked up by.
+@infinote_app.route('/infinote/api/v1.0/jobs/<j_id>/stream', methods=['GET'])
+@auth.login_required
+def stream_job(j_id):
+  job = runtime_data.getJob(g.user.id, j_id)
+  if job is None:
+    abort(404)
+  return Response(stream_with_context(_job_events(g.user.id, j_id)), mimetype='text/event-stream')
+
+# Read queue stats
+@infinote_app.route('/infinote/api/v1.0/queue', methods=['GET'])
+@auth.login_required
+def get_queue():
+  queue = scheduler.stats(g.user.id)
+  queue['max_active'] = scheduler.max_per_user
+  return jsonify({'queue': queue})
+
+# Read service stats
+@infinote_app.route('/infinote/api/v1.0/stats', methods=['GET'])
+@auth.login_required
+def get_stats():
+  return jsonify({'metadata_cache': metadata_cache.stats(), 'storage': storage.stats()})
+
 # Get File
 @infinote_app.route('/infinote/api/v1.0/jobs/<int:j_id>/link', methods=['GET'])
 @auth.login_required
@@ -288,9 +735,39 @@ def get_file(j_id):
   job = runtime_data.getJob(g.user.id, j_id)
   if not job:
     abort(404)
-  if job['stage'] is not 'done':
+  if job['stage'] == 'expired':
+    abort(410, 'File expired, submit the job again.')
+  if job['stage'] != 'done':
     abort(400, 'Job is not complete.')
-  return send_from_directory(download_dir, job['label']+'.mp3', as_attachment=True)
+  directory, filename = _job_file(job)
+  storage.touch(filename)
+  return _send_job_file(directory, filename, job['label']+'.mp3')
+
+# Download Many
+@infinote_app.route('/infinote/api/v1.0/jobs/archive', methods=['GET'])
+@auth.login_required
+def get_archive():
+  """Stream a ZIP of the finished jobs given as ?j_id=...&j_id=..., all of them if none are."""
+  j_ids = request.args.getlist('j_id')
+  user_data = runtime_data.getUser(g.user.id) or {}
+  if j_ids:
+    jobs = [user_data.get(j_id, None) for j_id in j_ids]
+    if None in jobs:
+      abort(404)
+    if any(job['stage'] != 'done' for job in jobs):
+      abort(400, 'Job is not complete.')
+  else:
+    jobs = [job for job in list(user_data.values()) if job['stage'] == 'done']
+    if not jobs:
+      abort(404)
+  files = []
+  for job in jobs:
+    directory, filename = _job_file(job)
+    storage.touch(filename)
+    files.append((job['label']+'.mp3', safe_join(directory, filename)))
+  rv = Response(stream_zip(files), mimetype='application/zip')
+  rv.headers.add('Content-Disposition', 'attachment', filename='infinote.zip')
+  return rv
 
 ## Update
 #@app.route('/infinote/api/v1.0/jobs/<int:job_id>', methods=['PUT'])
@@ -317,22 +794,82 @@ def get_file(j_id):
 @infinote_app.route('/infinote/api/v1.0/jobs/<int:j_id>', methods=['DELETE'])
 @auth.login_required
 def delete_job(j_id):
+  _cancel_job(g.user.id, j_id)
   job = runtime_data.delJob(g.user.id, j_id)
   if job is None:
     abort(404)
+  # Keep the row as a record of the job, just stop tracking it.
+  db_writer.update((g.user.id, j_id), {}, forget=True)
   return jsonify({'result': True})
 
 
 
 def setup(*args, **kwargs):
   global runtime_data
+  global scheduler
+  global transcoder
+  global output_cache
+  global db_writer
+  global journal
+  global playlist_expander
+  global storage
+  global layout
   global otp_count
   otp_count = 0
-  runtime_data = RuntimeData()
+  if journal is not None:
+    journal.stop()
+  # Pick up where the last run left off.
+  journal = JobJournal(infinote_app.config['JOURNAL_DIR'], infinote_app.config['JOURNAL_SNAPSHOT_EVERY'])
+  runtime_data = RuntimeData(journal=journal, tombstone_ttl=infinote_app.config['STREAM_TOMBSTONE_TTL'])
+  runtime_data.restore(journal.load())
+  journal.snapshot(runtime_data)
+  journal.start(runtime_data)
+  inflight.clear()
+  output_cache = OutputCache(download_dir, infinote_app.config['CACHE_INDEX'], locate=_locate_output)
+  if storage is not None:
+    storage.stop(wait=False)
+  storage = StorageManager(download_dir, infinote_app.config['STORAGE_BUDGET'], on_evict=_expire_jobs,
+      index_path=infinote_app.config['STORAGE_INDEX'])
+  # Only walk DOWNLOAD_DIR up front the first time, the sweep catches up with the rest.
+  if not storage.load():
+    storage.scan()
+  storage.start(infinote_app.config['STORAGE_SWEEP_INTERVAL'], infinote_app.config['STORAGE_PART_TTL'])
+  layout = StorageLayout(download_dir,
+      sharded=infinote_app.config['STORAGE_LAYOUT'] == 'sharded',
+      depth=infinote_app.config['STORAGE_SHARD_DEPTH'],
+      width=infinote_app.config['STORAGE_SHARD_WIDTH'],
+      on_move=storage.rename)
+  # Seed the layout's index with where the cache last saw each file.
+  for key, entry in output_cache.entries.items():
+    layout.record(entry['v_id'], entry['filename'], key.rsplit('.', 1)[1])
+  for pool in (scheduler, transcoder):
+    if pool is not None:
+      pool.stop(wait=False)
+  if db_writer is not None:
+    db_writer.stop()
+  db_writer = DBWriter(db, Job,
+      max_batch=infinote_app.config['DB_WRITE_BATCH'],
+      max_latency=infinote_app.config['DB_WRITE_LATENCY'])
+  db_writer.start()
+  scheduler = JobScheduler(_process_job,
+      workers=infinote_app.config['WORKER_COUNT'],
+      max_active=infinote_app.config['MAX_ACTIVE_JOBS'],
+      max_per_user=infinote_app.config['MAX_ACTIVE_JOBS_PER_USER'],
+      weights=infinote_app.config['USER_WEIGHTS'])
+  scheduler.start()
+  transcoder = JobScheduler(_transcode_job, workers=infinote_app.config['TRANSCODE_WORKERS'])
+  transcoder.start()
+  if playlist_expander is not None:
+    playlist_expander.stop(wait=False)
+  playlist_expander = PlaylistExpander(
+      YouTubePlaylistProvider(page_size=infinote_app.config['PLAYLIST_PAGE_SIZE']),
+      _spawn_jobs, max_entries=infinote_app.config['PLAYLIST_MAX_ENTRIES'])
+  print('Resumed jobs:', _resume_jobs())
   print('OTP Count:', otp_count)
   print('Setup complete!')
 
 setup()
 
 if __name__ == '__main__':
-  infinote_app.run(host=infinote_app.config['HOST'],port=infinote_app.config['PORT'], debug=True)
+  require_secret_key()
+  infinote_app.run(host=infinote_app.config['HOST'],port=infinote_app.config['PORT'], debug=True, threaded=True)
@@ -0,0 +1,211 @@
+import os, json, logging
+from threading import Lock, Thread, Event
+
+log = logging.getLogger(__name__)
+
+
+class JobJournal():
+  """Class used to make RuntimeData survive a restart.
+
+  Every change to a job is appended to the journal as the job's full new state
+  (JobRecord.values(), None once deleted), so replaying a record more than
+  once does no harm.
+  append() only queues the record, callers hold RuntimeData's user locks and
+  mustn't wait on disk. A writer thread writes whatever has queued up in one
+  go, flush() does the same on demand.
+  Every <snapshot_every> records the journal moves on to a new segment and a
+  compacted snapshot of all jobs is written in the background, after which
+  the segments it covers are deleted. Restoring loads the snapshot and
+  replays whatever was journaled after it.
+
+  Overall this is the structure:
+  <directory>/snapshot.json -- {'seq': <seq>, 'jobs': [[<u_id>, <j_id>, <job>], ...]}
+  <directory>/journal.<seq of first record> -- one record per line:
+    [<seq>, <u_id>, <j_id>, <job or null>]
+
+  """
+  snapshot_name = 'snapshot.json'
+  segment_prefix = 'journal.'
+
+  def __init__(self, directory, snapshot_every=10000):
+    self.directory = directory
+    self.snapshot_every = snapshot_every
+    self.seq = 0
+    self.since_snapshot = 0
+    self.file = None
+    self.pending = [] # [[<seq>, <u_id>, <j_id>, <job>], ...] not yet written
+    self.lock = Lock()
+    self.file_lock = Lock()
+    self.snapshot_lock = Lock()
+    self.source = None
+    self.wakeup = Event()
+    self.queued = Event()
+    self.running = False
+    self.thread = None
+    self.writer = None
+    os.makedirs(directory, exist_ok=True)
+
+  def _snapshot_path(self):
+    return os.path.join(self.directory, self.snapshot_name)
+
+  def _segments(self):
+    """Return [(<seq of first record>, <path>), ...] sorted by seq."""
+    segments = []
+    for name in os.listdir(self.directory):
+      if name.startswith(self.segment_prefix):
+        try:
+          segments.append((int(name[len(self.segment_prefix):]), os.path.join(self.directory, name)))
+        except ValueError:
+          pass
+    return sorted(segments)
+
+  def _new_segment(self, seq):
+    """Start writing to a new segment after <seq>. Caller must hold self.file_lock."""
+    if self.file is not None:
+      self.file.close()
+    name = '{}{:012d}'.format(self.segment_prefix, seq + 1)
+    self.file = open(os.path.join(self.directory, name), 'a')
+
+  def load(self):
+    """Restore the snapshot and replay the journal after it.
+
+    Returns the jobs as {<u_id>: {<j_id>: <job>}} and opens a fresh
+    segment for new records.
+    """
+    jobs = {}
+    seq = 0
+    try:
+      with open(self._snapshot_path()) as f:
+        snapshot = json.load(f)
+      seq = snapshot['seq']
+      for u_id, j_id, job in snapshot['jobs']:
+        jobs.setdefault(u_id, {})[j_id] = job
+    except (OSError, ValueError, KeyError):
+      pass
+    snapshot_seq = seq
+    for first, path in self._segments():
+      with open(path) as f:
+        for line in f:
+          try:
+            r_seq, u_id, j_id, job = json.loads(line)
+          except ValueError:
+            # Torn write from a crash, nothing after it made it to disk.
+            log.warning('Skipping the rest of journal segment %s.', path)
+            break
+          seq = max(seq, r_seq)
+          if r_seq <= snapshot_seq:
+            continue
+          if job is None:
+            user_jobs = jobs.get(u_id, {})
+            user_jobs.pop(j_id, None)
+            if not user_jobs:
+              jobs.pop(u_id, None)
+          else:
+            jobs.setdefault(u_id, {})[j_id] = job
+    with self.file_lock:
+      with self.lock:
+        self.seq = seq
+      self._new_segment(seq)
+    return jobs
+
+  def append(self, u_id, j_id, job):
+    """Queue the new state of a job, job=None means it was deleted."""
+    with self.lock:
+      if self.file is None:
+        return False
+      self.seq += 1
+      self.pending.append([self.seq, u_id, j_id, job])
+      if len(self.pending) == 1:
+        self.queued.set()
+      self.since_snapshot += 1
+      if self.since_snapshot >= self.snapshot_every:
+        self.since_snapshot = 0
+        self.wakeup.set()
+      return True
+
+  def _write_pending(self):
+    """Write out the queued records. Caller must hold self.file_lock.
+
+    Returns the seq of the last record written.
+    """
+    with self.lock:
+      records, self.pending = self.pending, []
+      seq = self.seq
+    if records and self.file is not None:
+      self.file.write(''.join(json.dumps(record) + '\n' for record in records))
+      self.file.flush()
+    return seq
+
+  def flush(self):
+    """Write out the queued records now."""
+    with self.file_lock:
+      return self._write_pending()
+
+  def snapshot(self, source):
+    """Write a compacted snapshot of <source> (a RuntimeData) and prune the journal."""
+    with self.snapshot_lock:
+      with self.file_lock:
+        # Everything up to seq goes to the segments about to be pruned,
+        # anything queued after it to the new one.
+        seq = self._write_pending()
+        self._new_segment(seq)
+      # Changes made while dumping may or may not be in the dump, they are
+      # journaled after seq either way and replaying them is harmless.
+      snapshot = {'seq': seq, 'jobs': source.dump()}
+      tmp_path = self._snapshot_path() + '.tmp'
+      with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f)
+      os.replace(tmp_path, self._snapshot_path())
+      for first, path in self._segments():
+        if first <= seq:
+          os.remove(path)
+      return seq
+
+  def start(self, source):
+    self.source = source
+    if self.running:
+      return False
+    self.running = True
+    self.thread = Thread(target=self._work, name='infinote-journal')
+    self.thread.daemon = True
+    self.thread.start()
+    self.writer = Thread(target=self._write_work, name='infinote-journal-writer')
+    self.writer.daemon = True
+    self.writer.start()
+    return True
+
+  def stop(self):
+    self.running = False
+    self.wakeup.set()
+    self.queued.set()
+    for thread in (self.thread, self.writer):
+      if thread is not None:
+        thread.join()
+    with self.file_lock:
+      self._write_pending()
+      with self.lock:
+        file, self.file = self.file, None
+      if file is not None:
+        file.close()
+
+  def _work(self):
+    while True:
+      self.wakeup.wait()
+      self.wakeup.clear()
+      if not self.running:
+        return
+      try:
+        self.snapshot(self.source)
+      except Exception:
+        log.exception('Failed to write a journal snapshot.')
+
+  def _write_work(self):
+    while True:
+      self.queued.wait()
+      self.queued.clear()
+      try:
+        self.flush()
+      except Exception:
+        log.exception('Failed to write journal records.')
+      if not self.running:
+        return
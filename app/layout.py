@@ -0,0 +1,82 @@
+import os, hashlib
+from threading import Lock
+
+
+class StorageLayout():
+  """Class used to decide where output files go and to find them again.
+
+  Layouts:
+  flat -- <directory>/<label>.<ext>, how files were always stored. Videos with
+    the same title end up with the same file.
+  sharded -- <directory>/<h[0:width]>/<h[width:2*width]>/<v_id>.<ext>, h being
+    the sha1 of the v_id (<depth> levels of <width> hex digits), so every
+    video gets a file of its own and no directory gets too big to list.
+
+  Where each video's file was last found is kept in an index, so most lookups
+  are a single stat(). Lookups fall back to the other layout, which keeps
+  files reachable while reshard.py moves them.
+
+  Overall this is the structure:
+  paths = {'<v_id>.<ext>': <path relative to directory>}
+
+  """
+
+  def __init__(self, directory, sharded=False, depth=2, width=2, on_move=None):
+    self.directory = directory
+    self.sharded = sharded
+    self.depth = depth
+    self.width = width
+    self.on_move = on_move
+    self.paths = {}
+    self.lock = Lock()
+
+  def flat_path(self, label, ext='mp3'):
+    return '{}.{}'.format(label, ext)
+
+  def shard_path(self, v_id, ext='mp3'):
+    digest = hashlib.sha1(v_id.encode('utf-8')).hexdigest()
+    shards = [digest[i*self.width:(i+1)*self.width] for i in range(self.depth)]
+    return os.path.join(*(shards + ['{}.{}'.format(v_id, ext)]))
+
+  def name(self, v_id):
+    """Path for a new file relative to directory, without extension. None means the label."""
+    if not self.sharded:
+      return None
+    return os.path.splitext(self.shard_path(v_id))[0]
+
+  def relpath(self, v_id, label, ext='mp3'):
+    """Where a new file for this video goes."""
+    return self.shard_path(v_id, ext) if self.sharded else self.flat_path(label, ext)
+
+  def _exists(self, relpath):
+    return os.path.isfile(os.path.join(self.directory, relpath))
+
+  def locate(self, v_id, label, ext='mp3'):
+    """Return the path of the video's file relative to directory, None if there is none.
+
+    reshard.py links a file into its shard before it removes the flat one, so
+    looking at the flat path before the shard never misses a file that is
+    being moved. The shard is looked at first too, since in the sharded
+    layout a flat file with the same label may be another video's.
+    """
+    key = '{}.{}'.format(v_id, ext)
+    with self.lock:
+      known = self.paths.get(key, None)
+    if known is not None and self._exists(known):
+      return known
+    shard_path = self.shard_path(v_id, ext)
+    candidates = [shard_path] if self.sharded else []
+    if label:
+      candidates.append(self.flat_path(label, ext))
+    candidates.append(shard_path)
+    for relpath in candidates:
+      if self._exists(relpath):
+        self.record(v_id, relpath, ext)
+        if known is not None and known != relpath and self.on_move is not None:
+          self.on_move(known, relpath)
+        return relpath
+    return None
+
+  def record(self, v_id, relpath, ext='mp3'):
+    with self.lock:
+      self.paths['{}.{}'.format(v_id, ext)] = relpath
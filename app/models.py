@@ -1,7 +1,10 @@
-from app.config import db
+import time
+from app.config import db, infinote_app
+from collections import namedtuple, deque
 from datetime import datetime, timezone
-from threading import RLock
+from threading import RLock, Condition
 from passlib.apps import custom_app_context as pwd_context
+from itsdangerous import TimedJSONWebSignatureSerializer as Serializer, BadSignature, SignatureExpired
 
 
 class User(db.Model):
@@ -28,6 +31,25 @@ class User(db.Model):
     return '<User {}: p_hash - {}>'.format(self.username, self.p_hash)
 
 
+# Stand-in for a User whose credentials were already verified, without a db hit.
+AuthUser = namedtuple('AuthUser', ('id', 'username'))
+
+
+# Signed tokens carry everything needed to authenticate a request, so checking
+# one is just an HMAC check -- no db lookup and no password hashing.
+def generate_auth_token(user, expiration=3600):
+  s = Serializer(infinote_app.config['SECRET_KEY'], expires_in=expiration)
+  return s.dumps({'id': user.id, 'username': user.username}).decode('ascii')
+
+def verify_auth_token(token):
+  s = Serializer(infinote_app.config['SECRET_KEY'])
+  try:
+    data = s.loads(token)
+  except (SignatureExpired, BadSignature):
+    return None
+  return AuthUser(data['id'], data['username'])
+
+
 class Job(db.Model):
   id = db.Column(db.Integer, primary_key=True)
   user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -45,6 +67,106 @@ class RuntimeDataException(Exception):
     self.msg = msg
 
 
+class JobRecord():
+  """Compact record of a job's meta data.
+
+  Uses __slots__ instead of a dict per job, but still behaves like the dict it
+  replaced -- job['stage'], iterating over the keys, comparing equal to a dict
+  with the same items -- so the public view of a job is unchanged. stage only
+  accepts one of JobRecord.stages.
+
+  """
+  __slots__ = ('id', 'v_id', 'label', '_stage', 'prog', 'link', 'timestamp')
+  fields = ('id', 'v_id', 'label', 'stage', 'prog', 'link', 'timestamp')
+  field_set = frozenset(fields)
+  stages = ('init', 'download', 'convert', 'done', 'expired')
+  # Maps a stage to its canonical string, for O(1) validation.
+  _stage_map = {stage: stage for stage in stages}
+
+  def __init__(self, id='', v_id='', label='', stage='init', prog=0.00, link='', timestamp=''):
+    self.id = id
+    self.v_id = v_id
+    self.label = label
+    self.stage = stage
+    self.prog = prog
+    self.link = link
+    self.timestamp = timestamp
+
+  @classmethod
+  def from_dict(cls, d):
+    return cls(**d)
+
+  @classmethod
+  def from_values(cls, values):
+    """Inverse of values(), skips __init__ since this is done in bulk on restore."""
+    job = cls.__new__(cls)
+    job.id, job.v_id, job.label, job.stage, job.prog, job.link, job.timestamp = values
+    return job
+
+  @property
+  def stage(self):
+    return self._stage
+
+  @stage.setter
+  def stage(self, value):
+    try:
+      self._stage = self._stage_map[value]
+    except (KeyError, TypeError):
+      raise ValueError('Invalid stage: {}'.format(value))
+
+  # Dict style access.
+  def __getitem__(self, key):
+    if key not in self.field_set:
+      raise KeyError(key)
+    return getattr(self, key)
+
+  def __setitem__(self, key, value):
+    if key not in self.field_set:
+      raise KeyError(key)
+    setattr(self, key, value)
+
+  def __contains__(self, key):
+    return key in self.field_set
+
+  def __iter__(self):
+    return iter(self.fields)
+
+  def __len__(self):
+    return len(self.fields)
+
+  def get(self, key, default=None):
+    if key not in self.field_set:
+      return default
+    return getattr(self, key)
+
+  def keys(self):
+    return self.fields
+
+  def items(self):
+    return [(key, getattr(self, key)) for key in self.fields]
+
+  def values(self):
+    return [self.id, self.v_id, self.label, self._stage, self.prog, self.link, self.timestamp]
+
+  def update(self, d):
+    if 'stage' in d:
+      # Validate first, so a bad stage doesn't leave a half updated job.
+      self.stage = d['stage']
+    for key, value in d.items():
+      self[key] = value
+
+  def as_dict(self):
+    return dict(self.items())
+
+  def __eq__(self, other):
+    if isinstance(other, (JobRecord, dict)):
+      return self.as_dict() == dict(other.items())
+    return NotImplemented
+
+  def __repr__(self):
+    return '<JobRecord {}>'.format(self.as_dict())
+
+
 class RuntimeData():
   """Class used to manage data that lives mostly outside of the db.
 
@@ -52,7 +174,7 @@ class RuntimeData():
 
   <jobs> is a dict itself -- {<j_id>:<meta_data>}
 
-  <meta_data> is a dict of meta data about a given job.
+  <meta_data> is a JobRecord of meta data about a given job.
 
   Overall this is the structure:
   data = {
@@ -73,18 +195,124 @@ class RuntimeData():
     }
   }
 
+  Locking is striped by user: every user hashes to one of <stripes> locks and
+  all job level operations only take that lock, so progress updates for one
+  user never wait on requests from unrelated users. data_lock is only taken
+  (after the user's stripe) when adding or removing a user.
+
+  Every change to a user's jobs bumps that user's revision number and wakes up
+  anyone blocked in wait_for_changes(), which is what live progress streams
+  are built on. Deleted jobs are remembered for <tombstone_ttl> seconds so
+  streams can pass the deletion on, then forgotten. With a <journal> every change is also recorded there, see
+  app.journal.JobJournal.
+
   """
-  valid_keys = ('id', 'v_id', 'label', 'stage', 'prog', 'link', 'timestamp')
+  valid_keys = JobRecord.fields
   default_values = ('', '', '', 'init', 0.00, '', '')
-  valid_stages = ('init', 'download', 'convert', 'done')
+  valid_stages = JobRecord.stages
 
-  def __init__(self):
+  def __init__(self, stripes=16, journal=None, tombstone_ttl=60):
     self.data = {}
+    self.journal = journal
     self.data_lock = RLock()
+    self.stripes = tuple(RLock() for i in range(max(1, stripes)))
+    self.conds = tuple(Condition(lock) for lock in self.stripes)
+    self.revs = {} # {<u_id>: <revision>}
+    self.changes = {} # {<u_id>: {<j_id>: <revision of last change>}}
+    self.tombstone_ttl = tombstone_ttl
+    self.tombstones = {} # {<u_id>: deque([(<time deleted>, <revision>, <j_id>), ...])}
+    self.horizons = {} # {<u_id>: <revision of the newest forgotten deletion>}
+
+  def _stripe(self, u_id):
+    return hash(u_id) % len(self.stripes)
+
+  def _user_lock(self, u_id):
+    return self.stripes[self._stripe(u_id)]
+
+  def _touch(self, u_id, j_ids):
+    """Record a change to the given jobs. Caller must hold the user's lock."""
+    rev = self.revs.get(u_id, 0) + 1
+    self.revs[u_id] = rev
+    changes = self.changes.setdefault(u_id, {})
+    jobs = self.data.get(u_id, {})
+    now = time.monotonic()
+    for j_id in j_ids:
+      changes[j_id] = rev
+      if j_id not in jobs:
+        self.tombstones.setdefault(u_id, deque()).append((now, rev, j_id))
+    self._prune(u_id, now)
+    self.conds[self._stripe(u_id)].notify_all()
+    if self.journal is not None:
+      for j_id in j_ids:
+        job = jobs.get(j_id, None)
+        self.journal.append(u_id, j_id, None if job is None else job.values())
+
+  def _prune(self, u_id, now):
+    """Forget deletions older than tombstone_ttl. Caller must hold the user's lock."""
+    tombstones = self.tombstones.get(u_id, None)
+    if not tombstones:
+      return
+    changes = self.changes[u_id]
+    cutoff = now - self.tombstone_ttl
+    while tombstones and tombstones[0][0] < cutoff:
+      deleted, rev, j_id = tombstones.popleft()
+      if changes.get(j_id, None) == rev:
+        # Not changed (i.e. created again) since.
+        del changes[j_id]
+      self.horizons[u_id] = rev
+    if not tombstones:
+      del self.tombstones[u_id]
+
+  def wait_for_changes(self, u_id, since=None, timeout=None):
+    """Wait for a user's jobs to change after revision <since>.
+
+    Returns (<revision>, {<j_id>: <copy of job> or None if deleted}). With
+    since=None all of the user's current jobs are returned right away, the
+    same goes for a <since> so old that deletions after it were forgotten. If
+    nothing changed before timeout, the dict is empty.
+    """
+    with self._user_lock(u_id):
+      if since is not None:
+        self.conds[self._stripe(u_id)].wait_for(lambda: self.revs.get(u_id, 0) > since, timeout)
+      rev = self.revs.get(u_id, 0)
+      jobs = self.data.get(u_id, {})
+      if since is None or since < self.horizons.get(u_id, 0):
+        return rev, {j_id: dict(job.items()) for j_id, job in jobs.items()}
+      changed = {}
+      for j_id, j_rev in self.changes.get(u_id, {}).items():
+        if j_rev > since:
+          job = jobs.get(j_id, None)
+          changed[j_id] = None if job is None else dict(job.items())
+      return rev, changed
+
+  def dump(self):
+    """Return a copy of every job as [[<u_id>, <j_id>, <job values>], ...]."""
+    with self.data_lock:
+      u_ids = list(self.data)
+    jobs = []
+    for u_id in u_ids:
+      with self._user_lock(u_id):
+        for j_id, job in self.data.get(u_id, {}).items():
+          jobs.append([u_id, j_id, job.values()])
+    return jobs
+
+  def restore(self, data):
+    """Load jobs from {<u_id>: {<j_id>: <job values>}}, without journaling them."""
+    restored = 0
+    for u_id, jobs in data.items():
+      with self._user_lock(u_id), self.data_lock:
+        user_data = self.data.setdefault(u_id, {})
+        for j_id, values in jobs.items():
+          try:
+            user_data[j_id] = JobRecord.from_values(values)
+          except (ValueError, TypeError):
+            continue
+          restored += 1
+    return restored
 
   # User Layer
   def addNewUser(self, u_id):
-    with self.data_lock:
+    with self._user_lock(u_id), self.data_lock:
       if u_id in self.data:
         return False
       else:
@@ -92,22 +320,26 @@ class RuntimeData():
         return True
 
   def getUser(self, u_id):
-    with self.data_lock:
+    with self._user_lock(u_id):
       return self.data.get(u_id, None)
 
   def updateUser(self, u_id, data):
-    with self.data_lock:
+    with self._user_lock(u_id):
       if not isinstance(data, dict) or self.getUser(u_id) is None:
         return False
       else:
         # Update a user's dictionary of jobs.
         # Overrides matching jobs and adds new ones.
         self.data[u_id].update(data)
+        self._touch(u_id, data.keys())
         return True
 
   def delUser(self, u_id):
-    with self.data_lock:
-      return self.data.pop(u_id, None)
+    with self._user_lock(u_id), self.data_lock:
+      user_data = self.data.pop(u_id, None)
+      if user_data:
+        self._touch(u_id, user_data.keys())
+      return user_data
 
   # Job Layer
   def _gen_job_id(self, v_id):
@@ -118,36 +350,65 @@ class RuntimeData():
     return j_id
 
   def createJob(self, u_id, v_id):
-    with self.data_lock:
+    with self._user_lock(u_id):
       j_id = self._gen_job_id(v_id)
       if not j_id:
         raise RuntimeDataException(400, 'Unable to generate job id.') #TODO: handle this w/o this exception.
 
-      if self.getJob(u_id, j_id):
+      existing = self.getJob(u_id, j_id)
+      if existing and existing.get('stage') != 'expired':
         raise RuntimeDataException(409, 'Job is already being processed.') #TODO: handle this w/o this exception.
 
-      job = dict(zip(self.valid_keys, self.default_values))
-      job['id'] = j_id
-      job['v_id'] = v_id
-      job['timestamp'] = datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()
+      job = JobRecord(id=j_id, v_id=v_id)
+      job.timestamp = datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()
 
+      if existing:
+        # Its file was evicted, start the job over.
+        self.updateUser(u_id, {j_id: job})
       # We should never fail to add a new job at this point,
       # but let's be smart and check anyways.
-      if not self.addNewJob(u_id, j_id, job):
+      elif not self.addNewJob(u_id, j_id, job):
         raise RuntimeDataException(500, 'Failed to add new job.')
         return '', ''
 
       return j_id, job['timestamp']
 
+  def createJobs(self, u_id, v_ids):
+    """Create a job for every v_id, all under one lock acquisition.
+
+    Returns [(<j_id>, <timestamp>), ...] in the order of v_ids. timestamp is
+    None if that job already exists (or showed up earlier in v_ids). Expired
+    jobs are started over like new ones.
+    """
+    with self._user_lock(u_id):
+      self.addNewUser(u_id)
+      user_data = self.data[u_id]
+      ts = datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()
+      created = []
+      new_jobs = {}
+      for v_id in v_ids:
+        j_id = self._gen_job_id(v_id)
+        if not j_id or j_id in new_jobs or (j_id in user_data and user_data[j_id].stage != 'expired'):
+          created.append((j_id, None))
+          continue
+        new_jobs[j_id] = JobRecord(id=j_id, v_id=v_id, timestamp=ts)
+        created.append((j_id, ts))
+      if new_jobs:
+        user_data.update(new_jobs)
+        self._touch(u_id, new_jobs.keys())
+      return created
+
   def _is_job_dict(self, d):
+    if isinstance(d, JobRecord):
+      return True
     if not isinstance(d, dict):
       return False
-    if set(d.keys()) ^ set(self.valid_keys):
+    if d.keys() != JobRecord.field_set:
       return False
-    return True
+    return d['stage'] in JobRecord._stage_map
 
   def addNewJob(self, u_id, j_id, data):
-    with self.data_lock:
+    with self._user_lock(u_id):
       if not self._is_job_dict(data):
         return False
       if self.getUser(u_id) is not None:
@@ -155,10 +416,12 @@ class RuntimeData():
           return False
       else:
         self.addNewUser(u_id)
+      if not isinstance(data, JobRecord):
+        data = JobRecord.from_dict(data)
       return self.updateUser(u_id, {j_id:data})
 
   def getJob(self, u_id, j_id):
-    with self.data_lock:
+    with self._user_lock(u_id):
       user_data = self.getUser(u_id)
       if not user_data:
         return None
@@ -166,25 +429,29 @@ class RuntimeData():
         return user_data.get(j_id, None)
 
   def updateJob(self, u_id, j_id, data):
-    with self.data_lock:
+    with self._user_lock(u_id):
       if not self._is_job_dict(data):
         return False
       if self.getJob(u_id, j_id) is None:
         return False
       else:
         self.data[u_id][j_id].update(data)
+        self._touch(u_id, (j_id,))
         return True
 
   def delJob(self, u_id, j_id):
-    with self.data_lock:
+    with self._user_lock(u_id):
       if self.getUser(u_id) is None:
         return None
       else:
-        return self.data[u_id].pop(j_id, None)
+        job = self.data[u_id].pop(j_id, None)
+        if job is not None:
+          self._touch(u_id, (j_id,))
+        return job
 
   # Data Layer:
   def get_attribute(self, u_id, j_id, key):
-    with self.data_lock:
+    with self._user_lock(u_id):
       job_data = self.getJob(u_id, j_id)
       if job_data is None:
         return None
@@ -192,10 +459,29 @@ class RuntimeData():
         return job_data.get(key, None)
 
   def set_attribute(self, u_id, j_id, key, value):
-    with self.data_lock:
+    with self._user_lock(u_id):
       # We don't allow adding NEW attributes.
       if self.get_attribute(u_id, j_id, key) is None or value is None:
         return False
+      elif key == 'stage' and value not in JobRecord._stage_map:
+        return False
       else:
         self.data[u_id][j_id][key] = value
+        self._touch(u_id, (j_id,))
         return True
+
+  def set_attributes(self, u_id, j_id, attrs):
+    """Atomically set several existing attributes of a job at once."""
+    with self._user_lock(u_id):
+      job_data = self.getJob(u_id, j_id)
+      if job_data is None:
+        return False
+      # We don't allow adding NEW attributes.
+      for key, value in attrs.items():
+        if job_data.get(key, None) is None or value is None:
+          return False
+      if 'stage' in attrs and attrs['stage'] not in JobRecord._stage_map:
+        return False
+      job_data.update(attrs)
+      self._touch(u_id, (j_id,))
+      return True
@@ -0,0 +1,138 @@
+import re, logging, pafy
+from threading import Thread, Lock
+
+log = logging.getLogger(__name__)
+# Normal playlists start with PL, mixes with RD, liked videos with LL, uploads
+# with UU, favorites with FL and albums with OL.
+list_id_re = re.compile(r'(?:^|[?&])list=(?P<list_id>(?:RD|PL|LL|UU|FL|OL)[-_0-9a-zA-Z]+)(?:&|$)')
+
+
+def extract_list_id(link):
+  match = list_id_re.search(link)
+  if not match:
+    return None
+  return match.group('list_id')
+
+
+
+#################
+### Providers ###
+#################
+class PlaylistProvider():
+  """Class used to list the videos of a playlist.
+
+  Subclasses implement pages(), which yields the v_ids of a playlist one page
+  at a time as they are fetched, so nobody has to wait for the full listing.
+  """
+
+  def pages(self, list_id):
+    raise NotImplementedError
+
+
+class YouTubePlaylistProvider(PlaylistProvider):
+  """Lists playlists with the YouTube data API, page_size entries per request."""
+
+  def __init__(self, page_size=50):
+    self.page_size = page_size
+
+  def pages(self, list_id):
+    query = {'part': 'contentDetails', 'maxResults': self.page_size, 'playlistId': list_id}
+    while True:
+      items = pafy.call_gdata('playlistItems', query)
+      yield [item['contentDetails']['videoId'] for item in items['items']]
+      token = items.get('nextPageToken', None)
+      if not token:
+        return
+      query['pageToken'] = token
+
+
+
+#################
+### Expansion ###
+#################
+class PlaylistExpander():
+  """Class used to turn playlists into jobs in the background.
+
+  Every playlist is expanded on a thread of its own. Each page the provider
+  yields is handed to spawn(user, v_ids) right away, so the first videos are
+  queued while the rest of the playlist is still being listed. Expansion stops
+  after max_entries videos.
+
+  Overall this is the structure:
+  expansions = {
+    <u_id>: {
+      <list_id>: {
+        'list_id': <list_id>,
+        'stage': 'expanding', 'done' or 'error',
+        'pages': <pages expanded so far>,
+        'entries': <videos seen so far>,
+        'created': <jobs created so far>,
+        'error': <message or None>
+      },
+      ...
+    },
+    ...
+  }
+
+  """
+
+  def __init__(self, provider, spawn, max_entries=5000):
+    self.provider = provider
+    self.spawn = spawn
+    self.max_entries = max_entries
+    self.expansions = {}
+    self.lock = Lock()
+    self.threads = []
+    self.running = True
+
+  def expand(self, user, list_id):
+    """Start expanding list_id for user, returns a copy of its state."""
+    with self.lock:
+      user_expansions = self.expansions.setdefault(user.id, {})
+      state = user_expansions.get(list_id, None)
+      if state is not None and state['stage'] == 'expanding':
+        return dict(state)
+      state = {'list_id': list_id, 'stage': 'expanding', 'pages': 0, 'entries': 0, 'created': 0, 'error': None}
+      user_expansions[list_id] = state
+      t = Thread(target=self._work, args=(user, list_id, state), name='infinote-playlist')
+      t.daemon = True
+      self.threads = [thread for thread in self.threads if thread.is_alive()]
+      self.threads.append(t)
+      t.start()
+      return dict(state)
+
+  def get(self, u_id, list_id):
+    with self.lock:
+      state = self.expansions.get(u_id, {}).get(list_id, None)
+      return dict(state) if state is not None else None
+
+  def stop(self, wait=True):
+    """Stop expanding after the page each playlist is on."""
+    with self.lock:
+      self.running = False
+      threads, self.threads = self.threads, []
+    if wait:
+      for t in threads:
+        t.join()
+
+  def _work(self, user, list_id, state):
+    try:
+      for page in self.provider.pages(list_id):
+        with self.lock:
+          if not self.running:
+            break
+          page = page[:self.max_entries - state['entries']]
+        results = self.spawn(user, page)
+        with self.lock:
+          state['pages'] += 1
+          state['entries'] += len(page)
+          state['created'] += sum(1 for res in results if res['result'] == 'created')
+          if state['entries'] >= self.max_entries:
+            break
+      with self.lock:
+        state['stage'] = 'done'
+    except Exception as e:
+      log.exception('Failed to expand playlist %s.', list_id)
+      with self.lock:
+        state['stage'] = 'error'
+        state['error'] = str(e)
@@ -2,35 +2,70 @@ import pafy
 import re
 import os.path
 import threading
+import subprocess
+import tempfile
+import time
+import logging
+from collections import namedtuple
+from contextlib import suppress
+from urllib.request import urlopen
 from converter import Converter
+from app.fetch import resumable_download, segmented_download
+from app import titles
+
+log = logging.getLogger(__name__)
+ffmpeg_path = 'ffmpeg'
+progress_log_interval = 5 # Min seconds between progress log lines.
+_last_progress_log = 0.0
+chunk_size = 16 * 1024
+stream_expiry_margin = 60 # Seconds before a stream url expires that we stop using it.
 
 
 
 ####################
 ### Text Parsing ###
 ####################
+# Both are rule tables in app.titles now, these stay for existing callers.
 def parsechannel(text):
-  t = re.sub('vevo$', '', text, flags=re.I) # Remove trailing 'vevo'
-  t = re.sub('tv$', '', t, flags=re.I) # Dido for 'tv'
-  if not re.search('^UKF', t):
-    t = ' '.join(re.findall('[A-Z][^A-Z\\s]*', t)) # Break up on camel case
-  return t
+  return titles.normalize_channel(text)
 
 def parsetitle(text):
-  # Look for these words within brackets/parenthesis. 
-  bracket_keywords=('monstercat', 'release', 'official', 'music', 'video', 'audio')
+  return titles.normalize_title(text)
+
+
+
+#################
+### Resolving ###
+#################
+class AudioStream(namedtuple('AudioStream', ('url', 'extension', 'filesize'))):
+  """What we need of a pafy audio stream, small enough to cache."""
+
+  def get_filesize(self):
+    return self.filesize
 
-  splits = re.split(r'-', text)
-  for i in range(len(splits)):
-    splits[i] = re.sub('^\[.*\]\s*', '', splits[i]) # Remove anything in brackets at the very beginning.
-    # Remove keywords and their surrounding brackets/parenthesis.
-    splits[i] = re.sub('\s{0,1}[\[\(].*['+'|'.join(bracket_keywords)+'].*[\]\)]', '', splits[i], flags=re.I)
-    splits[i] = re.sub('^\s+', '', splits[i]) # Remove spaces at the beginnig.
-    splits[i] = re.sub('\s+$', '', splits[i]) # Remove spaces at the end.
+# Everything a job needs to know about a video before it can download it.
+VideoMeta = namedtuple('VideoMeta', ('title', 'label', 'audio'))
 
-  splits = filter(None, splits) # Filter out empty strings
-  clean_string = ' - '.join(splits) # Join together new string
-  return clean_string
+def _stream_expiry(url):
+  # Stream urls are signed and stop working at 'expire'.
+  match = re.search(r'[?&]expire=(\d+)', url)
+  if not match:
+    return None
+  return int(match.group(1)) - stream_expiry_margin
+
+def resolve(url, cache=None):
+  """Look up a video's title and best audio stream, from cache when possible."""
+  if cache is not None:
+    meta = cache.get(url)
+    if meta is not None:
+      return meta
+  video = pafy.new(url)
+  best = video.getbestaudio()
+  audio = AudioStream(best.url, best.extension, best.get_filesize())
+  meta = VideoMeta(video.title, parsetitle(video.title), audio)
+  if cache is not None:
+    cache.put(url, meta, _stream_expiry(audio.url))
+  return meta
 
 
 
@@ -38,19 +73,28 @@ def parsetitle(text):
 ### Downloading ###
 ###################
 def progress_cb(total, recvd, ratio, rate, eta):
+  # Called for every chunk, so only log every now and then.
+  global _last_progress_log
+  now = time.time()
+  if ratio < 1 and now - _last_progress_log < progress_log_interval:
+    return
+  _last_progress_log = now
   status_string = ('  {:,} Bytes [{:.2%}] received. Rate: [{:4.0f} '
                                'KB/s].  ETA: [{:.0f} secs]')
   prg_stats = (recvd, ratio, rate, eta)
-  status = status_string.format(*prg_stats)
-  print(status)
+  log.info(status_string.format(*prg_stats))
 
-def download(audio_stream, filepath, callback=progress_cb):
-  print('START DOWNLOAD')
-  audio_stream.download(filepath=filepath, quiet=True, callback=callback)
-  print('FINISHED DOWNLOAD')
+def download(audio_stream, filepath, callback=progress_cb, segments=1):
+  # Resumes from <filepath>.part if an earlier attempt got cut off.
+  log.info('START DOWNLOAD')
+  if segments > 1:
+    segmented_download(audio_stream.url, filepath, callback, audio_stream.get_filesize(), segments)
+  else:
+    resumable_download(audio_stream.url, filepath, callback, audio_stream.get_filesize())
+  log.info('FINISHED DOWNLOAD')
 
 def convert_file(original_file, new_file, callback=None):
-  print('START CONVERSION')
+  log.info('START CONVERSION')
   c = Converter()
   # Let's assume we'll always have 2 channels.
   # Let's also assume we alway want .mp3
@@ -65,55 +109,161 @@ def convert_file(original_file, new_file, callback=None):
   else:
     for x in conversion:
       pass
-  print('FINISHED CONVERSION')
+  log.info('FINISHED CONVERSION')
+
+def _stream_cmd(new_file):
+  # Same output as convert_file(), but read the source from stdin.
+  return [ffmpeg_path, '-y', '-loglevel', 'error', '-i', 'pipe:0',
+          '-vn', '-ac', '2', '-codec:a', 'libmp3lame', '-f', 'mp3', new_file]
 
-def getaudio(url, directory=".", tracker=None):
+def stream_convert(audio_stream, new_file, callback=progress_cb):
+  """Download audio_stream straight into ffmpeg's stdin.
+
+  Conversion overlaps the download and no intermediate file is written.
+  callback gets the same (total, recvd, ratio, rate, eta) arguments as with
+  download(), so download progress is also conversion progress.
+  """
+  log.info('START STREAMING CONVERSION')
+  # ffmpeg's stderr goes to a file, a pipe nobody reads until the end can
+  # fill up and stall ffmpeg and the download with it.
+  with tempfile.TemporaryFile() as err_file:
+    proc = subprocess.Popen(_stream_cmd(new_file), stdin=subprocess.PIPE, stderr=err_file)
+    try:
+      response = urlopen(audio_stream.url)
+      total = int(response.headers.get('Content-Length') or audio_stream.get_filesize() or 0)
+      recvd = 0
+      t0 = time.time()
+      try:
+        with response:
+          for chunk in iter(lambda: response.read(chunk_size), b''):
+            proc.stdin.write(chunk)
+            recvd += len(chunk)
+            if callback:
+              elapsed = max(time.time() - t0, 1e-6)
+              rate = recvd / 1024 / elapsed
+              ratio = recvd / total if total else 0.0
+              eta = (total - recvd) / 1024 / rate if total else 0.0
+              callback(total, recvd, ratio, rate, eta)
+        # EOF tells ffmpeg to flush the rest of the output.
+        proc.stdin.close()
+      except BrokenPipeError:
+        # ffmpeg quit early, what it printed says why.
+        if proc.wait() == 0:
+          raise
+    except Exception:
+      proc.kill()
+      proc.wait()
+      if os.path.isfile(new_file):
+        os.remove(new_file)
+      raise
+    finally:
+      with suppress(BrokenPipeError):
+        proc.stdin.close()
+    if proc.wait() != 0:
+      if os.path.isfile(new_file):
+        os.remove(new_file)
+      err_file.seek(0)
+      err = err_file.read()
+      raise Exception('ffmpeg failed: {}'.format(err.decode(errors='replace').strip()))
+  log.info('FINISHED STREAMING CONVERSION')
+
+def _forget(url, cache):
+  # The stream may have gone stale, a retry should resolve it again.
+  if cache is not None:
+    cache.remove(url)
+
+def fetchaudio(url, directory=".", tracker=None, stream=False, segments=1, cache=None, name=None):
+  """Resolve a video and download its best audio stream.
+
+  Files are named after the parsed title, or go to <name> (relative to
+  directory, without extension) if given.
+  Returns (filename, ext, filepath) for the downloaded file or None on error.
+  If ext isn't 'mp3' the file still has to go through transcode(). With
+  stream=True the download is converted on the fly and filepath is the mp3.
+  With segments > 1 big files are downloaded over that many connections.
+  A MetadataCache as <cache> saves resolving videos seen recently again.
+  """
   if '.com' in url and 'www.youtube.com/watch?v=' not in url:
-    print('ERROR: Url does not point to youtube.')
-    return 'ERROR: Url does not point to youtube.'
+    log.error('Url does not point to youtube.')
+    return None
 
   # Can take 11 char video id or full link
   # Fails silently when using full url to non-youtube site
   try:
-    video = pafy.new(url)
+    meta = resolve(url, cache)
   except Exception as err:
     # invalid v_id
     # invalid full youtube url
     # unknown error
     tracker.handle_error(err)
-    return
+    return None
 
   # Generate file name & path.
   try:
-    audio = video.getbestaudio()
-    filename = parsetitle(video.title)
+    audio = meta.audio
+    filename = meta.label
     tracker.set_attribute('label', filename)
     ext = audio.extension
     download_dir = os.path.abspath(directory)
     if not os.path.isdir(download_dir):
       download_dir='.'
+    if name is not None:
+      filename = name
+      os.makedirs(os.path.dirname(os.path.join(download_dir, name)), exist_ok=True)
     filepath = download_dir+'/'+filename+'.'+ext
   except Exception as err:
     tracker.handle_error(err)
+    return None
+
+  # Download & convert in one go.
+  if stream and ext != 'mp3':
+    try:
+      tracker.update_stage('download')
+      mp3_filepath = download_dir+'/'+filename+'.mp3'
+      stream_convert(audio, mp3_filepath, tracker.download_prog)
+    except Exception as err:
+      _forget(url, cache)
+      tracker.handle_error(err)
+      return None
+    return filename, 'mp3', mp3_filepath
 
   # Download
   try:
     tracker.update_stage('download')
-    download(audio, filepath, tracker.download_prog)
+    download(audio, filepath, tracker.download_prog, segments)
   except Exception as err:
+    _forget(url, cache)
     tracker.handle_error(err)
+    return None
 
-  # Convert
-  if ext is not 'mp3':
-    try:
-      tracker.update_stage('convert')
-      mp3_filepath = download_dir+'/'+filename+'.mp3'
-      convert_file(filepath, mp3_filepath, tracker.convert_prog)
-    except Exception as err:
-      tracker.handle_error(err)
+  return filename, ext, filepath
+
+def transcode(filepath, tracker=None):
+  """Convert a downloaded file to mp3 and mark the job as done."""
+  try:
+    tracker.update_stage('convert')
+    mp3_filepath = os.path.splitext(filepath)[0]+'.mp3'
+    convert_file(filepath, mp3_filepath, tracker.convert_prog)
+  except Exception as err:
+    tracker.handle_error(err)
+    return None
 
   # Done
   tracker.update_stage('done')
+  return mp3_filepath
+
+def getaudio(url, directory=".", tracker=None, stream=False, name=None):
+  fetched = fetchaudio(url, directory, tracker, stream, name=name)
+  if fetched is None:
+    return None
+  filename, ext, filepath = fetched
+
+  # Convert
+  if ext != 'mp3':
+    if transcode(filepath, tracker) is None:
+      return None
+  else:
+    tracker.update_stage('done')
 
   return filename, ext
 
@@ -123,6 +273,7 @@ def getaudio(url, directory=".", tracker=None):
 ### Main ###
 ############
 if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
   url = "https://www.youtube.com/watch?v=3hlZQuAR7KI"
   getaudio(url)
   
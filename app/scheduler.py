@@ -0,0 +1,189 @@
+from collections import deque, OrderedDict
+from itertools import islice
+from threading import Condition, Thread
+
+
+class JobScheduler():
+  """Class used to run jobs on a fixed-size pool of worker threads.
+
+  Jobs are submitted with the (u_id, j_id) pair identifying them in
+  RuntimeData along with the arguments for the target function. They wait in
+  a per user FIFO queue until a worker is free and the limits allow it to run.
+
+  Limits:
+  max_active -- Max number of jobs running at once, across all users.
+  max_per_user -- Max number of jobs running at once for a single user.
+
+  Users with queued jobs are served round-robin. A user's weight (default 1)
+  is the number of jobs they get to start each time it's their turn, so one
+  user queuing 200 videos can't starve everyone else.
+
+  Every queued job has a sequence number, consecutive within its user's queue,
+  so looking up a job's position doesn't walk the queue.
+
+  Overall this is the structure:
+  queues = OrderedDict({
+    <u_id>: deque([(<j_id>, <args>), ...]),
+    ...
+  })
+  seqs = {<u_id>: {<j_id>: <seq>, ...}, ...}
+  heads = {<u_id>: <seq of the job at the front of the queue>, ...}
+
+  """
+
+  def __init__(self, target, workers=4, max_active=None, max_per_user=None, weights=None):
+    self.target = target
+    self.num_workers = workers
+    self.max_active = max_active or workers
+    self.max_per_user = max_per_user or self.max_active
+    self.weights = weights or {}
+    self.queues = OrderedDict()
+    self.seqs = {}
+    self.heads = {}
+    self.active = {}
+    self.num_active = 0
+    self.credits = {}
+    self.cond = Condition()
+    self.workers = []
+    self.running = False
+
+  def start(self):
+    with self.cond:
+      if self.running:
+        return False
+      self.running = True
+      for i in range(self.num_workers):
+        t = Thread(target=self._work, name='infinote-worker-{}'.format(i))
+        t.daemon = True
+        t.start()
+        self.workers.append(t)
+      return True
+
+  def stop(self, wait=True):
+    with self.cond:
+      self.running = False
+      self.cond.notify_all()
+      workers, self.workers = self.workers, []
+    if wait:
+      for t in workers:
+        t.join()
+
+  def submit(self, u_id, j_id, *args):
+    with self.cond:
+      jobs = self.queues.setdefault(u_id, deque())
+      self.seqs.setdefault(u_id, {})[j_id] = self.heads.setdefault(u_id, 0) + len(jobs)
+      jobs.append((j_id, args))
+      self.cond.notify()
+      return len(jobs)
+
+  def take(self, u_id, j_id):
+    """Remove a queued job and return its arguments, None if it isn't queued."""
+    with self.cond:
+      index = self._index(u_id, j_id)
+      if index is None:
+        return None
+      jobs, seqs = self.queues[u_id], self.seqs[u_id]
+      args = jobs[index][1]
+      del jobs[index]
+      del seqs[j_id]
+      if not jobs:
+        self._drop_user(u_id)
+        return args
+      # Close the gap from whichever end is nearer.
+      if index < len(jobs) // 2:
+        for item in islice(jobs, index):
+          seqs[item[0]] += 1
+        self.heads[u_id] += 1
+      else:
+        for item in islice(jobs, index, None):
+          seqs[item[0]] -= 1
+      return args
+
+  def cancel(self, u_id, j_id):
+    return self.take(u_id, j_id) is not None
+
+  def position(self, u_id, j_id):
+    """Return the 1-based position of a job in its user's queue, or None."""
+    with self.cond:
+      index = self._index(u_id, j_id)
+      return None if index is None else index + 1
+
+  def stats(self, u_id):
+    with self.cond:
+      return {
+        'active': self.active.get(u_id, 0),
+        'queued': len(self.queues.get(u_id, ()))
+      }
+
+  def _weight(self, u_id):
+    return max(1, self.weights.get(u_id, 1))
+
+  def _index(self, u_id, j_id):
+    """Return the 0-based index of a queued job, or None. Caller must hold self.cond."""
+    seq = self.seqs.get(u_id, {}).get(j_id, None)
+    return None if seq is None else seq - self.heads[u_id]
+
+  def _drop_user(self, u_id):
+    self.queues.pop(u_id, None)
+    self.seqs.pop(u_id, None)
+    self.heads.pop(u_id, None)
+    self.credits.pop(u_id, None)
+
+  def _pick(self):
+    """Pop the next job allowed to run, or None. Caller must hold self.cond."""
+    if self.num_active >= self.max_active:
+      return None
+    for i in range(len(self.queues)):
+      u_id, jobs = next(iter(self.queues.items()))
+      if self.active.get(u_id, 0) >= self.max_per_user:
+        # User is at their limit, give the next one a go.
+        self.queues.move_to_end(u_id)
+        continue
+      j_id, args = jobs.popleft()
+      del self.seqs[u_id][j_id]
+      self.heads[u_id] += 1
+      credits = self.credits.get(u_id, self._weight(u_id)) - 1
+      if not jobs:
+        self._drop_user(u_id)
+      elif credits <= 0:
+        # Turn is over, go to the back of the line.
+        self.credits.pop(u_id, None)
+        self.queues.move_to_end(u_id)
+      else:
+        self.credits[u_id] = credits
+      self.active[u_id] = self.active.get(u_id, 0) + 1
+      self.num_active += 1
+      return u_id, j_id, args
+    return None
+
+  def _next(self):
+    with self.cond:
+      while True:
+        if not self.running:
+          return None
+        item = self._pick()
+        if item is not None:
+          return item
+        self.cond.wait()
+
+  def _finished(self, u_id):
+    with self.cond:
+      self.num_active -= 1
+      self.active[u_id] -= 1
+      if not self.active[u_id]:
+        del self.active[u_id]
+      self.cond.notify_all()
+
+  def _work(self):
+    while True:
+      item = self._next()
+      if item is None:
+        return
+      u_id, j_id, args = item
+      try:
+        self.target(*args)
+      except Exception as e:
+        # Never let a bad job take down a worker.
+        print('Job {} for user {} failed: {}'.format(j_id, u_id, e))
+      finally:
+        self._finished(u_id)
@@ -0,0 +1,311 @@
+import os, json, heapq, time, logging
+from threading import RLock, Thread, Event
+
+log = logging.getLogger(__name__)
+
+
+class StorageManager():
+  """Class used to keep the output files in <directory> within a disk budget.
+
+  Every finished file is recorded with its size and the last time it was
+  downloaded. Once the recorded files add up to more than <max_bytes> the least
+  recently downloaded ones are deleted, and on_evict(filename, owners) is
+  called for each of them so the jobs pointing at it can be expired.
+
+  A heap ordered by last access finds the next file to evict in O(log n).
+  Touching a file pushes a new heap item instead of moving the old one, stale
+  items are recognized by their seq and skipped, and the heap is rebuilt once
+  it holds more than twice as many items as there are files.
+
+  With an <index_path> sizes and access times are saved there, at most every
+  <save_interval> seconds, so a restart reads one file instead of stat()ing
+  every file in directory. Whatever the index missed before a crash is
+  caught up with by a background sweep (see start()), which also deletes
+  intermediate files (.part downloads, sources a crash kept from being
+  converted) nobody touched for a while. Until then claim() records files it
+  doesn't know yet.
+
+  Overall this is the structure:
+  entries = {
+    <filename relative to directory>: {
+      'size': <bytes>,
+      'last_access': <timestamp>,
+      'seq': <seq of the heap item that is current>,
+      'owners': set([(<u_id>, <j_id>), ...])
+    },
+    ...
+  }
+  heap = [(<last_access>, <seq>, <filename>), ...]
+  index = {<filename>: [<size>, <last_access>], ...}
+
+  """
+
+  def __init__(self, directory, max_bytes=None, on_evict=None, index_path=None, save_interval=60):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.on_evict = on_evict
+    self.index_path = index_path
+    self.save_interval = save_interval
+    self.saved_at = 0.0
+    self.entries = {}
+    self.heap = []
+    self.seq = 0
+    self.total = 0
+    self.evicted = 0
+    self.swept = 0
+    self.lock = RLock()
+    self.wakeup = Event()
+    self.running = False
+    self.thread = None
+
+  def _push(self, filename, entry):
+    self.seq += 1
+    entry['seq'] = self.seq
+    heapq.heappush(self.heap, (entry['last_access'], self.seq, filename))
+    if len(self.heap) > 2 * len(self.entries) + 64:
+      self.heap = [(e['last_access'], e['seq'], name) for name, e in self.entries.items()]
+      heapq.heapify(self.heap)
+
+  def _record(self, filename, size, last_access):
+    entry = self.entries.get(filename, None)
+    if entry is None:
+      entry = self.entries[filename] = {'size': 0, 'last_access': last_access, 'seq': 0, 'owners': set()}
+    self.total += size - entry['size']
+    entry['size'] = size
+    entry['last_access'] = last_access
+    self._push(filename, entry)
+    return entry
+
+  def load(self):
+    """Read the index written by save(), False if there is none to read."""
+    if self.index_path is None:
+      return False
+    try:
+      with open(self.index_path) as f:
+        index = json.load(f)
+    except (OSError, ValueError):
+      return False
+    with self.lock:
+      for filename, (size, last_access) in index.items():
+        self._record(filename, size, last_access)
+      self.saved_at = time.time()
+    return True
+
+  def save(self):
+    if self.index_path is None:
+      return
+    with self.lock:
+      index = {name: [e['size'], e['last_access']] for name, e in self.entries.items()}
+      # Write to a temp file first so a crash never leaves a broken index.
+      tmp_path = self.index_path + '.tmp'
+      with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+      os.replace(tmp_path, self.index_path)
+      self.saved_at = time.time()
+
+  def _changed(self, force=False):
+    """Save the index if it wasn't for save_interval seconds. Caller must hold self.lock."""
+    if force or time.time() - self.saved_at >= self.save_interval:
+      try:
+        self.save()
+      except OSError as e:
+        log.warning('Failed to save the storage index: %s', e)
+
+  def scan(self, suffix='.mp3'):
+    """Record the finished files already in directory and its shards, used once at startup.
+
+    A file with several hard links (halfway through reshard.py) is only
+    recorded once.
+    """
+    with self.lock:
+      seen = set()
+      for root, dirs, names in os.walk(self.directory):
+        for name in names:
+          if not name.endswith(suffix):
+            continue
+          path = os.path.join(root, name)
+          try:
+            st = os.stat(path)
+          except OSError:
+            continue
+          if st.st_nlink > 1:
+            if (st.st_dev, st.st_ino) in seen:
+              continue
+            seen.add((st.st_dev, st.st_ino))
+          self._record(os.path.relpath(path, self.directory), st.st_size, max(st.st_atime, st.st_mtime))
+      self._changed(force=True)
+      return len(self.entries)
+
+  def sweep(self, max_age, suffix='.mp3'):
+    """Bring the index in line with directory and delete stale intermediate files.
+
+    Finished files the index doesn't know are recorded and entries whose file
+    is gone are dropped. Every other file not modified for max_age seconds is
+    left over from a download or conversion that never finished, and deleted.
+    Returns the number of files deleted.
+    """
+    now = time.time()
+    found = {}
+    seen = set()
+    removed = 0
+    for root, dirs, names in os.walk(self.directory):
+      for name in names:
+        path = os.path.join(root, name)
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        if name.endswith(suffix):
+          if st.st_nlink > 1:
+            if (st.st_dev, st.st_ino) in seen:
+              continue
+            seen.add((st.st_dev, st.st_ino))
+          found[os.path.relpath(path, self.directory)] = st
+        elif now - st.st_mtime >= max_age:
+          if self.discard(path):
+            removed += 1
+    with self.lock:
+      for filename, st in found.items():
+        if filename not in self.entries:
+          self._record(filename, st.st_size, max(st.st_atime, st.st_mtime))
+      for filename in [name for name in self.entries if name not in found]:
+        # May have been added since the walk went by.
+        if not os.path.isfile(os.path.join(self.directory, filename)):
+          self.total -= self.entries.pop(filename)['size']
+      self.swept += removed
+      evicted = self._evict()
+      self._changed(force=True)
+    self._notify(evicted)
+    return removed
+
+  def start(self, interval, max_age):
+    """Sweep in the background now and every interval seconds after."""
+    if self.running:
+      return False
+    self.running = True
+    self.wakeup.clear()
+    self.thread = Thread(target=self._work, args=(interval, max_age), name='infinote-storage')
+    self.thread.daemon = True
+    self.thread.start()
+    return True
+
+  def stop(self, wait=True):
+    self.running = False
+    self.wakeup.set()
+    if wait and self.thread is not None:
+      self.thread.join()
+
+  def _work(self, interval, max_age):
+    while self.running:
+      try:
+        self.sweep(max_age)
+      except Exception:
+        log.exception('Failed to sweep %s.', self.directory)
+      self.wakeup.wait(interval)
+
+  def rename(self, old, new):
+    """Follow a file that was moved, e.g. by reshard.py.
+
+    If new is recorded already both were names of the same file, old is
+    merged into it.
+    """
+    with self.lock:
+      entry = self.entries.pop(old, None)
+      if entry is None:
+        return False
+      current = self.entries.get(new, None)
+      if current is not None:
+        self.total -= entry['size']
+        current['owners'].update(entry['owners'])
+        self._changed()
+        return False
+      self.entries[new] = entry
+      self._push(new, entry)
+      self._changed()
+      return True
+
+  def claim(self, filename, owner):
+    """Remember that owner, a (u_id, j_id) pair, points at filename."""
+    with self.lock:
+      entry = self.entries.get(filename, None)
+      if entry is None:
+        # Finished since the index was last saved.
+        try:
+          st = os.stat(os.path.join(self.directory, filename))
+        except OSError:
+          return False
+        entry = self._record(filename, st.st_size, max(st.st_atime, st.st_mtime))
+      entry['owners'].add(owner)
+      return True
+
+  def add(self, filename, owners=()):
+    """Record a finished file as just accessed and evict files to make room for it."""
+    try:
+      size = os.path.getsize(os.path.join(self.directory, filename))
+    except OSError:
+      return []
+    with self.lock:
+      entry = self._record(filename, size, time.time())
+      entry['owners'].update(owners)
+      evicted = self._evict(keep=filename)
+      self._changed()
+    self._notify(evicted)
+    return [name for name, owners in evicted]
+
+  def touch(self, filename):
+    """Mark filename as just downloaded."""
+    with self.lock:
+      entry = self.entries.get(filename, None)
+      if entry is None:
+        return False
+      entry['last_access'] = time.time()
+      self._push(filename, entry)
+      self._changed()
+      return True
+
+  def discard(self, path):
+    """Delete an intermediate file (e.g. the source of a conversion) right away."""
+    try:
+      os.remove(path)
+      return True
+    except OSError:
+      return False
+
+  def _evict(self, keep=None):
+    """Delete least recently accessed files until within budget. Caller must hold self.lock."""
+    evicted = []
+    skipped = []
+    while self.max_bytes is not None and self.total > self.max_bytes and self.heap:
+      item = heapq.heappop(self.heap)
+      last_access, seq, filename = item
+      entry = self.entries.get(filename, None)
+      if entry is None or entry['seq'] != seq:
+        continue # Stale.
+      if filename == keep:
+        skipped.append(item)
+        continue
+      del self.entries[filename]
+      self.total -= entry['size']
+      self.evicted += 1
+      try:
+        os.remove(os.path.join(self.directory, filename))
+      except OSError as e:
+        log.warning('Failed to delete %s: %s', filename, e)
+      evicted.append((filename, entry['owners']))
+    for item in skipped:
+      heapq.heappush(self.heap, item)
+    return evicted
+
+  def _notify(self, evicted):
+    if self.on_evict is None:
+      return
+    for filename, owners in evicted:
+      try:
+        self.on_evict(filename, owners)
+      except Exception:
+        log.exception('Failed to expire the jobs of %s.', filename)
+
+  def stats(self):
+    with self.lock:
+      return {'files': len(self.entries), 'bytes': self.total, 'max_bytes': self.max_bytes, 'evicted': self.evicted,
+          'swept': self.swept}
@@ -0,0 +1,135 @@
+import re
+from functools import partial
+
+# Bracketed text is dropped if it contains any letter of these words. The old
+# parsetitle() regex joined them into a character class ('|' included), that is
+# what every label so far was built with, so that's what is matched here too.
+bracket_keywords = ('monstercat', 'release', 'official', 'music', 'video', 'audio')
+keyword_char_re = re.compile('[' + re.escape('|'.join(bracket_keywords)) + ']', re.I)
+opener_re = re.compile(r'[\[\(]')
+leading_tag_re = re.compile(r'\[.*\]\s*')
+camel_case_re = re.compile(r'[A-Z][^A-Z\s]*')
+
+
+
+#############
+### Rules ###
+#############
+# Every rule is a function from str to str. None of them backtrack: the regexes
+# left are anchored or plain character classes, and brackets are matched by
+# scanning, so normalizing is linear in the length of the text.
+def _drop_leading_tag(text):
+  """Drop anything in brackets at the very beginning."""
+  match = leading_tag_re.match(text)
+  return text[match.end():] if match else text
+
+def _drop_keyword_brackets(text):
+  r"""Drop bracketed text with a keyword letter in it, plus one space before it.
+
+  Gives the same result as re.sub(r'\s{0,1}[\[\(].*[<keywords>].*[\]\)]', '',
+  text, flags=re.I). That regex retries every bracket of a line and backtracks
+  over the rest of it each time. Only the first bracket of a line can ever
+  match though, and when it does it runs to the line's last closing bracket,
+  so one look at each line is enough.
+  """
+  pieces = []
+  keep = 0 # End of the last match, everything from here on is kept so far.
+  pos = 0
+  while True:
+    match = opener_re.search(text, pos)
+    if match is None:
+      break
+    opener = match.start()
+    eol = text.find('\n', opener)
+    if eol == -1:
+      eol = len(text)
+    closer = max(text.rfind(']', opener + 1, eol), text.rfind(')', opener + 1, eol))
+    if closer == -1 or not keyword_char_re.search(text, opener + 1, closer):
+      # No other bracket on this line can match either.
+      pos = eol + 1
+      continue
+    start = opener - 1 if opener > keep and text[opener - 1].isspace() else opener
+    pieces.append(text[keep:start])
+    keep = pos = closer + 1
+  if not pieces:
+    return text
+  pieces.append(text[keep:])
+  return ''.join(pieces)
+
+def _split_camel_case(text):
+  if text.startswith('UKF'):
+    return text
+  return ' '.join(camel_case_re.findall(text))
+
+# Applied in order to every dash separated segment of a title.
+title_rules = (
+  ('leading tag', _drop_leading_tag),
+  ('keyword brackets', _drop_keyword_brackets),
+  ('spaces', str.strip),
+)
+
+# Applied in order to a channel name.
+channel_rules = (
+  ('vevo suffix', partial(re.compile('vevo$', re.I).sub, '')),
+  ('tv suffix', partial(re.compile('tv$', re.I).sub, '')),
+  ('camel case', _split_camel_case),
+)
+
+
+
+##################
+### Normalizer ###
+##################
+class Normalizer():
+  """Class used to clean up text with a table of rules.
+
+  If a separator is given the text is split on it, every segment runs through
+  all the rules in order, empty segments are dropped and the rest is joined
+  back together with joiner. Without one the rules apply to the whole text.
+
+  Overall this is the structure:
+  rules = ((<name>, <function(str) -> str>), ...)
+
+  """
+
+  def __init__(self, rules, separator=None, joiner=None):
+    self.rules = tuple(rules)
+    self.separator = separator
+    self.joiner = joiner if joiner is not None else separator
+    self._funcs = tuple(func for name, func in self.rules)
+
+  def _apply(self, text):
+    for func in self._funcs:
+      text = func(text)
+    return text
+
+  def normalize(self, text):
+    if self.separator is None:
+      return self._apply(text)
+    apply = self._apply
+    return self.joiner.join(filter(None, [apply(s) for s in text.split(self.separator)]))
+
+  def normalize_many(self, texts):
+    """Normalize a batch of texts, returns a list in the same order.
+
+    Titles repeat a lot (the same video queued by many users, reuploads), so
+    each distinct text is only normalized once per batch.
+    """
+    done = {}
+    normalize = self.normalize
+    results = []
+    for text in texts:
+      result = done.get(text, None)
+      if result is None:
+        result = done[text] = normalize(text)
+      results.append(result)
+    return results
+
+
+title_normalizer = Normalizer(title_rules, separator='-', joiner=' - ')
+channel_normalizer = Normalizer(channel_rules)
+
+normalize_title = title_normalizer.normalize
+normalize_titles = title_normalizer.normalize_many
+normalize_channel = channel_normalizer.normalize
+normalize_channels = channel_normalizer.normalize_many
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Compare job row throughput with the default and the tuned sqlite profile.
+
+Writer threads insert and complete job rows one transaction at a time while
+reader threads keep listing jobs, roughly what request and worker threads do.
+
+usage: db_benchmark.py [threads] [transactions per thread]
+"""
+import os, sys, time, tempfile, shutil, threading
+from datetime import datetime
+from sqlalchemy import create_engine, event, MetaData, Table, Column, Integer, String, DateTime
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool, QueuePool
+from app.config import infinote_app, apply_sqlite_pragmas
+
+metadata = MetaData()
+jobs = Table('job', metadata,
+  Column('id', Integer, primary_key=True),
+  Column('user_id', Integer),
+  Column('v_id', String(11)),
+  Column('ts_start', DateTime),
+  Column('ts_complete', DateTime)
+)
+
+
+def default_engine(path, threads):
+  # What the app used before: a new connection per checkout, stock settings.
+  return create_engine('sqlite:///' + path, poolclass=NullPool)
+
+def tuned_engine(path, threads):
+  engine = create_engine('sqlite:///' + path, poolclass=QueuePool, pool_size=threads,
+      connect_args={'check_same_thread': False})
+  pragmas = infinote_app.config['SQLITE_PRAGMAS']
+  event.listen(engine, 'connect', lambda conn, record: apply_sqlite_pragmas(conn, pragmas))
+  return engine
+
+
+def writer(engine, u_id, count, stats):
+  for i in range(count):
+    start = time.time()
+    try:
+      with engine.begin() as conn:
+        res = conn.execute(jobs.insert().values(user_id=u_id, v_id='{:011d}'.format(i), ts_start=datetime.utcnow()))
+        conn.execute(jobs.update().where(jobs.c.id == res.inserted_primary_key[0]).values(ts_complete=datetime.utcnow()))
+    except OperationalError:
+      stats['locked'] += 1
+      continue
+    stats['latencies'].append(time.time() - start)
+
+def reader(engine, u_id, done, stats):
+  while not done.is_set():
+    try:
+      with engine.connect() as conn:
+        conn.execute(jobs.select().where(jobs.c.user_id == u_id)).fetchall()
+      stats['reads'] += 1
+    except OperationalError:
+      stats['locked'] += 1
+
+def run(name, make_engine, threads, count):
+  directory = tempfile.mkdtemp()
+  try:
+    engine = make_engine(os.path.join(directory, 'bench.db'), threads * 2)
+    metadata.create_all(engine)
+    stats = {'latencies': [], 'reads': 0, 'locked': 0}
+    done = threading.Event()
+    writers = [threading.Thread(target=writer, args=(engine, u_id, count, stats)) for u_id in range(threads)]
+    readers = [threading.Thread(target=reader, args=(engine, u_id, done, stats)) for u_id in range(threads)]
+    start = time.time()
+    for t in writers + readers:
+      t.start()
+    for t in writers:
+      t.join()
+    elapsed = time.time() - start
+    done.set()
+    for t in readers:
+      t.join()
+    engine.dispose()
+  finally:
+    shutil.rmtree(directory)
+
+  latencies = sorted(stats['latencies'])
+  p99 = latencies[int(len(latencies) * 0.99)] if latencies else float('nan')
+  print('{:8} {:8.1f} tx/s {:8.1f} reads/s   p99 {:7.1f}ms   locked {}'.format(
+      name, len(latencies) / elapsed, stats['reads'] / elapsed, p99 * 1000, stats['locked']))
+
+
+if __name__ == '__main__':
+  threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+  count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+  print('{} writer and {} reader threads, {} transactions each'.format(threads, threads, count))
+  run('default', default_engine, threads, count)
+  run('tuned', tuned_engine, threads, count)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""Move the flat output files in DOWNLOAD_DIR into the sharded layout.
+
+Which video a flat file belongs to is read from the cache index, files no
+entry points at are left where they are. The index itself isn't written, the
+app finds moved files through StorageLayout.locate() and updates it then.
+
+Every file is linked into its shard before the flat name is removed, so it is
+reachable under one name or the other at all times and this can run while the
+app is serving. A file several videos share (their titles collided) is linked
+into the shard of each of them.
+
+usage: reshard.py [--dry-run]
+"""
+import os, sys, json, shutil
+from contextlib import suppress
+from app.config import infinote_app
+from app.layout import StorageLayout
+
+
+def flat_files(directory, index_path):
+  """Return {<flat filename>: [(<v_id>, <fmt>), ...]} for the files in the cache index."""
+  try:
+    with open(index_path) as f:
+      entries = json.load(f)
+  except (OSError, ValueError):
+    entries = {}
+  files = {}
+  for key, entry in entries.items():
+    filename = entry['filename']
+    if os.path.dirname(filename) or not os.path.isfile(os.path.join(directory, filename)):
+      continue # Already sharded or gone.
+    files.setdefault(filename, []).append((entry['v_id'], key.rsplit('.', 1)[1]))
+  return files
+
+def _link(src, dst):
+  """Give src the name dst, all at once: the app may serve dst the moment it shows up."""
+  os.makedirs(os.path.dirname(dst), exist_ok=True)
+  if os.path.isfile(dst) and os.path.getsize(dst) == os.path.getsize(src):
+    return # Done by an earlier run.
+  # Anything else at dst is what an interrupted copy left, replaced below.
+  tmp = dst + '.part'
+  with suppress(FileNotFoundError):
+    os.remove(tmp)
+  try:
+    os.link(src, tmp)
+  except OSError:
+    # No hard links on this filesystem.
+    shutil.copy2(src, tmp)
+  os.replace(tmp, dst)
+
+def reshard(layout, files, dry_run=False):
+  """Link every file into its videos' shards, then remove the flat name."""
+  stats = {'moved': 0, 'links': 0, 'failed': 0}
+  for filename, videos in sorted(files.items()):
+    src = os.path.join(layout.directory, filename)
+    try:
+      for v_id, fmt in videos:
+        dst = os.path.join(layout.directory, layout.shard_path(v_id, fmt))
+        if not dry_run:
+          _link(src, dst)
+        stats['links'] += 1
+      if not dry_run:
+        os.remove(src)
+      stats['moved'] += 1
+    except OSError as e:
+      print('Failed to move {}: {}'.format(filename, e))
+      stats['failed'] += 1
+  return stats
+
+
+if __name__ == '__main__':
+  dry_run = '--dry-run' in sys.argv[1:]
+  config = infinote_app.config
+  layout = StorageLayout(infinote_app.root_path+config['DOWNLOAD_DIR'], sharded=True,
+      depth=config['STORAGE_SHARD_DEPTH'], width=config['STORAGE_SHARD_WIDTH'])
+  files = flat_files(layout.directory, config['CACHE_INDEX'])
+  print('{} flat files to move{}'.format(len(files), ' (dry run)' if dry_run else ''))
+  stats = reshard(layout, files, dry_run)
+  print('moved {moved} files into {links} shard paths, {failed} failed'.format(**stats))
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
+from app.config import infinote_app, require_secret_key
+require_secret_key()
 from app import infinote
-from app.config import infinote_app
 
-infinote_app.run(host=infinote_app.config['HOST'], port=infinote_app.config['PORT'], debug=True)
+infinote_app.run(host=infinote_app.config['HOST'], port=infinote_app.config['PORT'], debug=True, threaded=True)
@@ -5,7 +5,40 @@ loader = TestLoader()
 testRunner = TextTestRunner()
 modelsTestSuite = loader.discover('.', pattern='test_models.py')
 APITestSuite = loader.discover('.', pattern='test_api_server.py')
+schedulerTestSuite = loader.discover('.', pattern='test_scheduler.py')
+cacheTestSuite = loader.discover('.', pattern='test_cache.py')
+ripperTestSuite = loader.discover('.', pattern='test_ripper.py')
+titlesTestSuite = loader.discover('.', pattern='test_titles.py')
+fetchTestSuite = loader.discover('.', pattern='test_fetch.py')
+dbwriterTestSuite = loader.discover('.', pattern='test_dbwriter.py')
+journalTestSuite = loader.discover('.', pattern='test_journal.py')
+playlistTestSuite = loader.discover('.', pattern='test_playlist.py')
+archiveTestSuite = loader.discover('.', pattern='test_archive.py')
+storageTestSuite = loader.discover('.', pattern='test_storage.py')
+layoutTestSuite = loader.discover('.', pattern='test_layout.py')
 print('\n\tRUNNING MODEL TEST CASES\n')
 testRunner.run(modelsTestSuite)
+print('\n\tRUNNING SCHEDULER TEST CASES\n')
+testRunner.run(schedulerTestSuite)
+print('\n\tRUNNING CACHE TEST CASES\n')
+testRunner.run(cacheTestSuite)
+print('\n\tRUNNING RIPPER TEST CASES\n')
+testRunner.run(ripperTestSuite)
+print('\n\tRUNNING TITLE TEST CASES\n')
+testRunner.run(titlesTestSuite)
+print('\n\tRUNNING FETCH TEST CASES\n')
+testRunner.run(fetchTestSuite)
+print('\n\tRUNNING DB WRITER TEST CASES\n')
+testRunner.run(dbwriterTestSuite)
+print('\n\tRUNNING JOURNAL TEST CASES\n')
+testRunner.run(journalTestSuite)
+print('\n\tRUNNING PLAYLIST TEST CASES\n')
+testRunner.run(playlistTestSuite)
+print('\n\tRUNNING ARCHIVE TEST CASES\n')
+testRunner.run(archiveTestSuite)
+print('\n\tRUNNING STORAGE TEST CASES\n')
+testRunner.run(storageTestSuite)
+print('\n\tRUNNING LAYOUT TEST CASES\n')
+testRunner.run(layoutTestSuite)
 print('\n\tRUNNING API TEST CASES\n')
 testRunner.run(APITestSuite)
@@ -1,17 +1,23 @@
 #!/usr/bin/env python
 
-import os, json, unittest, base64
+import io, os, json, time, shutil, tempfile, unittest, zipfile, base64
 from datetime import datetime
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch, ANY
 from flask import Flask, jsonify
 from flask.ext.testing import TestCase
 from contextlib import suppress
 from werkzeug.exceptions import NotFound, MethodNotAllowed
 from werkzeug.routing import RequestRedirect
-from app import infinote
+from app import infinote, config
 from app.config import basedir, infinote_app, db
-from app.infinote import ProcessException
-from app.models import User, Job, RuntimeData, RuntimeDataException
+from app.infinote import ProcessException, JobTracker
+from app.cache import MetadataCache
+from app.storage import StorageManager
+from app.layout import StorageLayout
+from app.dbwriter import DBWriter
+from app.scheduler import JobScheduler
+from app.models import User, Job, RuntimeData, RuntimeDataException, generate_auth_token
+from test_playlist import FakePlaylistProvider
 
 
 class HelperTestCases(unittest.TestCase):
@@ -56,6 +62,15 @@ class HelperTestCases(unittest.TestCase):
     self.assertEqual(expected, res)
     infinote.runtime_data.getJob.assert_called_once_with(uid, jid)
 
+  def test_require_secret_key(self):
+    # case 1 - no key, no server
+    with patch.object(config, 'secret_key', None):
+      self.assertRaises(SystemExit, config.require_secret_key)
+
+    # case 2 - key set
+    with patch.object(config, 'secret_key', 'k' * 64):
+      config.require_secret_key()
+
   def test_extract_v_id(self):
     # case 1
     expected = test_data = '11111111111'
@@ -107,6 +122,229 @@ class HelperTestCases(unittest.TestCase):
     infinote.runtime_data.createJob.reset_mock()
     infinote._extract_v_id.reset_mock()
 
+  def test_coalesce_jobs(self):
+    v_id = '11111111111'
+    rtd = RuntimeData()
+    j_id, ts = rtd.createJob(1, v_id)
+    rtd.createJob(2, v_id)
+    rtd.createJob(3, v_id)
+    primary = JobTracker(1, j_id)
+    follower_1 = JobTracker(2, j_id)
+    follower_2 = JobTracker(3, j_id)
+    mock_scheduler = MagicMock()
+    mock_scheduler.cancel = MagicMock(return_value=True)
+
+    with patch.object(infinote, 'runtime_data', rtd), \
+         patch.object(infinote, 'scheduler', mock_scheduler), \
+         patch.object(infinote, 'db_writer') as mock_writer, \
+         patch.dict(infinote.inflight, clear=True):
+      # case 1 - first job is queued
+      self.assertTrue(infinote._submit_job(v_id, primary))
+      mock_scheduler.submit.assert_called_once_with(1, j_id, v_id, infinote.download_dir, primary)
+      mock_scheduler.submit.reset_mock()
+
+      # case 2 - second job follows the first, and catches up on its progress
+      primary.set_attribute('label', 'Song')
+      primary.update_stage('download')
+      self.assertFalse(infinote._submit_job(v_id, follower_1))
+      mock_scheduler.submit.assert_not_called()
+      self.assertEqual('Song', rtd.get_attribute(2, j_id, 'label'))
+      self.assertEqual('download', rtd.get_attribute(2, j_id, 'stage'))
+
+      # case 3 - later updates are mirrored
+      self.assertFalse(infinote._submit_job(v_id, follower_2))
+      primary.download_prog(100, 50, 0.5, 10, 5)
+      self.assertEqual(0.5, rtd.get_attribute(2, j_id, 'prog'))
+      self.assertEqual(0.5, rtd.get_attribute(3, j_id, 'prog'))
+
+      # case 4 - cancelling the first job hands the video over to a follower
+      self.assertTrue(infinote._cancel_job(1, j_id))
+      mock_scheduler.submit.assert_called_once_with(2, j_id, v_id, infinote.download_dir, follower_1)
+      self.assertIs(follower_1, infinote.inflight[v_id])
+      self.assertEqual([follower_2], follower_1.followers)
+
+      # case 5 - errors are passed on to followers
+      follower_1.handle_error(Exception('mock_exception'))
+      self.assertIsNone(rtd.getJob(3, j_id))
+      mock_writer.delete.assert_any_call((2, j_id))
+      mock_writer.delete.assert_any_call((3, j_id))
+
+  def test_cancel_transcoding(self):
+    v_id = '11111111111'
+    rtd = RuntimeData()
+    j_id, ts = rtd.createJob(1, v_id)
+    rtd.createJob(2, v_id)
+    primary = JobTracker(1, j_id)
+    follower = JobTracker(2, j_id)
+    mock_scheduler = MagicMock()
+    mock_scheduler.cancel = MagicMock(return_value=False)
+    mock_storage = MagicMock()
+    # Not started, so submitted jobs stay queued.
+    transcoder = JobScheduler(MagicMock())
+
+    with patch.object(infinote, 'runtime_data', rtd), \
+         patch.object(infinote, 'scheduler', mock_scheduler), \
+         patch.object(infinote, 'transcoder', transcoder), \
+         patch.object(infinote, 'storage', mock_storage), \
+         patch.dict(infinote.inflight, clear=True):
+      infinote.inflight[v_id] = primary
+      primary.attach(follower)
+      transcoder.submit(1, j_id, v_id, '/tmp/source.webm', primary)
+
+      # case 1 - waiting for conversion, the follower takes over the download
+      self.assertTrue(infinote._cancel_job(1, j_id))
+      self.assertIsNone(transcoder.position(1, j_id))
+      self.assertEqual(1, transcoder.position(2, j_id))
+      self.assertIs(follower, infinote.inflight[v_id])
+      mock_scheduler.submit.assert_not_called()
+      mock_storage.discard.assert_not_called()
+
+      # case 2 - no one left who wants it, the download is thrown away
+      self.assertTrue(infinote._cancel_job(2, j_id))
+      self.assertEqual({}, transcoder.queues)
+      self.assertNotIn(v_id, infinote.inflight)
+      mock_storage.discard.assert_called_once_with('/tmp/source.webm')
+
+      # case 3 - not queued anywhere
+      self.assertFalse(infinote._cancel_job(2, j_id))
+
+  def test_lead_job_deleted(self):
+    v_id = '11111111111'
+    rtd = RuntimeData()
+    j_id, ts = rtd.createJob(1, v_id)
+    rtd.createJob(2, v_id)
+    primary = JobTracker(1, j_id, v_id)
+    follower = JobTracker(2, j_id, v_id)
+    mock_cache = MagicMock()
+    mock_storage = MagicMock()
+    mock_layout = MagicMock()
+    mock_layout.locate = MagicMock(return_value='Song.mp3')
+
+    with patch.object(infinote, 'runtime_data', rtd), \
+         patch.object(infinote, 'output_cache', mock_cache), \
+         patch.object(infinote, 'storage', mock_storage), \
+         patch.object(infinote, 'layout', mock_layout), \
+         patch.object(infinote, 'db_writer', MagicMock()), \
+         patch.object(infinote, 'url_for', MagicMock(return_value='http://mock_job_link')):
+      primary.attach(follower)
+      primary.set_attribute('label', 'Song')
+      primary.update_stage('download')
+      # The lead's owner deletes it while it is still ripping.
+      rtd.delJob(1, j_id)
+      primary.update_stage('done')
+
+    self.assertEqual('done', rtd.get_attribute(2, j_id, 'stage'))
+    mock_layout.locate.assert_called_once_with(v_id, 'Song')
+    mock_cache.put.assert_called_once_with(v_id, 'Song', 'Song.mp3')
+    mock_storage.add.assert_called_once_with('Song.mp3', [(1, j_id), (2, j_id)])
+
+  def test_resume_jobs(self):
+    rtd = RuntimeData()
+    j_id_1, ts = rtd.createJob(1, '11111111111')
+    j_id_2, ts = rtd.createJob(1, '22222222222')
+    j_id_3, ts = rtd.createJob(2, '33333333333')
+    j_id_4, ts = rtd.createJob(2, '44444444444')
+    rtd.set_attributes(1, j_id_1, {'stage': 'download', 'prog': 0.5})
+    rtd.set_attributes(1, j_id_2, {'stage': 'done', 'prog': 1.0, 'label': 'Song'})
+    rtd.set_attributes(2, j_id_4, {'stage': 'expired', 'prog': 1.0})
+    mock_scheduler = MagicMock()
+    mock_storage = MagicMock()
+    mock_cache = MagicMock()
+    mock_cache.get = MagicMock(return_value=None)
+
+    with patch.object(infinote, 'runtime_data', rtd), \
+         patch.object(infinote, 'scheduler', mock_scheduler), \
+         patch.object(infinote, 'output_cache', mock_cache), \
+         patch.object(infinote, 'storage', mock_storage), \
+         patch.object(infinote, 'layout', StorageLayout('.')), \
+         patch.object(infinote, 'db_writer') as mock_writer, \
+         patch.dict(infinote.inflight, clear=True):
+      # Unfinished jobs start over, done and expired ones are left alone.
+      self.assertEqual(2, infinote._resume_jobs())
+      self.assertEqual('init', rtd.get_attribute(1, j_id_1, 'stage'))
+      self.assertEqual(0.0, rtd.get_attribute(1, j_id_1, 'prog'))
+      self.assertEqual('done', rtd.get_attribute(1, j_id_2, 'stage'))
+      submitted = sorted(c[0][:3] for c in mock_scheduler.submit.call_args_list)
+      self.assertEqual([(1, j_id_1, '11111111111'), (2, j_id_3, '33333333333')], submitted)
+      self.assertEqual('expired', rtd.get_attribute(2, j_id_4, 'stage'))
+      # Files of done jobs can be expired later on.
+      mock_storage.claim.assert_called_once_with('Song.mp3', (1, j_id_2))
+      # Their rows are looked up again, so they can be completed.
+      mock_writer.relink.assert_any_call((1, j_id_1), {'user_id': 1, 'v_id': '11111111111', 'ts_complete': None})
+      self.assertEqual(2, mock_writer.relink.call_count)
+
+  def test_throttled_progress(self):
+    rtd = RuntimeData()
+    j_id, ts = rtd.createJob(1, '11111111111')
+    tracker = JobTracker(1, j_id)
+    rtd.set_attributes = MagicMock(wraps=rtd.set_attributes)
+
+    with patch.object(infinote, 'runtime_data', rtd):
+      # case 1 - first update is written
+      self.assertTrue(tracker.download_prog(100, 10, 0.1, 1, 1))
+      self.assertEqual(1, rtd.set_attributes.call_count)
+
+      # case 2 - updates right after are dropped
+      for recvd in range(11, 100):
+        self.assertFalse(tracker.download_prog(100, recvd, recvd/100, 1, 1))
+      self.assertEqual(1, rtd.set_attributes.call_count)
+      self.assertEqual(0.1, rtd.get_attribute(1, j_id, 'prog'))
+
+      # case 3 - finishing is always written
+      self.assertTrue(tracker.download_prog(100, 100, 1.0, 1, 1))
+      self.assertEqual(1.0, rtd.get_attribute(1, j_id, 'prog'))
+
+      # case 4 - enough time went by, but progress didn't move enough
+      tracker.update_stage('convert')
+      tracker.convert_prog(0.5)
+      tracker.last_prog_ts -= tracker.prog_interval
+      self.assertFalse(tracker.convert_prog(0.505))
+
+      # case 5 - enough time went by, and progress moved
+      self.assertTrue(tracker.convert_prog(0.6))
+      self.assertEqual(0.6, rtd.get_attribute(1, j_id, 'prog'))
+
+  def test_process_job_stages(self):
+    v_id = '11111111111'
+    tracker = MagicMock()
+    tracker.u_id = 1
+    tracker.j_id = 5
+    mock_ripper = MagicMock()
+    mock_transcoder = MagicMock()
+    mock_cache = MagicMock()
+    mock_cache.get = MagicMock(return_value=None)
+
+    with patch.object(infinote, 'ripper', mock_ripper), \
+         patch.object(infinote, 'transcoder', mock_transcoder), \
+         patch.object(infinote, 'output_cache', mock_cache), \
+         patch.dict(infinote.inflight, clear=True):
+      # case 1 - download failed
+      infinote.inflight[v_id] = tracker
+      mock_ripper.fetchaudio = MagicMock(return_value=None)
+      infinote._process_job(v_id, '.', tracker)
+      mock_transcoder.submit.assert_not_called()
+      self.assertNotIn(v_id, infinote.inflight)
+
+      # case 2 - already an mp3, no conversion needed
+      infinote.inflight[v_id] = tracker
+      mock_ripper.fetchaudio = MagicMock(return_value=('Song', 'mp3', './Song.mp3'))
+      infinote._process_job(v_id, '.', tracker)
+      mock_transcoder.submit.assert_not_called()
+      tracker.update_stage.assert_called_once_with('done')
+      self.assertNotIn(v_id, infinote.inflight)
+
+      # case 3 - download is queued for the transcoding pool
+      infinote.inflight[v_id] = tracker
+      mock_ripper.fetchaudio = MagicMock(return_value=('Song', 'webm', './Song.webm'))
+      infinote._process_job(v_id, '.', tracker)
+      mock_transcoder.submit.assert_called_once_with(1, 5, v_id, './Song.webm', tracker)
+      self.assertIs(tracker, infinote.inflight[v_id])
+
+      # case 4 - job is done in flight once converted
+      infinote._transcode_job(v_id, './Song.webm', tracker)
+      mock_ripper.transcode.assert_called_once_with('./Song.webm', tracker)
+      self.assertNotIn(v_id, infinote.inflight)
+
 
 class APITestCases(TestCase):
 
@@ -124,6 +362,7 @@ class APITestCases(TestCase):
 
   def setUp(self):
     self.test_client = infinote_app.test_client()
+    infinote.credential_cache.clear()
     db.create_all()
 
   def tearDown(self):
@@ -372,6 +611,81 @@ class APITestCases(TestCase):
     self.assertEqual({'Result':'Auth Success! Got User Dan'}, self._get_json(resp))
     self.assertEqual('application/json', resp.mimetype)
 
+  def test_auth_cache(self):
+    endpoint = '/infinote/api/v1.0/auth_test'
+    u, password = self._gen_user('Dan')
+    header = self._gen_auth_header(u.username, password)
+
+    with patch.object(User, 'verify_password', autospec=True, side_effect=User.verify_password) as mock_verify:
+      # case 1 - password is only checked once
+      for i in range(3):
+        resp = self.test_client.get(endpoint, headers=header)
+        self.assert200(resp)
+        self.assertEqual({'Result':'Auth Success! Got User Dan'}, self._get_json(resp))
+      self.assertEqual(1, mock_verify.call_count)
+
+      # case 2 - wrong passwords are never cached
+      bad_header = self._gen_auth_header(u.username, 'incorrect')
+      for i in range(2):
+        self.assert401(self.test_client.get(endpoint, headers=bad_header))
+      self.assertEqual(3, mock_verify.call_count)
+
+    # case 3 - changing the password invalidates the cache
+    u = User.query.filter_by(username = 'Dan').first()
+    u.hash_password('new_password')
+    db.session.commit()
+    self.assert401(self.test_client.get(endpoint, headers=header))
+    header = self._gen_auth_header(u.username, 'new_password')
+    self.assert200(self.test_client.get(endpoint, headers=header))
+
+    # case 4 - deleting the user invalidates the cache
+    db.session.delete(u)
+    db.session.commit()
+    self.assert401(self.test_client.get(endpoint, headers=header))
+
+  def test_token_page(self):
+    endpoint = '/infinote/api/v1.0/token'
+    u, password = self._gen_user('Dan')
+    header = self._gen_auth_header(u.username, password)
+
+    # case 1 - no credentials
+    self.assert401(self.test_client.get(endpoint))
+
+    # case 2 - happy path
+    resp = self.test_client.get(endpoint, headers=header)
+    self.assert200(resp)
+    res = self._get_json(resp)
+    self.assertEqual(infinote_app.config['TOKEN_EXPIRATION'], res['duration'])
+    token_header = {'Authorization': 'Bearer ' + res['token']}
+
+    # case 3 - a token can't be used to get another token
+    self.assert401(self.test_client.get(endpoint, headers=token_header))
+
+  def test_token_auth(self):
+    endpoint = '/infinote/api/v1.0/auth_test'
+    u, password = self._gen_user('Dan')
+    token = generate_auth_token(u)
+
+    # case 1 - token is checked without touching the db or password hash
+    with patch.object(User, 'verify_password') as mock_verify, \
+         patch.object(infinote, 'User') as mock_user:
+      resp = self.test_client.get(endpoint, headers={'Authorization': 'Bearer ' + token})
+      self.assert200(resp)
+      self.assertEqual({'Result':'Auth Success! Got User Dan'}, self._get_json(resp))
+      mock_verify.assert_not_called()
+      self.assertEqual([], mock_user.mock_calls)
+
+    # case 2 - tampered token
+    resp = self.test_client.get(endpoint, headers={'Authorization': 'Bearer ' + token[:-2] + 'xx'})
+    self.assert401(resp)
+
+    # case 3 - expired token
+    token = generate_auth_token(u, expiration=-1)
+    self.assert401(self.test_client.get(endpoint, headers={'Authorization': 'Bearer ' + token}))
+
+    # case 4 - basic auth still works
+    self.assert200(self.test_client.get(endpoint, headers=self._gen_auth_header(u.username, password)))
+
   def _compare_jobs_response(self, expected, actual):
     if not isinstance(expected, dict):
       self.fail('Expected jobs response is not a dict.')
@@ -517,6 +831,432 @@ class APITestCases(TestCase):
     self.assertEqual('application/json', resp.mimetype)
 #    self.assertEqual(expected_resp, self._get_json(resp))
 
+  def test_queue_page(self):
+    endpoint = '/infinote/api/v1.0/queue'
+    supported_methods = frozenset(('GET', 'HEAD'))
+    u, password = self._gen_user('tom')
+
+    # Validate only specified methods are supported.
+    self._verify_methods(supported_methods, endpoint)
+
+    # Ensure this endpoint is protected.
+    self._verify_credential_check(endpoint, 'GET', u.username, password)
+
+    # case 1 - nothing queued
+    header = self._gen_auth_header(u.username, password)
+    resp = self.test_client.get(endpoint, headers=header)
+    self.assert200(resp)
+    self.assertEqual('application/json', resp.mimetype)
+    expected = {'active': 0, 'queued': 0, 'max_active': infinote.scheduler.max_per_user}
+    self.assertEqual({'queue': expected}, self._get_json(resp))
+
+  def test_jobs_bulk_page(self):
+    endpoint = '/infinote/api/v1.0/jobs/bulk'
+    supported_methods = frozenset(('POST',))
+    u, password = self._gen_user('tom')
+    self._tested_endpoint(endpoint)
+
+    # Validate only specified methods are supported.
+    self._verify_methods(supported_methods, endpoint)
+
+    # Ensure this endpoint is protected.
+    resp = self.test_client.post(endpoint, data=json.dumps({'v_ids': []}))
+    self.assert401(resp)
+    resp = self.test_client.post(endpoint, headers=self._gen_auth_header(u.username, 'incorrect'))
+    self.assert401(resp)
+
+    header = self._gen_auth_header(u.username, password)
+    header['Content-Type'] = 'application/json'
+    rtd = RuntimeData()
+    rtd.createJobs = MagicMock(wraps=rtd.createJobs)
+    mock_scheduler = MagicMock()
+    mock_scheduler.position = MagicMock(return_value=None)
+    mock_cache = MagicMock()
+    mock_cache.get = MagicMock(return_value=None)
+
+    with patch.object(infinote, 'runtime_data', rtd), \
+         patch.object(infinote, 'scheduler', mock_scheduler), \
+         patch.object(infinote, 'output_cache', mock_cache), \
+         patch.dict(infinote.inflight, clear=True):
+      # case 1 - bad request
+      resp = self.test_client.post(endpoint, headers=header, data=json.dumps({'v_ids': 'not a list'}))
+      self.assert400(resp)
+
+      # case 2 - too many jobs
+      with patch.dict(infinote_app.config, {'MAX_BULK_JOBS': 2}):
+        resp = self.test_client.post(endpoint, headers=header, data=json.dumps({'v_ids': ['1'] * 3}))
+      self.assert400(resp)
+
+      # case 3 - mixed results
+      links = ['11111111111', 'www.youtube.com/watch?v=22222222222', 'nope', 5, '11111111111']
+      resp = self.test_client.post(endpoint, headers=header, data=json.dumps({'v_ids': links}))
+      self.assert200(resp)
+      results = self._get_json(resp)['results']
+      self.assertEqual(['created', 'created', 'invalid', 'invalid', 'duplicate'], [r['result'] for r in results])
+      self.assertEqual(links, [r['link'] for r in results])
+      self.assertEqual('22222222222', results[1]['job']['v_id'])
+      self.assertEqual(results[0]['job'], results[4]['job'])
+      self.assertNotIn('job', results[2])
+
+      # All jobs were created at once, and queued.
+      rtd.createJobs.assert_called_once_with(u.id, ['11111111111', '22222222222', '11111111111'])
+      self.assertEqual(2, mock_scheduler.submit.call_count)
+      infinote.db_writer.flush()
+      self.assertEqual(['11111111111', '22222222222'], sorted(j.v_id for j in Job.query.all()))
+
+  def test_resume_jobs_rows(self):
+    db.session.add(Job(user_id=1, v_id='11111111111', ts_start=datetime.utcnow()))
+    db.session.commit()
+    db.session.remove()
+    rtd = RuntimeData()
+    j_id, ts = rtd.createJob(1, '11111111111')
+    rtd.set_attributes(1, j_id, {'stage': 'download', 'prog': 0.5})
+    mock_scheduler = MagicMock()
+    mock_cache = MagicMock()
+    mock_cache.get = MagicMock(return_value=None)
+    # A writer fresh from a restart, it knows of no rows.
+    writer = DBWriter(db, Job)
+    writer.start()
+
+    with patch.object(infinote, 'runtime_data', rtd), \
+         patch.object(infinote, 'scheduler', mock_scheduler), \
+         patch.object(infinote, 'output_cache', mock_cache), \
+         patch.object(infinote, 'storage', MagicMock()), \
+         patch.object(infinote, 'layout', StorageLayout('.')), \
+         patch.object(infinote, 'url_for', MagicMock(return_value='http://mock_job_link')), \
+         patch.object(infinote, 'db_writer', writer), \
+         patch.dict(infinote.inflight, clear=True):
+      self.assertEqual(1, infinote._resume_jobs())
+      tracker = mock_scheduler.submit.call_args[0][4]
+      tracker.set_attribute('label', 'Song')
+      tracker.update_stage('done')
+      writer.stop()
+    self.assertIsNotNone(Job.query.one().ts_complete)
+
+  def test_playlist_page(self):
+    endpoint = '/infinote/api/v1.0/playlists/PL1234'
+    supported_methods = frozenset(('GET', 'HEAD'))
+    u, password = self._gen_user('tom')
+    self._tested_endpoint(endpoint)
+
+    # Validate only specified methods are supported.
+    self._verify_methods(supported_methods, endpoint)
+
+    # Ensure this endpoint is protected.
+    self._verify_credential_check(endpoint, 'GET', u.username, password)
+
+    header = self._gen_auth_header(u.username, password)
+    header['Content-Type'] = 'application/json'
+    provider = FakePlaylistProvider(1000, page_delay=0.02)
+    mock_scheduler = MagicMock()
+    mock_scheduler.position = MagicMock(return_value=None)
+    mock_cache = MagicMock()
+    mock_cache.get = MagicMock(return_value=None)
+
+    with patch.object(infinote, 'runtime_data', RuntimeData()), \
+         patch.object(infinote, 'scheduler', mock_scheduler), \
+         patch.object(infinote, 'output_cache', mock_cache), \
+         patch.object(infinote.playlist_expander, 'provider', provider), \
+         patch.dict(infinote.inflight, clear=True):
+      # case 1 - unknown playlist
+      resp = self.test_client.get(endpoint, headers=header)
+      self.assert404(resp)
+
+      # case 2 - submitting a playlist link starts expanding it...
+      start = time.time()
+      link = 'www.youtube.com/playlist?list=PL1234'
+      resp = self.test_client.post('/infinote/api/v1.0/jobs', headers=header, data=json.dumps({'v_id': link}))
+      self.assertEqual(202, resp.status_code)
+      playlist = self._get_json(resp)['playlist']
+      self.assertEqual(('PL1234', 'expanding'), (playlist['list_id'], playlist['stage']))
+      self.assertTrue(playlist['uri'].endswith(endpoint))
+
+      # ...and the first jobs are queued right away, long before the rest are listed.
+      while not mock_scheduler.submit.called and time.time() - start < 1.0:
+        time.sleep(0.01)
+      self.assertLess(time.time() - start, 1.0)
+      resp = self.test_client.get(endpoint, headers=header)
+      self.assertEqual('expanding', self._get_json(resp)['playlist']['stage'])
+
+      # case 3 - all done
+      while infinote.playlist_expander.get(u.id, 'PL1234')['stage'] == 'expanding' and time.time() - start < 10:
+        time.sleep(0.01)
+      resp = self.test_client.get(endpoint, headers=header)
+      self.assert200(resp)
+      playlist = self._get_json(resp)['playlist']
+      self.assertEqual(('done', 20, 1000, 1000), (playlist['stage'], playlist['pages'], playlist['entries'], playlist['created']))
+      self.assertEqual(1000, mock_scheduler.submit.call_count)
+      self.assertEqual(1000, len(infinote.runtime_data.getUser(u.id)))
+      infinote.db_writer.flush()
+      self.assertEqual(1000, Job.query.filter_by(user_id=u.id).count())
+
+  def test_file_page(self):
+    u, password = self._gen_user('tom')
+    header = self._gen_auth_header(u.username, password)
+    directory = tempfile.mkdtemp()
+    payload = os.urandom(64 * 1024)
+    with open(os.path.join(directory, 'Some Song.mp3'), 'wb') as f:
+      f.write(payload)
+    job = {'id': 1234, 'v_id': '11111111111', 'label': '', 'stage': 'init'}
+    rtd = MagicMock()
+    rtd.getJob = MagicMock(return_value=job)
+    endpoint = '/infinote/api/v1.0/jobs/1234/link'
+    self._tested_endpoint(endpoint)
+
+    with patch.object(infinote, 'runtime_data', rtd), patch.object(infinote, 'layout', StorageLayout(directory)):
+      # Ensure this endpoint is protected.
+      self.assert401(self.test_client.get(endpoint))
+
+      # case 1 - not done yet
+      resp = self.test_client.get(endpoint, headers=header)
+      self.assert400(resp)
+
+      # case 2 - whole file
+      job.update({'stage': 'done', 'label': 'Some Song'})
+      resp = self.test_client.get(endpoint, headers=header)
+      self.assert200(resp)
+      self.assertEqual(payload, resp.data)
+      self.assertEqual('bytes', resp.headers['Accept-Ranges'])
+      self.assertIn('attachment', resp.headers['Content-Disposition'])
+      etag = resp.headers['ETag']
+      resp.close()
+
+      # case 3 - ranges, e.g. to resume a dropped download
+      resp = self.test_client.get(endpoint, headers=dict(header, Range='bytes=1000-1999'))
+      self.assertEqual(206, resp.status_code)
+      self.assertEqual(payload[1000:2000], resp.data)
+      self.assertEqual('bytes 1000-1999/{}'.format(len(payload)), resp.headers['Content-Range'])
+      resp.close()
+      resp = self.test_client.get(endpoint, headers=dict(header, Range='bytes=1000000-'))
+      self.assertEqual(416, resp.status_code)
+
+      # case 4 - conditional requests
+      resp = self.test_client.get(endpoint, headers=dict(header, **{'If-None-Match': etag}))
+      self.assertEqual(304, resp.status_code)
+      self.assertEqual(b'', resp.data)
+      resp.close()
+      # A new file means a new etag, so a stale If-Range gets the whole thing.
+      os.remove(os.path.join(directory, 'Some Song.mp3'))
+      with open(os.path.join(directory, 'Some Song.mp3'), 'wb') as f:
+        f.write(payload[::-1])
+      resp = self.test_client.get(endpoint, headers=dict(header, **{'Range': 'bytes=1000-', 'If-Range': etag}))
+      self.assert200(resp)
+      self.assertEqual(payload[::-1], resp.data)
+      self.assertNotEqual(etag, resp.headers['ETag'])
+      resp.close()
+
+      # case 5 - the front proxy sends the file
+      with patch.dict(infinote_app.config, {'FILE_OFFLOAD': 'x-accel-redirect'}):
+        resp = self.test_client.get(endpoint, headers=header)
+      self.assert200(resp)
+      self.assertEqual(b'', resp.data)
+      self.assertEqual('/protected/output/Some%20Song.mp3', resp.headers['X-Accel-Redirect'])
+      self.assertIn('attachment', resp.headers['Content-Disposition'])
+      with patch.dict(infinote_app.config, {'FILE_OFFLOAD': 'x-sendfile'}):
+        resp = self.test_client.get(endpoint, headers=header)
+      self.assertEqual(b'', resp.data)
+      self.assertEqual(os.path.join(directory, 'Some Song.mp3'), resp.headers['X-Sendfile'])
+
+      # case 6 - file is gone
+      os.remove(os.path.join(directory, 'Some Song.mp3'))
+      self.assert404(self.test_client.get(endpoint, headers=header))
+    shutil.rmtree(directory)
+
+  def test_expired_jobs(self):
+    u, password = self._gen_user('tom')
+    header = self._gen_auth_header(u.username, password)
+    directory = tempfile.mkdtemp()
+    rtd = RuntimeData()
+    trackers = []
+    for i in range(2):
+      j_id, ts = rtd.createJob(u.id, '{:011d}'.format(i))
+      trackers.append(JobTracker(u.id, j_id, '{:011d}'.format(i)))
+      trackers[-1].set_attribute('label', 'Song {}'.format(i))
+      with open(os.path.join(directory, 'Song {}.mp3'.format(i)), 'wb') as f:
+        f.write(b'x' * 1000)
+    storage = StorageManager(directory, max_bytes=1500, on_evict=infinote._expire_jobs)
+
+    with patch.object(infinote, 'runtime_data', rtd), \
+         patch.object(infinote, 'layout', StorageLayout(directory)), \
+         patch.object(infinote, 'output_cache', MagicMock()), \
+         patch.object(infinote, 'url_for', MagicMock(return_value='http://mock_job_link')), \
+         patch.object(infinote, 'storage', storage):
+      # Finishing the second job pushes the first one's file out.
+      trackers[0].update_stage('done')
+      trackers[1].update_stage('done')
+      self.assertEqual(['Song 1.mp3'], os.listdir(directory))
+      self.assertEqual('expired', rtd.get_attribute(u.id, trackers[0].j_id, 'stage'))
+      self.assertEqual('', rtd.get_attribute(u.id, trackers[0].j_id, 'link'))
+      self.assertEqual('done', rtd.get_attribute(u.id, trackers[1].j_id, 'stage'))
+
+      # Expired jobs say so instead of pretending the file is just missing.
+      job = rtd.getJob(u.id, trackers[0].j_id)
+      with patch.object(rtd, 'getJob', MagicMock(return_value=job)):
+        resp = self.test_client.get('/infinote/api/v1.0/jobs/1234/link', headers=header)
+      self.assertEqual(410, resp.status_code)
+      self.assertEqual('Gone', self._get_json(resp)['error'])
+
+      # Submitting it again starts the job over.
+      infinote.output_cache.get.return_value = None
+      with patch.object(infinote, 'scheduler', MagicMock(**{'position.return_value': 0})) as mock_scheduler, \
+           patch.dict(infinote.inflight, clear=True):
+        resp = self.test_client.post('/infinote/api/v1.0/jobs', headers=header,
+            data=json.dumps({'v_id': '00000000000'}), content_type='application/json')
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual('init', rtd.get_attribute(u.id, trackers[0].j_id, 'stage'))
+        mock_scheduler.submit.assert_called_once_with(u.id, trackers[0].j_id, '00000000000', infinote.download_dir, ANY)
+        # ...and only that one.
+        resp = self.test_client.post('/infinote/api/v1.0/jobs', headers=header,
+            data=json.dumps({'v_id': '00000000001'}), content_type='application/json')
+        self.assertEqual(409, resp.status_code)
+    shutil.rmtree(directory)
+
+  def test_archive_page(self):
+    endpoint = '/infinote/api/v1.0/jobs/archive'
+    supported_methods = frozenset(('GET', 'HEAD'))
+    u, password = self._gen_user('tom')
+    self._tested_endpoint(endpoint)
+
+    # Validate only specified methods are supported.
+    self._verify_methods(supported_methods, endpoint)
+
+    header = self._gen_auth_header(u.username, password)
+    directory = tempfile.mkdtemp()
+    rtd = RuntimeData()
+    j_ids = []
+    for i, stage in enumerate(('done', 'done', 'download')):
+      j_id, ts = rtd.createJob(u.id, '{:011d}'.format(i))
+      rtd.set_attributes(u.id, j_id, {'stage': stage, 'label': 'Song {}'.format(i)})
+      with open(os.path.join(directory, 'Song {}.mp3'.format(i)), 'wb') as f:
+        f.write(b'song %d' % i)
+      j_ids.append(j_id)
+
+    with patch.object(infinote, 'runtime_data', rtd), patch.object(infinote, 'layout', StorageLayout(directory)):
+      # Ensure this endpoint is protected.
+      self.assert401(self.test_client.get(endpoint))
+
+      # case 1 - all finished jobs
+      resp = self.test_client.get(endpoint, headers=header)
+      self.assert200(resp)
+      self.assertEqual('application/zip', resp.mimetype)
+      self.assertIn('infinote.zip', resp.headers['Content-Disposition'])
+      with zipfile.ZipFile(io.BytesIO(resp.data)) as z:
+        self.assertEqual(['Song 0.mp3', 'Song 1.mp3'], sorted(z.namelist()))
+        self.assertEqual(b'song 1', z.read('Song 1.mp3'))
+
+      # case 2 - a selection
+      resp = self.test_client.get(endpoint + '?j_id=' + j_ids[1], headers=header)
+      self.assert200(resp)
+      with zipfile.ZipFile(io.BytesIO(resp.data)) as z:
+        self.assertEqual(['Song 1.mp3'], z.namelist())
+
+      # case 3 - unfinished or unknown jobs
+      resp = self.test_client.get(endpoint + '?j_id={}&j_id={}'.format(j_ids[0], j_ids[2]), headers=header)
+      self.assert400(resp)
+      resp = self.test_client.get(endpoint + '?j_id=1234', headers=header)
+      self.assert404(resp)
+
+    # case 4 - nothing finished
+    with patch.object(infinote, 'runtime_data', RuntimeData()):
+      resp = self.test_client.get(endpoint, headers=header)
+      self.assert404(resp)
+    shutil.rmtree(directory)
+
+  def test_stats_page(self):
+    endpoint = '/infinote/api/v1.0/stats'
+    supported_methods = frozenset(('GET', 'HEAD'))
+    u, password = self._gen_user('tom')
+    self._tested_endpoint(endpoint)
+
+    # Validate only specified methods are supported.
+    self._verify_methods(supported_methods, endpoint)
+
+    # Ensure this endpoint is protected.
+    self._verify_credential_check(endpoint, 'GET', u.username, password)
+
+    # case 1 - metadata cache hit rate
+    header = self._gen_auth_header(u.username, password)
+    with patch.object(infinote, 'metadata_cache', MetadataCache()) as cache:
+      cache.get('11111111111')
+      cache.put('11111111111', 'meta')
+      cache.get('11111111111')
+      resp = self.test_client.get(endpoint, headers=header)
+    self.assert200(resp)
+    expected = {'size': 1, 'hits': 1, 'misses': 1, 'hit_rate': 0.5}
+    self.assertEqual(expected, self._get_json(resp)['metadata_cache'])
+
+    # case 2 - disk usage
+    self.assertEqual(infinote.storage.stats(), self._get_json(resp)['storage'])
+
+  def test_jobs_stream_page(self):
+    endpoint = '/infinote/api/v1.0/jobs/stream'
+    supported_methods = frozenset(('GET', 'HEAD'))
+    u, password = self._gen_user('tom')
+    self._tested_endpoint(endpoint)
+
+    # Ensure this endpoint is protected.
+    resp = self.test_client.get(endpoint)
+    self.assert401(resp)
+
+    # case 1 - current state of the user's jobs is sent first
+    rtd = RuntimeData()
+    jid, ts = rtd.createJob(u.id, '11111111111')
+    header = self._gen_auth_header(u.username, password)
+    with patch.object(infinote, 'runtime_data', rtd):
+      resp = self.test_client.get(endpoint, headers=header, buffered=False)
+      self.assert200(resp)
+      self.assertEqual('text/event-stream', resp.mimetype)
+      events = iter(resp.response)
+      event = next(events).decode('utf-8')
+      self.assertTrue(event.startswith('data: '))
+      job = json.loads(event[len('data: '):])
+      self.assertEqual('11111111111', job['v_id'])
+      self.assertEqual('init', job['stage'])
+
+      # case 2 - updates are pushed as they are recorded
+      rtd.set_attributes(u.id, jid, {'stage': 'download', 'prog': 0.5})
+      event = next(events).decode('utf-8')
+      job = json.loads(event[len('data: '):])
+      self.assertEqual('download', job['stage'])
+      self.assertEqual(0.5, job['prog'])
+      resp.close()
+
+  def test_job_stream_page(self):
+    u, password = self._gen_user('tom')
+    header = self._gen_auth_header(u.username, password)
+    rtd = RuntimeData()
+    jid, ts = rtd.createJob(u.id, '11111111111')
+    endpoint = '/infinote/api/v1.0/jobs/{}/stream'.format(jid)
+    self._tested_endpoint('/infinote/api/v1.0/jobs/<j_id>/stream')
+
+    with patch.object(infinote, 'runtime_data', rtd), \
+         patch.dict(infinote_app.config, {'STREAM_INTERVAL': 0}):
+      # Ensure this endpoint is protected.
+      self.assert401(self.test_client.get(endpoint))
+
+      # case 1 - unknown job
+      self.assert404(self.test_client.get('/infinote/api/v1.0/jobs/1234/stream', headers=header))
+
+      # case 2 - current state of the job, as created by the API
+      resp = self.test_client.get(endpoint, headers=header, buffered=False)
+      self.assert200(resp)
+      events = iter(resp.response)
+      job = json.loads(next(events).decode('utf-8')[len('data: '):])
+      self.assertEqual('11111111111', job['v_id'])
+
+      # case 3 - other jobs' updates are left out
+      jid_2, ts = rtd.createJob(u.id, '22222222222')
+      rtd.set_attribute(u.id, jid, 'prog', 0.5)
+      job = json.loads(next(events).decode('utf-8')[len('data: '):])
+      self.assertEqual('11111111111', job['v_id'])
+      self.assertEqual(0.5, job['prog'])
+
+      # case 4 - deleting the job ends the stream
+      rtd.delJob(u.id, jid)
+      self.assertTrue(next(events).decode('utf-8').startswith('event: delete\n'))
+      self.assertRaises(StopIteration, next, events)
+      resp.close()
+
   def test_user_registration(self):
     endpoint = '/infinote/api/v1.0/register'
     supported_methods = frozenset(('POST',))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import io, os, unittest, tempfile, shutil, zipfile
+from unittest.mock import patch
+from app import archive
+from app.archive import stream_zip
+
+
+class StreamZipTestCases(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.files = {}
+    for name, size in (('a.mp3', 1000), ('b.mp3', 300 * 1024), ('empty.mp3', 0)):
+      self.files[name] = os.urandom(size)
+      with open(os.path.join(self.directory, name), 'wb') as f:
+        f.write(self.files[name])
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _path(self, name):
+    return os.path.join(self.directory, name)
+
+  def test_stream_zip(self):
+    chunks = list(stream_zip([(name, self._path(name)) for name in sorted(self.files)]))
+
+    self.assertNotIn(b'', chunks)
+    with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as z:
+      self.assertIsNone(z.testzip())
+      self.assertEqual(sorted(self.files), z.namelist())
+      for info in z.infolist():
+        self.assertEqual(zipfile.ZIP_STORED, info.compress_type)
+        self.assertEqual(self.files[info.filename], z.read(info))
+
+  def test_constant_memory(self):
+    # No chunk is much bigger than what is read from disk at a time...
+    with patch.object(archive, 'chunk_size', 4096):
+      chunks = stream_zip([('b.mp3', self._path('b.mp3'))] * 50)
+      sizes = [len(chunk) for chunk in chunks]
+    self.assertLess(max(sizes), 4096 + 1024)
+    # ...no matter how much goes in.
+    self.assertGreater(sum(sizes), 50 * 300 * 1024)
+
+  def test_lazy(self):
+    # Nothing is read before the response asks for it.
+    chunks = stream_zip([('a.mp3', self._path('a.mp3'))])
+    os.remove(self._path('a.mp3'))
+    with self.assertLogs('app.archive', 'WARNING'):
+      data = b''.join(chunks)
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+      self.assertEqual([], z.namelist())
+
+  def test_names(self):
+    files = [('a.mp3', self._path('a.mp3')), ('missing.mp3', self._path('missing.mp3')),
+        ('a.mp3', self._path('b.mp3')), ('a.mp3', self._path('empty.mp3'))]
+    with self.assertLogs('app.archive', 'WARNING'):
+      data = b''.join(stream_zip(files))
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+      self.assertEqual(['a.mp3', 'a (2).mp3', 'a (3).mp3'], z.namelist())
+      self.assertEqual(self.files['b.mp3'], z.read('a (2).mp3'))
+
+  def test_unsafe_names(self):
+    names = ['AC/DC - Thunderstruck.mp3', '../../etc/passwd.mp3', '..\\..\\boot.ini.mp3', '/abs.mp3', '..', '.hidden.mp3']
+    data = b''.join(stream_zip([(name, self._path('a.mp3')) for name in names]))
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+      self.assertEqual(['AC_DC - Thunderstruck.mp3', '_.._etc_passwd.mp3', '_.._boot.ini.mp3', '_abs.mp3', 'untitled',
+          'hidden.mp3'], z.namelist())
+      for name in z.namelist():
+        self.assertNotIn('/', name)
+        self.assertNotIn('\\', name)
+        self.assertFalse(name.startswith('.'))
+
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+import os, time, unittest, tempfile, shutil
+from unittest.mock import MagicMock
+from app.cache import OutputCache, CredentialCache, MetadataCache
+
+
+class OutputCacheTestCases(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.index_path = os.path.join(self.directory, 'index.json')
+    self.cache = OutputCache(self.directory, self.index_path)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _touch(self, filename):
+    with open(os.path.join(self.directory, filename), 'w') as f:
+      f.write('data')
+
+  def test_get(self):
+    v_id = '11111111111'
+
+    # case 1 - nothing cached
+    self.assertIsNone(self.cache.get(v_id))
+
+    # case 2 - cached and file exists
+    self._touch('Song.mp3')
+    self.cache.put(v_id, 'Song', 'Song.mp3')
+    res = self.cache.get(v_id)
+    self.assertEqual('Song', res['label'])
+    self.assertEqual(os.path.join(self.directory, 'Song.mp3'), self.cache.path(res))
+
+    # case 3 - other format not cached
+    self.assertIsNone(self.cache.get(v_id, 'ogg'))
+
+    # case 4 - file disappeared, entry is dropped
+    os.remove(os.path.join(self.directory, 'Song.mp3'))
+    self.assertIsNone(self.cache.get(v_id))
+    self.assertEqual({}, self.cache.entries)
+
+  def test_put(self):
+    v_id = '11111111111'
+
+    # case 1 - new entry is written to the index
+    res = self.cache.put(v_id, 'Song', 'Song.mp3')
+    self.assertEqual(v_id, res['v_id'])
+    self.assertTrue(os.path.isfile(self.index_path))
+
+    # case 2 - same entry again is not rewritten
+    self.cache.save = MagicMock()
+    self.assertIs(res, self.cache.put(v_id, 'Song', 'Song.mp3'))
+    self.cache.save.assert_not_called()
+
+    # case 3 - changed entry is rewritten
+    self.cache.put(v_id, 'Song 2', 'Song 2.mp3')
+    self.cache.save.assert_called_once_with()
+
+  def test_remove(self):
+    v_id = '11111111111'
+
+    # case 1 - nothing to remove
+    self.assertIsNone(self.cache.remove(v_id))
+
+    # case 2 - happy path
+    self.cache.put(v_id, 'Song', 'Song.mp3')
+    self.assertEqual('Song', self.cache.remove(v_id)['label'])
+    self.assertEqual({}, self.cache.entries)
+
+  def test_z_survives_restart(self):
+    self._touch('Song.mp3')
+    self.cache.put('11111111111', 'Song', 'Song.mp3')
+
+    new_cache = OutputCache(self.directory, self.index_path)
+    self.assertEqual('Song', new_cache.get('11111111111')['label'])
+
+    # A broken index just means an empty cache.
+    with open(self.index_path, 'w') as f:
+      f.write('{not json')
+    new_cache = OutputCache(self.directory, self.index_path)
+    self.assertEqual({}, new_cache.entries)
+
+
+class CredentialCacheTestCases(unittest.TestCase):
+
+  def setUp(self):
+    self.cache = CredentialCache('secret', ttl=60, max_size=3)
+
+  def test_get(self):
+    # case 1 - never verified
+    self.assertIsNone(self.cache.get('tom', 'tom_password'))
+
+    # case 2 - happy path
+    self.cache.put('tom', 'tom_password', 1)
+    self.assertEqual((1, 'tom'), self.cache.get('tom', 'tom_password'))
+
+    # case 3 - wrong password or username
+    self.assertIsNone(self.cache.get('tom', 'incorrect'))
+    self.assertIsNone(self.cache.get('incorrect', 'tom_password'))
+    # ...no ambiguity in where the username ends and the password starts.
+    self.assertIsNone(self.cache.get('to', 'mtom_password'))
+
+    # case 4 - expired
+    self.cache.ttl = -1
+    self.cache.put('dan', 'dan_password', 2)
+    self.assertIsNone(self.cache.get('dan', 'dan_password'))
+    self.assertNotIn(2, self.cache.by_user)
+
+  def test_no_plain_text(self):
+    self.cache.put('tom', 'tom_password', 1)
+    for digest, entry in self.cache.entries.items():
+      self.assertNotIn(b'tom_password', digest)
+      self.assertNotIn('tom_password', entry)
+
+    # Digests depend on the secret.
+    other = CredentialCache(b'other secret')
+    other.put('tom', 'tom_password', 1)
+    self.assertNotEqual(set(self.cache.entries), set(other.entries))
+
+  def test_max_size(self):
+    for u_id in range(3):
+      self.cache.put('user{}'.format(u_id), 'password', u_id)
+    # Using user0 makes user1 the least recently used.
+    self.cache.get('user0', 'password')
+    self.cache.put('user3', 'password', 3)
+
+    self.assertEqual(3, len(self.cache.entries))
+    self.assertIsNone(self.cache.get('user1', 'password'))
+    self.assertEqual((0, 'user0'), self.cache.get('user0', 'password'))
+    self.assertEqual((3, 'user3'), self.cache.get('user3', 'password'))
+
+  def test_invalidate(self):
+    self.cache.put('tom', 'tom_password', 1)
+    self.cache.put('tom', 'old_password', 1)
+    self.cache.put('dan', 'dan_password', 2)
+
+    # case 1 - unknown user
+    self.cache.invalidate(3)
+    self.assertEqual(3, len(self.cache.entries))
+
+    # case 2 - all of a user's entries go, others stay
+    self.cache.invalidate(1)
+    self.assertIsNone(self.cache.get('tom', 'tom_password'))
+    self.assertIsNone(self.cache.get('tom', 'old_password'))
+    self.assertEqual((2, 'dan'), self.cache.get('dan', 'dan_password'))
+    self.assertEqual({2}, set(self.cache.by_user))
+
+
+class MetadataCacheTestCases(unittest.TestCase):
+
+  def setUp(self):
+    self.cache = MetadataCache(ttl=60, max_size=3)
+
+  def test_get(self):
+    # case 1 - miss
+    self.assertIsNone(self.cache.get('11111111111'))
+
+    # case 2 - hit
+    self.cache.put('11111111111', 'meta')
+    self.assertEqual('meta', self.cache.get('11111111111'))
+
+    # case 3 - expired by ttl
+    self.cache.ttl = -1
+    self.cache.put('22222222222', 'meta')
+    self.assertIsNone(self.cache.get('22222222222'))
+    self.assertNotIn('22222222222', self.cache.entries)
+
+    # case 4 - expired by the entry's own expiry
+    self.cache.ttl = 60
+    self.cache.put('33333333333', 'meta', expiry=time.time() - 1)
+    self.assertIsNone(self.cache.get('33333333333'))
+
+  def test_max_size(self):
+    for i in range(3):
+      self.cache.put(i, 'meta')
+    # Using 0 makes 1 the least recently used.
+    self.cache.get(0)
+    self.cache.put(3, 'meta')
+    self.assertEqual([2, 0, 3], list(self.cache.entries))
+
+  def test_stats(self):
+    # case 1 - no lookups yet
+    self.assertEqual({'size': 0, 'hits': 0, 'misses': 0, 'hit_rate': 0.0}, self.cache.stats())
+
+    # case 2 - one miss, three hits
+    self.cache.get('11111111111')
+    self.cache.put('11111111111', 'meta')
+    for i in range(3):
+      self.cache.get('11111111111')
+    self.assertEqual({'size': 1, 'hits': 3, 'misses': 1, 'hit_rate': 0.75}, self.cache.stats())
+
+    # case 3 - clear resets everything
+    self.cache.clear()
+    self.assertEqual(0, self.cache.stats()['misses'])
+
+
+
+if __name__ == '__main__':
+  unittest.main()
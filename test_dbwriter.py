@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock
+from flask import Flask
+from sqlalchemy.pool import StaticPool
+from app.config import db, infinote_app, TunedSQLAlchemy
+from app.models import Job
+from app.dbwriter import DBWriter
+
+
+class DBWriterTestCases(unittest.TestCase):
+
+  def setUp(self):
+    db.create_all()
+    self.writer = DBWriter(db, Job, max_batch=4, max_latency=0.05)
+    self.writer._write = MagicMock(wraps=self.writer._write)
+
+  def tearDown(self):
+    self.writer.stop()
+    db.session.remove()
+    db.drop_all()
+
+  def _fields(self, u_id, v_id='11111111111'):
+    return {'user_id': u_id, 'v_id': v_id, 'ts_start': datetime.utcnow()}
+
+  def _jobs(self):
+    jobs = Job.query.order_by(Job.user_id).all()
+    db.session.remove()
+    return jobs
+
+  def test_insert(self):
+    # case 1 - nothing is written until flushed
+    self.writer.insert((1, 0), self._fields(1))
+    self.assertEqual([], self._jobs())
+
+    # case 2 - happy path
+    self.assertTrue(self.writer.flush())
+    jobs = self._jobs()
+    self.assertEqual(1, len(jobs))
+    self.assertEqual(1, jobs[0].user_id)
+    self.assertIsNone(jobs[0].ts_complete)
+    self.assertEqual(jobs[0].id, self.writer.rows[(1, 0)])
+
+  def test_update(self):
+    ts = datetime.utcnow()
+
+    # case 1 - unknown key
+    self.writer.update((1, 0), {'ts_complete': ts})
+    self.writer.flush()
+    self.assertEqual([], self._jobs())
+
+    # case 2 - update within the same batch as the insert
+    self.writer.insert((1, 0), self._fields(1))
+    self.writer.update((1, 0), {'v_id': '22222222222'})
+    self.writer.flush()
+    self.assertEqual('22222222222', self._jobs()[0].v_id)
+
+    # case 3 - update of an already written row, then forget about it
+    self.writer.update((1, 0), {'ts_complete': ts}, forget=True)
+    self.writer.flush()
+    self.assertEqual(ts, self._jobs()[0].ts_complete)
+    self.assertNotIn((1, 0), self.writer.rows)
+
+  def test_delete(self):
+    # case 1 - already written row
+    self.writer.insert((1, 0), self._fields(1))
+    self.writer.flush()
+    self.writer.delete((1, 0))
+    self.writer.flush()
+    self.assertEqual([], self._jobs())
+    self.assertEqual({}, self.writer.rows)
+
+    # case 2 - inserted and deleted in one batch
+    self.writer.insert((1, 1), self._fields(1))
+    self.writer.delete((1, 1))
+    self.writer.insert((2, 0), self._fields(2))
+    self.writer.flush()
+    jobs = self._jobs()
+    self.assertEqual([2], [j.user_id for j in jobs])
+    self.assertEqual({(2, 0): jobs[0].id}, self.writer.rows)
+
+  def test_relink(self):
+    ts = datetime.utcnow()
+    self.writer.insert((1, 0), self._fields(1))
+    self.writer.insert((1, 1), self._fields(1, '22222222222'))
+    self.writer.flush()
+    self.writer.update((1, 1), {'ts_complete': ts}, forget=True)
+    self.writer.flush()
+
+    # case 1 - after a restart the keys are found again, finished rows are not
+    self.writer.stop()
+    self.writer = DBWriter(db, Job, max_batch=4, max_latency=0.05)
+    self.writer.start()
+    self.writer.relink((1, 0), {'user_id': 1, 'v_id': '11111111111', 'ts_complete': None})
+    self.writer.relink((1, 1), {'user_id': 1, 'v_id': '22222222222', 'ts_complete': None})
+    self.writer.update((1, 0), {'ts_complete': ts}, forget=True)
+    self.writer.flush()
+    self.assertEqual([ts, ts], [j.ts_complete for j in self._jobs()])
+    self.assertEqual({}, self.writer.rows)
+
+    # case 2 - a key that is known already is left alone
+    self.writer.insert((2, 0), self._fields(2))
+    self.writer.relink((2, 0), {'user_id': 1})
+    self.writer.flush()
+    self.assertEqual(2, self._jobs()[2].user_id)
+    self.assertEqual(self._jobs()[2].id, self.writer.rows[(2, 0)])
+
+  def test_insert_many(self):
+    rows = [((u_id, 0), self._fields(u_id)) for u_id in range(3)]
+    self.writer.max_batch = 2
+    self.writer.insert_many(rows)
+    self.writer.insert((3, 0), self._fields(3))
+    self.writer.flush()
+
+    self.assertEqual([0, 1, 2, 3], [j.user_id for j in self._jobs()])
+    self.assertEqual(4, len(self.writer.rows))
+    # All of them went in as one operation.
+    self.assertEqual(2, len(self.writer._write.call_args[0][0]))
+
+  def test_failed_batch(self):
+    self.writer.insert((1, 0), {'no_such_column': 1})
+    with self.assertLogs('app.dbwriter', 'ERROR'):
+      self.writer.flush()
+    self.assertEqual({}, self.writer.rows)
+
+    # The writer recovers and carries on with the next batch.
+    self.writer.insert((2, 0), self._fields(2))
+    self.writer.flush()
+    self.assertEqual([2], [j.user_id for j in self._jobs()])
+
+  def test_z_group_commit(self):
+    num_jobs = 10
+    self.writer.start()
+    for u_id in range(num_jobs):
+      self.writer.insert((u_id, 0), self._fields(u_id))
+    self.assertTrue(self.writer.flush(5))
+
+    # Everything is written, in batches of at most max_batch.
+    self.assertEqual(list(range(num_jobs)), [j.user_id for j in self._jobs()])
+    batches = [len(c[0][0]) for c in self.writer._write.call_args_list]
+    self.assertEqual(num_jobs, sum(batches))
+    self.assertLessEqual(max(batches), 4)
+    self.assertLess(len(batches), num_jobs)
+
+  def test_z_stop(self):
+    self.writer.max_latency = 10
+    self.writer.start()
+    self.assertFalse(self.writer.start())
+    self.writer.insert((1, 0), self._fields(1))
+    # Stopping doesn't wait out max_latency and doesn't drop queued writes.
+    self.writer.stop()
+    self.assertFalse(self.writer.thread.is_alive())
+    self.assertEqual(1, len(self._jobs()))
+
+
+class SQLiteProfileTestCases(unittest.TestCase):
+
+  def test_pragmas(self):
+    with db.engine.connect() as conn:
+      self.assertEqual('wal', conn.execute('PRAGMA journal_mode').scalar())
+      self.assertEqual(1, conn.execute('PRAGMA synchronous').scalar()) # NORMAL
+      self.assertEqual(5000, conn.execute('PRAGMA busy_timeout').scalar())
+
+  def test_pool(self):
+    self.assertEqual(infinote_app.config['WORKER_COUNT'], db.engine.pool.size())
+
+  def test_in_memory(self):
+    app = Flask(__name__)
+    app.config.update(infinote_app.config)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    memory_db = TunedSQLAlchemy(app)
+    memory_db.create_all()
+    self.assertIsInstance(memory_db.engine.pool, StaticPool)
+    self.assertEqual(1, memory_db.engine.execute('SELECT 1').scalar())
+
+
+
+if __name__ == '__main__':
+  unittest.main()
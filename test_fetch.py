@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+import os, unittest, tempfile, shutil, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest.mock import MagicMock, patch
+from urllib.error import HTTPError
+from app import fetch
+from app.fetch import PartialFile, resumable_download, segmented_download
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+  """Serves files with ETags and byte ranges, and can drop connections."""
+  directory = '.'
+  drop_after = None # Bytes to send before hanging up, None to send everything.
+  etag = '"v1"'
+  accept_ranges = True
+  ranges = [] # Range header of every request.
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    self.ranges.append(self.headers.get('Range'))
+    path = os.path.join(self.directory, self.path.lstrip('/'))
+    if not os.path.isfile(path):
+      self.send_error(404)
+      return
+    with open(path, 'rb') as f:
+      data = f.read()
+
+    start = 0
+    range_header = self.headers.get('Range')
+    if_range = self.headers.get('If-Range')
+    end = len(data) - 1
+    if self.accept_ranges and range_header and (if_range is None or if_range == self.etag):
+      first, last = range_header[len('bytes='):].split('-')
+      start = int(first)
+      end = min(int(last), end) if last else end
+      if start >= len(data):
+        self.send_error(416)
+        return
+      self.send_response(206)
+      self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+    else:
+      self.send_response(200)
+    body = data[start:end+1]
+    self.send_header('ETag', self.etag)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    if self.drop_after is not None:
+      body = body[:self.drop_after]
+    try:
+      self.wfile.write(body)
+    except ConnectionError:
+      pass # Client hung up, e.g. after probing for range support.
+
+
+class RangeServer():
+
+  def __init__(self, directory):
+    self.handler = type('Handler', (RangeHandler,), {'directory': directory, 'ranges': []})
+    self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.handler)
+    self.thread = threading.Thread(target=self.httpd.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def url(self, filename):
+    return 'http://127.0.0.1:{}/{}'.format(self.httpd.server_port, filename)
+
+  def stop(self):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+
+
+class ResumableDownloadTestCases(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.payload = os.urandom(300 * 1024)
+    with open(os.path.join(self.directory, 'source.webm'), 'wb') as f:
+      f.write(self.payload)
+    self.server = RangeServer(self.directory)
+    self.url = self.server.url('source.webm')
+    self.filepath = os.path.join(self.directory, 'out.webm')
+    self.retry_delay = fetch.retry_delay
+    fetch.retry_delay = 0
+
+  def tearDown(self):
+    fetch.retry_delay = self.retry_delay
+    self.server.stop()
+    shutil.rmtree(self.directory)
+
+  def _read(self, path):
+    with open(path, 'rb') as f:
+      return f.read()
+
+  def _listdir(self):
+    return sorted(os.listdir(self.directory))
+
+  def test_download(self):
+    callback = MagicMock()
+    resumable_download(self.url, self.filepath, callback)
+
+    self.assertEqual(self.payload, self._read(self.filepath))
+    self.assertEqual(['out.webm', 'source.webm'], self._listdir())
+    self.assertEqual([None], self.server.handler.ranges)
+    total, recvd, ratio, rate, eta = callback.call_args[0]
+    self.assertEqual((len(self.payload), len(self.payload), 1.0), (total, recvd, ratio))
+
+  def test_retry_resumes(self):
+    self.server.handler.drop_after = 100 * 1024
+    callback = MagicMock()
+    with self.assertLogs('app.fetch', 'WARNING'):
+      resumable_download(self.url, self.filepath, callback)
+
+    # Every retry only asked for what was missing.
+    self.assertEqual(self.payload, self._read(self.filepath))
+    self.assertEqual([None, 'bytes=102400-', 'bytes=204800-'], self.server.handler.ranges)
+    self.assertEqual(['out.webm', 'source.webm'], self._listdir())
+    # Progress is for the whole file, not just the last attempt.
+    self.assertEqual(len(self.payload), callback.call_args[0][1])
+
+  def test_resume_later(self):
+    # case 1 - all attempts fail, the partial file is kept
+    self.server.handler.drop_after = 50 * 1024
+    with patch.object(fetch, 'retries', 0):
+      self.assertRaises(Exception, resumable_download, self.url, self.filepath)
+    part = PartialFile(self.filepath)
+    self.assertEqual(50 * 1024, part.offset)
+    self.assertEqual('"v1"', part.validator)
+    self.assertEqual(len(self.payload), part.total)
+
+    # case 2 - a later call (e.g. after a restart) picks up from there
+    self.server.handler.drop_after = None
+    resumable_download(self.url, self.filepath)
+    self.assertEqual(self.payload, self._read(self.filepath))
+    self.assertEqual('bytes=51200-', self.server.handler.ranges[-1])
+    self.assertEqual(['out.webm', 'source.webm'], self._listdir())
+
+  def test_changed_file(self):
+    self.server.handler.drop_after = 50 * 1024
+    with patch.object(fetch, 'retries', 0):
+      self.assertRaises(Exception, resumable_download, self.url, self.filepath)
+
+    # The server has a new version, the partial bytes must not be reused.
+    self.server.handler.drop_after = None
+    self.server.handler.etag = '"v2"'
+    resumable_download(self.url, self.filepath)
+    # It asked to resume, but got (and kept) the whole new file instead.
+    self.assertEqual('bytes=51200-', self.server.handler.ranges[-1])
+    self.assertEqual(self.payload, self._read(self.filepath))
+    self.assertEqual(['out.webm', 'source.webm'], self._listdir())
+
+  def test_already_complete(self):
+    # Crashed after the last byte was written but before the rename.
+    part = PartialFile(self.filepath)
+    part.save('"v1"', len(self.payload))
+    with open(part.part_path, 'wb') as f:
+      f.write(self.payload)
+
+    resumable_download(self.url, self.filepath)
+    self.assertEqual(self.payload, self._read(self.filepath))
+    self.assertEqual(['out.webm', 'source.webm'], self._listdir())
+
+  def test_unsafe_partial(self):
+    # Partial bytes without a sidecar can't be trusted.
+    with open(self.filepath + '.part', 'wb') as f:
+      f.write(b'garbage')
+
+    resumable_download(self.url, self.filepath)
+    self.assertEqual(self.payload, self._read(self.filepath))
+    self.assertEqual([None], self.server.handler.ranges)
+
+  def test_not_found(self):
+    self.assertRaises(HTTPError, resumable_download, self.server.url('missing.webm'), self.filepath)
+    # HTTP errors are not retried.
+    self.assertEqual(1, len(self.server.handler.ranges))
+
+
+class SegmentedDownloadTestCases(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.payload = os.urandom(1024 * 1024)
+    with open(os.path.join(self.directory, 'source.webm'), 'wb') as f:
+      f.write(self.payload)
+    self.server = RangeServer(self.directory)
+    self.url = self.server.url('source.webm')
+    self.filepath = os.path.join(self.directory, 'out.webm')
+    self.patches = [patch.object(fetch, 'retry_delay', 0), patch.object(fetch, 'min_segment_size', 128 * 1024)]
+    for p in self.patches:
+      p.start()
+
+  def tearDown(self):
+    for p in self.patches:
+      p.stop()
+    self.server.stop()
+    shutil.rmtree(self.directory)
+
+  def _read(self, path):
+    with open(path, 'rb') as f:
+      return f.read()
+
+  def _segment_ranges(self):
+    # Everything but the probe.
+    return sorted(r for r in self.server.handler.ranges if r != 'bytes=0-0')
+
+  def test_split(self):
+    size = fetch.min_segment_size
+
+    # case 1 - too small to split
+    self.assertEqual([[0, size - 1, 0]], fetch._split(size, 4))
+
+    # case 2 - segment count grows with the size...
+    self.assertEqual(3, len(fetch._split(3 * size + 10, 4)))
+
+    # case 3 - ...up to max_segments, covering every byte exactly once
+    segments = fetch._split(100 * size + 1, 4)
+    self.assertEqual(4, len(segments))
+    self.assertEqual(0, segments[0][0])
+    self.assertEqual(100 * size, segments[-1][1])
+    for prev, nxt in zip(segments, segments[1:]):
+      self.assertEqual(prev[1] + 1, nxt[0])
+
+  def test_segmented(self):
+    callback = MagicMock()
+    segmented_download(self.url, self.filepath, callback, max_segments=4)
+
+    self.assertEqual(self.payload, self._read(self.filepath))
+    self.assertEqual(['bytes=0-262143', 'bytes=262144-524287', 'bytes=524288-786431', 'bytes=786432-1048575'],
+        self._segment_ranges())
+    self.assertEqual(['out.webm', 'source.webm'], sorted(os.listdir(self.directory)))
+    # Progress is the aggregate of all segments.
+    recvd = [c[0][1] for c in callback.call_args_list]
+    self.assertEqual(sorted(recvd), recvd)
+    self.assertEqual((len(self.payload), len(self.payload), 1.0), callback.call_args[0][:3])
+
+  def test_segment_retry(self):
+    self.server.handler.drop_after = 100 * 1024
+    with self.assertLogs('app.fetch', 'WARNING'):
+      segmented_download(self.url, self.filepath, max_segments=4)
+    self.assertEqual(self.payload, self._read(self.filepath))
+    self.assertIn('bytes=102400-262143', self.server.handler.ranges)
+
+  def test_resume_later(self):
+    # case 1 - segments fail, how far each got is remembered
+    self.server.handler.drop_after = 100 * 1024
+    with patch.object(fetch, 'retries', 0):
+      self.assertRaises(Exception, segmented_download, self.url, self.filepath, max_segments=4)
+    part = PartialFile(self.filepath)
+    self.assertEqual([100 * 1024] * 4, [s[2] for s in part.segments])
+
+    # case 2 - the next call only fetches what is missing
+    self.server.handler.drop_after = None
+    self.server.handler.ranges.clear()
+    segmented_download(self.url, self.filepath, max_segments=4)
+    self.assertEqual(self.payload, self._read(self.filepath))
+    self.assertEqual(['bytes=102400-262143', 'bytes=364544-524287', 'bytes=626688-786431', 'bytes=888832-1048575'],
+        self._segment_ranges())
+
+  def test_changed_file(self):
+    self.server.handler.drop_after = 100 * 1024
+    with patch.object(fetch, 'retries', 0):
+      self.assertRaises(Exception, segmented_download, self.url, self.filepath, max_segments=4)
+
+    # A new version means starting from scratch.
+    self.server.handler.drop_after = None
+    self.server.handler.etag = '"v2"'
+    self.server.handler.ranges.clear()
+    segmented_download(self.url, self.filepath, max_segments=4)
+    self.assertEqual(self.payload, self._read(self.filepath))
+    self.assertIn('bytes=0-262143', self.server.handler.ranges)
+
+  def test_fallback(self):
+    # case 1 - no range support
+    self.server.handler.accept_ranges = False
+    segmented_download(self.url, self.filepath, max_segments=4)
+    self.assertEqual(self.payload, self._read(self.filepath))
+    self.assertEqual(['bytes=0-0', None], self.server.handler.ranges)
+
+    # case 2 - too small to bother
+    self.server.handler.accept_ranges = True
+    self.server.handler.ranges.clear()
+    with patch.object(fetch, 'min_segment_size', len(self.payload)):
+      segmented_download(self.url, self.filepath, max_segments=4)
+    self.assertEqual(['bytes=0-0', None], self.server.handler.ranges)
+
+
+
+if __name__ == '__main__':
+  unittest.main()
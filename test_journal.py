@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+import os, time, unittest, tempfile, shutil
+from unittest.mock import MagicMock
+from app.journal import JobJournal
+from app.models import RuntimeData
+
+
+class JobJournalTestCases(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.journal = JobJournal(self.directory, snapshot_every=1000)
+    self.journal.load()
+
+  def tearDown(self):
+    self.journal.stop()
+    shutil.rmtree(self.directory)
+
+  def _restart(self):
+    self.journal.stop()
+    self.journal = JobJournal(self.directory, snapshot_every=1000)
+    rtd = RuntimeData(journal=self.journal)
+    rtd.restore(self.journal.load())
+    return rtd
+
+  def test_replay(self):
+    rtd = RuntimeData(journal=self.journal)
+    j_id_1, ts = rtd.createJob(1, '11111111111')
+    j_id_2, ts = rtd.createJob(1, '22222222222')
+    j_id_3, ts = rtd.createJob(2, '11111111111')
+    rtd.set_attributes(1, j_id_1, {'stage': 'download', 'prog': 0.5})
+    rtd.delJob(1, j_id_2)
+    rtd.delUser(2)
+
+    # case 1 - state is rebuilt from the journal alone
+    new_rtd = self._restart()
+    self.assertEqual(rtd.data, new_rtd.data)
+    self.assertEqual(0.5, new_rtd.get_attribute(1, j_id_1, 'prog'))
+    self.assertIsNone(new_rtd.getJob(1, j_id_2))
+    self.assertIsNone(new_rtd.getUser(2))
+
+    # case 2 - restoring doesn't journal anything
+    seq = self.journal.seq
+    self._restart()
+    self.assertEqual(seq, self.journal.seq)
+
+  def test_snapshot(self):
+    rtd = RuntimeData(journal=self.journal)
+    j_id, ts = rtd.createJob(1, '11111111111')
+    seq = self.journal.snapshot(rtd)
+    rtd.set_attribute(1, j_id, 'stage', 'convert')
+
+    # case 1 - segments covered by the snapshot are gone
+    segments = self.journal._segments()
+    self.assertEqual(1, len(segments))
+    self.assertGreater(segments[0][0], seq)
+
+    # case 2 - snapshot plus tail
+    new_rtd = self._restart()
+    self.assertEqual(rtd.data, new_rtd.data)
+    self.assertEqual('convert', new_rtd.get_attribute(1, j_id, 'stage'))
+
+    # case 3 - changes made while dumping end up in both, that's harmless
+    rtd.journal = self.journal
+    source = MagicMock()
+    source.dump = lambda: rtd.set_attribute(1, j_id, 'stage', 'done') and rtd.dump()
+    self.journal.snapshot(source)
+    self.assertEqual('done', self._restart().get_attribute(1, j_id, 'stage'))
+
+  def test_torn_write(self):
+    rtd = RuntimeData(journal=self.journal)
+    j_id, ts = rtd.createJob(1, '11111111111')
+    self.journal.flush()
+    self.journal.file.write('[2, 1, "')
+    self.journal.file.flush()
+
+    with self.assertLogs('app.journal', 'WARNING'):
+      new_rtd = self._restart()
+    self.assertEqual(rtd.data, new_rtd.data)
+
+  def test_queued_writes(self):
+    rtd = RuntimeData(journal=self.journal)
+    self.journal.file = MagicMock(wraps=self.journal.file)
+    j_id, ts = rtd.createJob(1, '11111111111')
+    rtd.set_attribute(1, j_id, 'stage', 'download')
+
+    # case 1 - appending doesn't touch the file
+    self.journal.file.write.assert_not_called()
+    self.assertEqual(2, len(self.journal.pending))
+
+    # case 2 - one write for everything queued
+    self.assertEqual(2, self.journal.flush())
+    self.journal.file.write.assert_called_once()
+    self.assertEqual([], self.journal.pending)
+
+    # case 3 - the writer thread picks up new records by itself
+    self.journal.start(rtd)
+    rtd.set_attribute(1, j_id, 'prog', 0.5)
+    end = time.time() + 5
+    while self.journal.file.write.call_count < 2 and time.time() < end:
+      time.sleep(0.01)
+    self.assertEqual(2, self.journal.file.write.call_count)
+    self.assertEqual(rtd.data, self._restart().data)
+
+  def test_background_snapshot(self):
+    self.journal.snapshot_every = 10
+    rtd = RuntimeData(journal=self.journal)
+    self.journal.start(rtd)
+    for i in range(10):
+      rtd.createJob(1, '{:011d}'.format(i))
+
+    end = time.time() + 5
+    while not os.path.isfile(self.journal._snapshot_path()) and time.time() < end:
+      time.sleep(0.01)
+    self.assertEqual(rtd.data, self._restart().data)
+
+  def test_z_fast_restart(self):
+    num_jobs = 100000
+    rtd = RuntimeData()
+    for i in range(num_jobs):
+      rtd.createJob(i % 1000, '{:011d}'.format(i))
+    self.journal.snapshot(rtd)
+    # ...plus a tail of changes since the snapshot.
+    rtd.journal = self.journal
+    for u_id, j_id, job in rtd.dump()[:self.journal.snapshot_every]:
+      rtd.set_attributes(u_id, j_id, {'stage': 'download', 'prog': 0.5})
+
+    start = time.time()
+    new_rtd = self._restart()
+    elapsed = time.time() - start
+    print('\nRestored {} jobs in {:.3f}s'.format(num_jobs, elapsed))
+    self.assertEqual(rtd.data, new_rtd.data)
+    self.assertLess(elapsed, 1.0)
+
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+import os, json, unittest, tempfile, shutil
+from unittest.mock import MagicMock, patch
+from app.layout import StorageLayout
+from app.storage import StorageManager
+from app.cache import OutputCache
+import reshard
+
+
+class StorageLayoutTestCases(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.on_move = MagicMock()
+    self.layout = StorageLayout(self.directory, sharded=True, on_move=self.on_move)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _write(self, relpath):
+    path = os.path.join(self.directory, relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+      f.write(b'x')
+
+  def test_paths(self):
+    # case 1 - two levels of two hex digits of the v_id's sha1
+    self.assertEqual(os.path.join('3d', 'd0', 'dQw4w9WgXcQ.mp3'), self.layout.shard_path('dQw4w9WgXcQ'))
+    self.assertEqual(self.layout.shard_path('dQw4w9WgXcQ'), self.layout.relpath('dQw4w9WgXcQ', 'Song'))
+    self.assertEqual(os.path.join('3d', 'd0', 'dQw4w9WgXcQ'), self.layout.name('dQw4w9WgXcQ'))
+
+    # case 2 - other depth and width
+    layout = StorageLayout(self.directory, sharded=True, depth=3, width=1)
+    self.assertEqual(os.path.join('3', 'd', 'd', 'dQw4w9WgXcQ.mp3'), layout.shard_path('dQw4w9WgXcQ'))
+
+    # case 3 - flat layout keeps naming files by label
+    layout = StorageLayout(self.directory)
+    self.assertEqual('Song.mp3', layout.relpath('dQw4w9WgXcQ', 'Song'))
+    self.assertIsNone(layout.name('dQw4w9WgXcQ'))
+
+  def test_locate(self):
+    shard = self.layout.shard_path('11111111111')
+
+    # case 1 - nothing on disk
+    self.assertIsNone(self.layout.locate('11111111111', 'Song'))
+
+    # case 2 - flat file from before sharding
+    self._write('Song.mp3')
+    self.assertEqual('Song.mp3', self.layout.locate('11111111111', 'Song'))
+    self.assertEqual('Song.mp3', self.layout.paths['11111111111.mp3'])
+
+    # case 3 - moved into its shard, the move is reported
+    self._write(shard)
+    os.remove(os.path.join(self.directory, 'Song.mp3'))
+    self.assertEqual(shard, self.layout.locate('11111111111', 'Song'))
+    self.on_move.assert_called_once_with('Song.mp3', shard)
+
+    # case 4 - no label, only the shard is looked at
+    self.assertEqual(shard, StorageLayout(self.directory).locate('11111111111', None))
+
+  def test_no_collisions(self):
+    # Two videos with the same title.
+    self._write(self.layout.shard_path('11111111111'))
+    self._write(self.layout.shard_path('22222222222'))
+    self._write('Song.mp3')
+    self.assertEqual(self.layout.shard_path('11111111111'), self.layout.locate('11111111111', 'Song'))
+    self.assertEqual(self.layout.shard_path('22222222222'), self.layout.locate('22222222222', 'Song'))
+    self.assertNotEqual(self.layout.shard_path('11111111111'), self.layout.shard_path('22222222222'))
+
+  def test_storage(self):
+    storage = StorageManager(self.directory)
+    shard = self.layout.shard_path('11111111111')
+    self._write('Song.mp3')
+    self._write(shard)
+
+    # case 1 - scan finds files in shards too
+    self.assertEqual(2, storage.scan())
+    self.assertEqual(set(['Song.mp3', shard]), set(storage.entries))
+
+    # case 2 - rename follows a move
+    os.remove(os.path.join(self.directory, shard))
+    storage.entries.pop(shard)
+    self.assertTrue(storage.claim('Song.mp3', (1, '1')))
+    self.assertTrue(storage.rename('Song.mp3', shard))
+    self.assertEqual({(1, '1')}, storage.entries[shard]['owners'])
+    self.assertFalse(storage.rename('Song.mp3', shard))
+
+  def test_storage_hard_links(self):
+    storage = StorageManager(self.directory)
+    shard = self.layout.shard_path('11111111111')
+    with open(os.path.join(self.directory, 'Song.mp3'), 'wb') as f:
+      f.write(b'x' * 100)
+    os.makedirs(os.path.dirname(os.path.join(self.directory, shard)))
+    os.link(os.path.join(self.directory, 'Song.mp3'), os.path.join(self.directory, shard))
+
+    # case 1 - two names, one file
+    self.assertEqual(1, storage.scan())
+    self.assertEqual(100, storage.stats()['bytes'])
+
+    # case 2 - both names recorded, the move merges them
+    storage.entries.clear()
+    storage.total = 0
+    storage.add('Song.mp3', [(1, '1')])
+    storage.add(shard, [(2, '2')])
+    self.assertFalse(storage.rename('Song.mp3', shard))
+    self.assertEqual({'files': 1, 'bytes': 100, 'max_bytes': None, 'evicted': 0, 'swept': 0}, storage.stats())
+    self.assertEqual({(1, '1'), (2, '2')}, storage.entries[shard]['owners'])
+
+  def test_cache_locate(self):
+    index_path = os.path.join(self.directory, 'index.json')
+    cache = OutputCache(self.directory, index_path, locate=self.layout.locate)
+    self._write('Song.mp3')
+    cache.put('11111111111', 'Song', 'Song.mp3')
+
+    # case 1 - moved file is found and the entry updated
+    self._write(self.layout.shard_path('11111111111'))
+    os.remove(os.path.join(self.directory, 'Song.mp3'))
+    entry = cache.get('11111111111')
+    self.assertEqual(self.layout.shard_path('11111111111'), entry['filename'])
+    with open(index_path) as f:
+      self.assertEqual(entry['filename'], json.load(f)['11111111111.mp3']['filename'])
+
+    # case 2 - gone for good
+    os.remove(os.path.join(self.directory, self.layout.shard_path('11111111111')))
+    self.assertIsNone(cache.get('11111111111'))
+    self.assertNotIn('11111111111.mp3', cache.entries)
+
+
+class ReshardTestCases(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.index_path = os.path.join(self.directory, 'index.json')
+    self.layout = StorageLayout(self.directory, sharded=True)
+    cache = OutputCache(self.directory, self.index_path)
+    for v_id, label in (('11111111111', 'Song'), ('22222222222', 'Song'), ('33333333333', 'Other')):
+      with open(os.path.join(self.directory, label+'.mp3'), 'wb') as f:
+        f.write(label.encode('utf-8'))
+      cache.put(v_id, label, label+'.mp3')
+    # Not in the index.
+    with open(os.path.join(self.directory, 'Unknown.mp3'), 'wb') as f:
+      f.write(b'x')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _exists(self, relpath):
+    return os.path.isfile(os.path.join(self.directory, relpath))
+
+  def test_flat_files(self):
+    files = reshard.flat_files(self.directory, self.index_path)
+    self.assertEqual({'Song.mp3', 'Other.mp3'}, set(files))
+    self.assertEqual({('11111111111', 'mp3'), ('22222222222', 'mp3')}, set(files['Song.mp3']))
+    self.assertEqual({}, reshard.flat_files(self.directory, os.path.join(self.directory, 'missing.json')))
+
+  def test_reshard(self):
+    files = reshard.flat_files(self.directory, self.index_path)
+
+    # case 1 - dry run touches nothing
+    self.assertEqual({'moved': 2, 'links': 3, 'failed': 0}, reshard.reshard(self.layout, files, dry_run=True))
+    self.assertTrue(self._exists('Song.mp3'))
+    self.assertFalse(self._exists(self.layout.shard_path('11111111111')))
+
+    # case 2 - every video gets its own copy, unknown files stay
+    self.assertEqual({'moved': 2, 'links': 3, 'failed': 0}, reshard.reshard(self.layout, files))
+    for v_id in ('11111111111', '22222222222', '33333333333'):
+      self.assertTrue(self._exists(self.layout.shard_path(v_id)))
+    self.assertFalse(self._exists('Song.mp3'))
+    self.assertFalse(self._exists('Other.mp3'))
+    self.assertTrue(self._exists('Unknown.mp3'))
+
+    # case 3 - the app finds them through the old index
+    cache = OutputCache(self.directory, self.index_path, locate=self.layout.locate)
+    self.assertEqual(self.layout.shard_path('22222222222'), cache.get('22222222222')['filename'])
+
+    # case 4 - running again finds nothing left to do
+    self.assertEqual({}, reshard.flat_files(self.directory, self.index_path))
+
+  def test_reshard_copy(self):
+    files = reshard.flat_files(self.directory, self.index_path)
+    shard = self.layout.shard_path('33333333333')
+    # What an interrupted copy left behind.
+    os.makedirs(os.path.dirname(os.path.join(self.directory, shard)))
+    with open(os.path.join(self.directory, shard), 'wb') as f:
+      f.write(b'Ot')
+
+    with patch.object(reshard.os, 'link', MagicMock(side_effect=OSError('not supported'))):
+      self.assertEqual({'moved': 2, 'links': 3, 'failed': 0}, reshard.reshard(self.layout, files))
+    with open(os.path.join(self.directory, shard), 'rb') as f:
+      self.assertEqual(b'Other', f.read())
+    # Copies only ever show up under their final name complete.
+    self.assertEqual(['33333333333.mp3'], os.listdir(os.path.dirname(os.path.join(self.directory, shard))))
+
+
+if __name__ == '__main__':
+  unittest.main()
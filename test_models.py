@@ -1,10 +1,67 @@
 #!/usr/bin/env python
 
-import unittest, time
+import sys, unittest, time
 from datetime import datetime
 from threading import Thread
 from unittest.mock import MagicMock, patch
-from app.models import User, Job, RuntimeData, RuntimeDataException
+from app.models import User, Job, JobRecord, RuntimeData, RuntimeDataException
+
+
+class JobRecordTestCases(unittest.TestCase):
+
+  def setUp(self):
+    self.mock_dict = dict(zip(RuntimeData.valid_keys, RuntimeData.default_values))
+    self.record = JobRecord()
+
+  def test_defaults(self):
+    self.assertEqual(self.mock_dict, self.record)
+    self.assertEqual(self.mock_dict, self.record.as_dict())
+
+  def test_dict_access(self):
+    # case 1 - known keys
+    self.record['label'] = 'Song'
+    self.assertEqual('Song', self.record['label'])
+    self.assertEqual('Song', self.record.get('label'))
+    self.assertIn('label', self.record)
+    self.assertEqual(list(RuntimeData.valid_keys), list(self.record))
+
+    # case 2 - unknown keys
+    self.assertRaises(KeyError, self.record.__getitem__, 'bad_key')
+    self.assertRaises(KeyError, self.record.__setitem__, 'bad_key', 1)
+    self.assertIsNone(self.record.get('bad_key'))
+    self.assertNotIn('bad_key', self.record)
+
+  def test_stage(self):
+    # case 1 - valid stages
+    for stage in RuntimeData.valid_stages:
+      self.record.stage = stage
+      self.assertEqual(stage, self.record['stage'])
+
+    # case 2 - invalid stage
+    with self.assertRaises(ValueError):
+      self.record['stage'] = 'bad_stage'
+    self.assertRaises(ValueError, JobRecord, stage=None)
+    self.assertEqual(RuntimeData.valid_stages[-1], self.record.stage)
+
+  def test_update(self):
+    # case 1 - happy path
+    self.record.update({'stage': 'download', 'prog': 0.5})
+    self.mock_dict.update({'stage': 'download', 'prog': 0.5})
+    self.assertEqual(self.mock_dict, self.record)
+
+    # case 2 - bad stage leaves the record untouched
+    self.assertRaises(ValueError, self.record.update, {'prog': 0.7, 'stage': 'bad_stage'})
+    self.assertEqual(self.mock_dict, self.record)
+
+  def test_equality(self):
+    self.assertEqual(JobRecord(id='1'), JobRecord(id='1'))
+    self.assertNotEqual(JobRecord(id='1'), JobRecord(id='2'))
+    self.assertNotEqual(self.record, 'not a job')
+
+  def test_footprint(self):
+    # No per instance dict, and a fraction of the size of the dict it replaces.
+    self.assertFalse(hasattr(self.record, '__dict__'))
+    self.assertLess(sys.getsizeof(self.record) * 2, sys.getsizeof(self.mock_dict))
 
 
 class RuntimeDataTestCases(unittest.TestCase):
@@ -153,6 +210,46 @@ class RuntimeDataTestCases(unittest.TestCase):
     self.dummy_rtd.getJob.assert_called_once_with(uid, jid)
     self.dummy_rtd.addNewJob.assert_called_once_with(uid, jid, unittest.mock.ANY)
 
+    # case 5 - expired job starts over
+    self.dummy_rtd.getJob = MagicMock(return_value={'stage': 'expired'})
+    self.dummy_rtd.addNewJob.reset_mock()
+    self.dummy_rtd.updateUser = MagicMock(return_value=True)
+    self.assertEqual(jid, self.dummy_rtd.createJob(uid, vid)[0])
+    self.assertFalse(self.dummy_rtd.addNewJob.called)
+    self.dummy_rtd.updateUser.assert_called_once_with(uid, {jid: unittest.mock.ANY})
+    self.assertEqual('init', self.dummy_rtd.updateUser.call_args[0][1][jid].stage)
+
+  def test_create_jobs(self):
+    uid = 1
+    existing_jid, ts = self.dummy_rtd.createJob(uid, '11111111111')
+    self.dummy_rtd._touch = MagicMock(wraps=self.dummy_rtd._touch)
+
+    # case 1 - new, existing and repeated jobs in one go
+    res = self.dummy_rtd.createJobs(uid, ['22222222222', '11111111111', '33333333333', '22222222222'])
+    jid_2, ts_2 = res[0]
+    jid_3, ts_3 = res[2]
+    self.assertEqual([(existing_jid, None), (jid_2, None)], [res[1], res[3]])
+    self.assertEqual(ts_2, ts_3)
+    self.assertEqual('22222222222', self.dummy_rtd.get_attribute(uid, jid_2, 'v_id'))
+    self.assertEqual('init', self.dummy_rtd.get_attribute(uid, jid_3, 'stage'))
+    # ...notifying about them all at once.
+    self.dummy_rtd._touch.assert_called_once_with(uid, unittest.mock.ANY)
+    self.assertEqual({jid_2, jid_3}, set(self.dummy_rtd._touch.call_args[0][1]))
+
+    # case 2 - expired jobs start over
+    self.dummy_rtd.set_attributes(uid, existing_jid, {'stage': 'expired', 'label': 'Song'})
+    res = self.dummy_rtd.createJobs(uid, ['11111111111', '22222222222'])
+    self.assertIsNotNone(res[0][1])
+    self.assertIsNone(res[1][1])
+    self.assertEqual('init', self.dummy_rtd.get_attribute(uid, existing_jid, 'stage'))
+    self.assertEqual('', self.dummy_rtd.get_attribute(uid, existing_jid, 'label'))
+    self.dummy_rtd._touch.reset_mock()
+
+    # case 3 - new user, nothing new
+    self.assertEqual([('', None)], self.dummy_rtd.createJobs(2, [None]))
+    self.assertEqual({}, self.dummy_rtd.getUser(2))
+    self.assertEqual(0, self.dummy_rtd._touch.call_count)
+
   def test_is_job_dict(self):
     mock_dict = {}
 
@@ -174,6 +271,16 @@ class RuntimeDataTestCases(unittest.TestCase):
     res = self.dummy_rtd._is_job_dict(mock_dict)
     self.assertFalse(res)
 
+    # case 5 - dict has an invalid stage
+    mock_dict = dict(zip(self.dummy_rtd.valid_keys, self.dummy_rtd.default_values))
+    mock_dict['stage'] = 'bad_stage'
+    res = self.dummy_rtd._is_job_dict(mock_dict)
+    self.assertFalse(res)
+
+    # case 6 - job record
+    res = self.dummy_rtd._is_job_dict(JobRecord())
+    self.assertTrue(res)
+
   def test_add_new_job(self):
     uid = 1
     jid = 50
@@ -392,6 +499,118 @@ class RuntimeDataTestCases(unittest.TestCase):
     self.assertDictEqual(expected, self.dummy_rtd.data[uid][jid])
     self.dummy_rtd.get_attribute.assert_called_once_with(uid, jid, key)
 
+  def test_set_attributes(self):
+    uid = 1
+    jid = 5
+    mock_job_data = dict(zip(self.dummy_rtd.valid_keys, self.dummy_rtd.default_values))
+
+    # case 1 - job does not exist
+    res = self.dummy_rtd.set_attributes(uid, jid, {'stage': 'done'})
+    self.assertFalse(res)
+
+    # ...prime the data structure so we can check it at the end.
+    self.dummy_rtd.data = {uid:{jid:mock_job_data}}
+    expected = mock_job_data.copy()
+
+    # case 2 - one attribute does not exist, nothing is changed
+    res = self.dummy_rtd.set_attributes(uid, jid, {'stage': 'done', 'some_key': 1})
+    self.assertFalse(res)
+    self.assertDictEqual(expected, self.dummy_rtd.data[uid][jid])
+
+    # case 3 - one bad value, nothing is changed
+    res = self.dummy_rtd.set_attributes(uid, jid, {'stage': 'done', 'prog': None})
+    self.assertFalse(res)
+    self.assertDictEqual(expected, self.dummy_rtd.data[uid][jid])
+
+    # case 4 - happy path
+    res = self.dummy_rtd.set_attributes(uid, jid, {'stage': 'done', 'prog': 1.0})
+    self.assertTrue(res)
+    expected.update({'stage': 'done', 'prog': 1.0})
+    self.assertDictEqual(expected, self.dummy_rtd.data[uid][jid])
+
+  def test_wait_for_changes(self):
+    uid = 1
+    jid_1, ts = self.dummy_rtd.createJob(uid, '11111111111')
+    jid_2, ts = self.dummy_rtd.createJob(uid, '22222222222')
+
+    # case 1 - no revision, get everything
+    rev, changed = self.dummy_rtd.wait_for_changes(uid)
+    self.assertEqual(2, rev)
+    self.assertEqual({jid_1, jid_2}, set(changed.keys()))
+    self.assertEqual(self.dummy_rtd.getJob(uid, jid_1), changed[jid_1])
+
+    # case 2 - nothing changed, times out
+    start = time.time()
+    res = self.dummy_rtd.wait_for_changes(uid, rev, 0.2)
+    self.assertGreaterEqual(time.time() - start, 0.2)
+    self.assertEqual((rev, {}), res)
+
+    # case 3 - only changed jobs are returned
+    self.dummy_rtd.set_attributes(uid, jid_1, {'stage': 'download', 'prog': 0.5})
+    new_rev, changed = self.dummy_rtd.wait_for_changes(uid, rev, 0)
+    self.assertGreater(new_rev, rev)
+    self.assertEqual([jid_1], list(changed.keys()))
+    self.assertEqual('download', changed[jid_1]['stage'])
+
+    # case 4 - deleted jobs show up as None
+    rev = new_rev
+    self.dummy_rtd.delJob(uid, jid_2)
+    rev, changed = self.dummy_rtd.wait_for_changes(uid, rev, 0)
+    self.assertEqual({jid_2: None}, changed)
+
+    # case 5 - other users' changes don't count
+    self.dummy_rtd.createJob(2, '11111111111')
+    self.assertEqual((rev, {}), self.dummy_rtd.wait_for_changes(uid, rev, 0))
+
+  def test_tombstones(self):
+    rtd = RuntimeData(tombstone_ttl=0.1)
+    uid = 1
+    jid_1, ts = rtd.createJob(uid, '11111111111')
+    jid_2, ts = rtd.createJob(uid, '22222222222')
+    rev, changed = rtd.wait_for_changes(uid)
+
+    # case 1 - deletions are passed on for a while...
+    rtd.delJob(uid, jid_1)
+    self.assertEqual({jid_1: None}, rtd.wait_for_changes(uid, rev, 0)[1])
+    self.assertIn(jid_1, rtd.changes[uid])
+
+    # case 2 - ...then forgotten
+    time.sleep(0.2)
+    rtd.set_attribute(uid, jid_2, 'prog', 0.5)
+    self.assertEqual({jid_2}, set(rtd.changes[uid]))
+    self.assertNotIn(uid, rtd.tombstones)
+
+    # case 3 - streams that far behind get everything
+    new_rev, changed = rtd.wait_for_changes(uid, rev, 0)
+    self.assertEqual(rtd.revs[uid], new_rev)
+    self.assertEqual({jid_2}, set(changed))
+
+    # case 4 - up to date streams only get what changed
+    rtd.set_attribute(uid, jid_2, 'prog', 0.6)
+    self.assertEqual(0.6, rtd.wait_for_changes(uid, new_rev, 0)[1][jid_2]['prog'])
+
+    # case 5 - created again after the deletion, kept
+    rtd.delJob(uid, jid_2)
+    rtd.createJob(uid, '22222222222')
+    time.sleep(0.2)
+    rtd.set_attribute(uid, jid_2, 'prog', 0.1)
+    self.assertIn(jid_2, rtd.changes[uid])
+
+  def test_z_threaded_wait_for_changes(self):
+    uid = 1
+    jid, ts = self.dummy_rtd.createJob(uid, '11111111111')
+    rev, changed = self.dummy_rtd.wait_for_changes(uid)
+    res = []
+
+    t = Thread(target=lambda: res.append(self.dummy_rtd.wait_for_changes(uid, rev, 5)))
+    t.start()
+    time.sleep(0.2)
+    self.assertTrue(t.is_alive())
+    self.dummy_rtd.set_attribute(uid, jid, 'prog', 0.5)
+    t.join(1)
+    self.assertFalse(t.is_alive())
+    self.assertEqual(0.5, res[0][1][jid]['prog'])
+
   #######################
   ### Real World Test ###
   #######################
@@ -427,7 +646,7 @@ class RuntimeDataTestCases(unittest.TestCase):
     self.assertDictEqual(expected_user_data_1, res)
 
     res = self.dummy_rtd.getJob(uid_1, jid_1)
-    self.assertDictEqual(expected_job_data_1, res)
+    self.assertEqual(expected_job_data_1, res)
 
     # update job data
     expected_job_data_1['stage'] = 'done'
@@ -436,7 +655,7 @@ class RuntimeDataTestCases(unittest.TestCase):
 
     # verify update to job
     res = self.dummy_rtd.getJob(uid_1, jid_1)
-    self.assertDictEqual(expected_job_data_1, res)
+    self.assertEqual(expected_job_data_1, res)
 
     # verify update to user
     expected_user_data_1.update({jid_1:expected_job_data_1})
@@ -467,9 +686,9 @@ class RuntimeDataTestCases(unittest.TestCase):
     self.assertDictEqual(expected_user_data_2, res)
 
     res = self.dummy_rtd.getJob(uid_1, jid_1)
-    self.assertDictEqual(expected_job_data_1, res)
+    self.assertEqual(expected_job_data_1, res)
     res = self.dummy_rtd.getJob(uid_2, jid_2)
-    self.assertDictEqual(expected_job_data_2, res)
+    self.assertEqual(expected_job_data_2, res)
 
     # delete user 1
     expected_del = expected_data.pop(uid_1)
@@ -505,7 +724,7 @@ class RuntimeDataTestCases(unittest.TestCase):
     # delete job 1 for user 2
     expected_del = expected_user_data_2.pop(jid_2)
     res = self.dummy_rtd.delJob(uid_2, jid_2)
-    self.assertDictEqual(expected_del, res)
+    self.assertEqual(expected_del, res)
 
     # verify job deletion
     res = self.dummy_rtd.getUser(uid_2)
@@ -514,7 +733,9 @@ class RuntimeDataTestCases(unittest.TestCase):
     self.assertIsNone(res)
 
     # test get/set attribute
-    new_value = 'new_value'
+    res = self.dummy_rtd.set_attribute(uid_2, jid_3, 'stage', 'new_value')
+    self.assertFalse(res)
+    new_value = 'download'
     res = self.dummy_rtd.set_attribute(uid_2, jid_3, 'stage', new_value)
     self.assertTrue(res)
 
@@ -535,11 +756,11 @@ class RuntimeDataTestCases(unittest.TestCase):
 
     t = Thread(target=self.dummy_rtd.set_attribute, args=(uid, jid, key, new_value))
 
-    self.dummy_rtd.data_lock.acquire()
+    self.dummy_rtd._user_lock(uid).acquire()
     t.start()
     time.sleep(1)
     self.assertTrue(t.is_alive())
-    self.dummy_rtd.data_lock.release()
+    self.dummy_rtd._user_lock(uid).release()
     t.join()
     self.assertFalse(t.is_alive())
 
@@ -547,6 +768,50 @@ class RuntimeDataTestCases(unittest.TestCase):
     mock_job_data[key]=new_value
     self.assertDictEqual(mock_job_data, self.dummy_rtd.data[uid][jid])
 
+  def _contention_run(self, rtd, num_users, num_updates, hold_time):
+    """
+    User 0 holds its lock for hold_time seconds (a slow reader), meanwhile one
+    worker thread per other user records num_updates progress ticks. Returns the
+    number of ticks recorded while user 0's lock was held and the total time.
+    """
+    jobs = [rtd.createJob(uid, '99999999999')[0] for uid in range(num_users)]
+    recorded = [0] * num_users
+    holding = True
+
+    def worker(uid, jid):
+      for i in range(num_updates):
+        rtd.set_attributes(uid, jid, {'prog': i / num_updates, 'timestamp': time.time()})
+        if holding:
+          recorded[uid] += 1
+
+    threads = [Thread(target=worker, args=(uid, jobs[uid])) for uid in range(1, num_users)]
+    start = time.time()
+    with rtd._user_lock(0):
+      for t in threads:
+        t.start()
+      time.sleep(hold_time)
+      holding = False
+    for t in threads:
+      t.join()
+    return sum(recorded), time.time() - start
+
+  def test_z_threaded_contention_benchmark(self):
+    num_users = 16
+    num_updates = 2000
+    hold_time = 0.5
+
+    # One stripe is the same as a single global lock.
+    global_ticks, global_time = self._contention_run(RuntimeData(stripes=1), num_users, num_updates, hold_time)
+    striped_ticks, striped_time = self._contention_run(RuntimeData(stripes=64), num_users, num_updates, hold_time)
+    print('\n  {} workers x {} updates, one user held for {}s:'.format(num_users-1, num_updates, hold_time))
+    print('  global lock:  {:6d} updates while held, {:.3f}s total'.format(global_ticks, global_time))
+    print('  striped lock: {:6d} updates while held, {:.3f}s total'.format(striped_ticks, striped_time))
+
+    # Nobody gets anything done while the global lock is held...
+    self.assertEqual(0, global_ticks)
+    # ...while with striping unrelated users never wait on it.
+    self.assertGreater(striped_ticks, 0)
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import time, unittest
+from threading import Event
+from unittest.mock import MagicMock
+from app.models import AuthUser
+from app.playlist import PlaylistProvider, PlaylistExpander, extract_list_id
+
+
+class FakePlaylistProvider(PlaylistProvider):
+  """Lists made up playlists of <size> videos, page_delay seconds per page."""
+
+  def __init__(self, size, page_size=50, page_delay=0.0):
+    self.size = size
+    self.page_size = page_size
+    self.page_delay = page_delay
+    self.fetched = [] # (list_id, page) of every page handed out.
+
+  def pages(self, list_id):
+    if list_id == 'PLbroken':
+      raise IOError('No such playlist.')
+    for start in range(0, self.size, self.page_size):
+      time.sleep(self.page_delay)
+      page = ['{:011d}'.format(i) for i in range(start, min(start + self.page_size, self.size))]
+      self.fetched.append((list_id, len(self.fetched)))
+      yield page
+
+
+class PlaylistTestCases(unittest.TestCase):
+
+  def setUp(self):
+    self.user = AuthUser(1, 'tom')
+    self.spawned = []
+    self.provider = FakePlaylistProvider(120)
+    self.expander = PlaylistExpander(self.provider, self._spawn)
+
+  def tearDown(self):
+    self.expander.stop()
+
+  def _spawn(self, user, v_ids):
+    self.spawned.append((user, v_ids))
+    return [{'link': v_id, 'result': 'created'} for v_id in v_ids]
+
+  def _wait(self, list_id, timeout=5):
+    end = time.time() + timeout
+    while self.expander.get(self.user.id, list_id)['stage'] == 'expanding' and time.time() < end:
+      time.sleep(0.01)
+    return self.expander.get(self.user.id, list_id)
+
+  def test_extract_list_id(self):
+    # case 1 - playlist links
+    self.assertEqual('PLabc-_123', extract_list_id('https://www.youtube.com/playlist?list=PLabc-_123'))
+    self.assertEqual('PLabc', extract_list_id('youtube.com/watch?v=11111111111&list=PLabc&index=2'))
+    self.assertEqual('UU1234', extract_list_id('www.youtube.com/playlist?list=UU1234'))
+
+    # case 2 - no playlist
+    self.assertIsNone(extract_list_id('www.youtube.com/watch?v=11111111111'))
+    self.assertIsNone(extract_list_id('www.youtube.com/playlist?list=XX1234'))
+    self.assertIsNone(extract_list_id('www.youtube.com/playlist?blacklist=PL1234'))
+
+  def test_expand(self):
+    state = self.expander.expand(self.user, 'PL1')
+    self.assertEqual('expanding', state['stage'])
+
+    state = self._wait('PL1')
+    expected = {'list_id': 'PL1', 'stage': 'done', 'pages': 3, 'entries': 120, 'created': 120, 'error': None}
+    self.assertEqual(expected, state)
+    # One spawn per page, in playlist order.
+    self.assertEqual([50, 50, 20], [len(v_ids) for user, v_ids in self.spawned])
+    self.assertEqual(['{:011d}'.format(i) for i in range(120)], sum((v_ids for user, v_ids in self.spawned), []))
+    self.assertEqual({self.user}, {user for user, v_ids in self.spawned})
+
+    # case 2 - unknown expansions
+    self.assertIsNone(self.expander.get(self.user.id, 'PL2'))
+    self.assertIsNone(self.expander.get(2, 'PL1'))
+
+  def test_lazy(self):
+    # The first page is spawned long before the listing is done.
+    first_spawn = Event()
+    self.expander.spawn = lambda user, v_ids: first_spawn.set() or self._spawn(user, v_ids)
+    self.provider.size = 1000
+    self.provider.page_delay = 0.05
+
+    start = time.time()
+    self.expander.expand(self.user, 'PL1')
+    self.assertTrue(first_spawn.wait(1.0))
+    self.assertLess(time.time() - start, 1.0)
+    self.assertEqual('expanding', self.expander.get(self.user.id, 'PL1')['stage'])
+    self.assertLess(len(self.provider.fetched), 20)
+
+    self.assertEqual(1000, self._wait('PL1')['created'])
+
+  def test_expand_twice(self):
+    self.provider.page_delay = 0.05
+    self.expander.expand(self.user, 'PL1')
+
+    # case 1 - still expanding, nothing new happens
+    self.assertEqual('expanding', self.expander.expand(self.user, 'PL1')['stage'])
+    self._wait('PL1')
+    self.assertEqual(3, len(self.spawned))
+
+    # case 2 - done, expanding again picks up whatever was added since
+    self.expander.expand(self.user, 'PL1')
+    self.assertEqual('done', self._wait('PL1')['stage'])
+    self.assertEqual(6, len(self.spawned))
+
+  def test_max_entries(self):
+    self.expander.max_entries = 70
+    self.expander.expand(self.user, 'PL1')
+    state = self._wait('PL1')
+    self.assertEqual(('done', 70), (state['stage'], state['entries']))
+    self.assertEqual([50, 20], [len(v_ids) for user, v_ids in self.spawned])
+    self.assertEqual(2, len(self.provider.fetched))
+
+  def test_error(self):
+    with self.assertLogs('app.playlist', 'ERROR'):
+      self.expander.expand(self.user, 'PLbroken')
+      state = self._wait('PLbroken')
+    self.assertEqual(('error', 'No such playlist.'), (state['stage'], state['error']))
+    self.assertEqual([], self.spawned)
+
+  def test_stop(self):
+    self.provider.page_delay = 0.05
+    self.expander.expand(self.user, 'PL1')
+    self.expander.stop()
+    # Whatever page it was on is not spawned anymore.
+    self.assertLess(len(self.spawned), 3)
+    self.assertEqual(len(self.spawned), self.expander.get(self.user.id, 'PL1')['pages'])
+
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+import os, sys, time, unittest, tempfile, shutil, threading
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from unittest.mock import MagicMock, patch
+from app import ripper
+from app.cache import MetadataCache
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+
+  def log_message(self, format, *args):
+    pass
+
+
+class LocalServer():
+  """Serves files from a temp directory, stands in for the video host."""
+
+  def __init__(self, directory):
+    handler = lambda *args, **kwargs: QuietHandler(*args, directory=directory, **kwargs)
+    self.httpd = HTTPServer(('127.0.0.1', 0), handler)
+    self.thread = threading.Thread(target=self.httpd.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def url(self, filename):
+    return 'http://127.0.0.1:{}/{}'.format(self.httpd.server_port, filename)
+
+  def stop(self):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+
+
+class StreamConvertTestCases(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.payload = os.urandom(200 * 1024)
+    with open(os.path.join(self.directory, 'source.webm'), 'wb') as f:
+      f.write(self.payload)
+    self.server = LocalServer(self.directory)
+    self.audio = MagicMock()
+    self.audio.url = self.server.url('source.webm')
+    self.new_file = os.path.join(self.directory, 'out.mp3')
+
+  def tearDown(self):
+    self.server.stop()
+    shutil.rmtree(self.directory)
+
+  def _fake_encoder(self, script):
+    # Stand in for ffmpeg, the "encoder" just works on raw bytes.
+    return lambda new_file: [sys.executable, '-c', script, new_file]
+
+  def test_stream_convert(self):
+    copy = 'import sys, shutil; shutil.copyfileobj(sys.stdin.buffer, open(sys.argv[1], "wb"))'
+    callback = MagicMock()
+
+    with patch.object(ripper, '_stream_cmd', self._fake_encoder(copy)):
+      ripper.stream_convert(self.audio, self.new_file, callback)
+
+    with open(self.new_file, 'rb') as f:
+      self.assertEqual(self.payload, f.read())
+    # Progress is reported in download() terms and ends at 100%.
+    total, recvd, ratio, rate, eta = callback.call_args[0]
+    self.assertEqual(len(self.payload), total)
+    self.assertEqual(len(self.payload), recvd)
+    self.assertEqual(1.0, ratio)
+    self.assertGreater(callback.call_count, 1)
+    # Nothing but the output was written.
+    self.assertEqual(['out.mp3', 'source.webm'], sorted(os.listdir(self.directory)))
+
+  def test_stream_convert_encoder_fails(self):
+    fail = 'import sys; open(sys.argv[1], "wb"); sys.stdin.buffer.read(); sys.exit("bad input")'
+
+    with patch.object(ripper, '_stream_cmd', self._fake_encoder(fail)):
+      with self.assertRaises(Exception) as cm:
+        ripper.stream_convert(self.audio, self.new_file, None)
+    self.assertIn('bad input', str(cm.exception))
+    self.assertFalse(os.path.exists(self.new_file))
+
+  def test_stream_convert_encoder_quits_early(self):
+    quit = 'import sys; sys.exit("unknown format")'
+    # Bigger than any pipe buffer, so writing to the dead encoder fails.
+    with open(os.path.join(self.directory, 'source.webm'), 'wb') as f:
+      f.write(os.urandom(1024 * 1024))
+
+    with patch.object(ripper, '_stream_cmd', self._fake_encoder(quit)):
+      with self.assertRaises(Exception) as cm:
+        ripper.stream_convert(self.audio, self.new_file, None)
+    self.assertNotIsInstance(cm.exception, BrokenPipeError)
+    self.assertIn('unknown format', str(cm.exception))
+
+  def test_stream_convert_chatty_encoder(self):
+    # Writes far more to stderr than a pipe holds before it reads any input.
+    chatty = ('import sys, shutil; sys.stderr.write("x" * 1024 * 1024); sys.stderr.flush(); '
+              'shutil.copyfileobj(sys.stdin.buffer, open(sys.argv[1], "wb"))')
+
+    with patch.object(ripper, '_stream_cmd', self._fake_encoder(chatty)):
+      ripper.stream_convert(self.audio, self.new_file, None)
+    with open(self.new_file, 'rb') as f:
+      self.assertEqual(self.payload, f.read())
+
+  def test_stream_convert_download_fails(self):
+    copy = 'import sys, shutil; shutil.copyfileobj(sys.stdin.buffer, open(sys.argv[1], "wb"))'
+    self.audio.url = self.server.url('missing.webm')
+
+    with patch.object(ripper, '_stream_cmd', self._fake_encoder(copy)):
+      self.assertRaises(Exception, ripper.stream_convert, self.audio, self.new_file, None)
+    self.assertFalse(os.path.exists(self.new_file))
+
+
+class ResolveTestCases(unittest.TestCase):
+
+  def setUp(self):
+    self.video = MagicMock()
+    self.video.title = 'Ellie Goulding - Love Me Like You Do (Official Video)'
+    best = self.video.getbestaudio.return_value
+    self.expire = int(time.time()) + 600
+    best.url = 'https://host/videoplayback?id=1&expire={}&sig=x'.format(self.expire)
+    best.extension = 'webm'
+    best.get_filesize.return_value = 1234
+    self.cache = MetadataCache()
+
+  def test_resolve(self):
+    with patch.object(ripper.pafy, 'new', return_value=self.video) as mock_new:
+      # case 1 - first lookup goes upstream
+      meta = ripper.resolve('11111111111', self.cache)
+      self.assertEqual('Ellie Goulding - Love Me Like You Do', meta.label)
+      self.assertEqual('webm', meta.audio.extension)
+      self.assertEqual(1234, meta.audio.get_filesize())
+
+      # case 2 - repeat lookups don't
+      self.assertIs(meta, ripper.resolve('11111111111', self.cache))
+      self.assertEqual(1, mock_new.call_count)
+      self.assertEqual(0.5, self.cache.stats()['hit_rate'])
+
+      # case 3 - no cache
+      ripper.resolve('11111111111')
+      self.assertEqual(2, mock_new.call_count)
+
+    # Entries don't outlive the stream url.
+    value, expiry = self.cache.entries['11111111111']
+    self.assertEqual(self.expire - ripper.stream_expiry_margin, expiry)
+
+  def test_stream_expiry(self):
+    self.assertEqual(100 - ripper.stream_expiry_margin, ripper._stream_expiry('https://host/a?expire=100&b=2'))
+    self.assertIsNone(ripper._stream_expiry('https://host/a?b=2'))
+
+  def test_failed_download_forgets(self):
+    tracker = MagicMock()
+    with patch.object(ripper.pafy, 'new', return_value=self.video), \
+         patch.object(ripper, 'download', side_effect=Exception('403 Forbidden')):
+      self.assertIsNone(ripper.fetchaudio('11111111111', tempfile.gettempdir(), tracker, cache=self.cache))
+    tracker.handle_error.assert_called_once()
+    # A retry resolves the video again instead of reusing a stale stream url.
+    self.assertNotIn('11111111111', self.cache.entries)
+
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+import unittest, time
+from threading import Event, Lock
+from app.scheduler import JobScheduler
+
+
+class JobSchedulerTestCases(unittest.TestCase):
+
+  def setUp(self):
+    self.release = Event()
+    self.lock = Lock()
+    self.running = 0
+    self.max_running = 0
+    self.finished = []
+    self.scheduler = JobScheduler(self._dummy_job, workers=2)
+
+  def tearDown(self):
+    self.release.set()
+    self.scheduler.stop()
+
+  def _dummy_job(self, j_id):
+    with self.lock:
+      self.running += 1
+      self.max_running = max(self.max_running, self.running)
+    self.release.wait(5)
+    with self.lock:
+      self.running -= 1
+      self.finished.append(j_id)
+
+  def _wait_for(self, predicate, timeout=5):
+    end = time.time() + timeout
+    while time.time() < end:
+      if predicate():
+        return True
+      time.sleep(0.01)
+    return False
+
+  def test_start(self):
+    # case 1 - happy path
+    self.assertTrue(self.scheduler.start())
+    self.assertEqual(2, len(self.scheduler.workers))
+
+    # case 2 - already running
+    self.assertFalse(self.scheduler.start())
+    self.assertEqual(2, len(self.scheduler.workers))
+
+  def test_position_and_cancel(self):
+    # Workers not started, so everything stays queued.
+    for j_id in range(3):
+      self.scheduler.submit(1, j_id, j_id)
+
+    # case 1 - queued jobs
+    self.assertEqual(1, self.scheduler.position(1, 0))
+    self.assertEqual(3, self.scheduler.position(1, 2))
+
+    # case 2 - unknown job
+    self.assertIsNone(self.scheduler.position(2, 0))
+    self.assertFalse(self.scheduler.cancel(2, 0))
+
+    # case 3 - cancel moves everything behind it up
+    self.assertTrue(self.scheduler.cancel(1, 0))
+    self.assertIsNone(self.scheduler.position(1, 0))
+    self.assertEqual(2, self.scheduler.position(1, 2))
+
+    # case 4 - take hands back the job's arguments
+    self.assertEqual((1,), self.scheduler.take(1, 1))
+    self.assertIsNone(self.scheduler.take(1, 1))
+    self.assertEqual(1, self.scheduler.position(1, 2))
+
+    # case 5 - cancelling near the front and near the back of a long queue
+    for j_id in range(3, 10):
+      self.scheduler.submit(1, j_id, j_id)
+    self.assertTrue(self.scheduler.cancel(1, 3))
+    self.assertTrue(self.scheduler.cancel(1, 8))
+    expected = [2, 4, 5, 6, 7, 9]
+    self.assertEqual(expected, [item[0] for item in self.scheduler.queues[1]])
+    self.assertEqual(list(range(1, 7)), [self.scheduler.position(1, j_id) for j_id in expected])
+
+  def test_z_bounded_pool(self):
+    num_jobs = 6
+    self.scheduler.start()
+    for j_id in range(num_jobs):
+      self.scheduler.submit(1, j_id, j_id)
+
+    # Only two jobs are picked up, the rest wait their turn.
+    self.assertTrue(self._wait_for(lambda: self.running == 2))
+    time.sleep(0.1)
+    self.assertEqual(2, self.running)
+    self.assertEqual(1, self.scheduler.position(1, 2))
+
+    self.release.set()
+    self.assertTrue(self._wait_for(lambda: len(self.finished) == num_jobs))
+    self.assertEqual(2, self.max_running)
+    self.assertEqual(list(range(num_jobs)), sorted(self.finished))
+
+  def test_stats(self):
+    # case 1 - unknown user
+    self.assertEqual({'active': 0, 'queued': 0}, self.scheduler.stats(1))
+
+    # case 2 - queued jobs
+    self.scheduler.submit(1, 1, 1)
+    self.scheduler.submit(1, 2, 2)
+    self.assertEqual({'active': 0, 'queued': 2}, self.scheduler.stats(1))
+
+    # case 3 - picked job counts as active
+    self.scheduler._pick()
+    self.assertEqual({'active': 1, 'queued': 1}, self.scheduler.stats(1))
+
+  def test_round_robin_pick(self):
+    for j_id in range(4):
+      self.scheduler.submit(1, j_id)
+    self.scheduler.submit(2, 10)
+    self.scheduler.submit(3, 20)
+    self.scheduler.max_active = 100
+    self.scheduler.max_per_user = 100
+
+    picked = []
+    item = self.scheduler._pick()
+    while item is not None:
+      picked.append(item[:2])
+      item = self.scheduler._pick()
+    expected = [(1, 0), (2, 10), (3, 20), (1, 1), (1, 2), (1, 3)]
+    self.assertEqual(expected, picked)
+
+  def test_weighted_pick(self):
+    for j_id in range(4):
+      self.scheduler.submit(1, j_id)
+      self.scheduler.submit(2, 10+j_id)
+    self.scheduler.weights = {1: 3}
+    self.scheduler.max_active = 100
+    self.scheduler.max_per_user = 100
+
+    picked = [self.scheduler._pick()[:2] for i in range(6)]
+    expected = [(1, 0), (1, 1), (1, 2), (2, 10), (1, 3), (2, 11)]
+    self.assertEqual(expected, picked)
+
+  def test_limits(self):
+    for j_id in range(3):
+      self.scheduler.submit(1, j_id)
+    self.scheduler.submit(2, 10)
+    self.scheduler.submit(3, 20)
+    self.scheduler.max_active = 3
+    self.scheduler.max_per_user = 1
+
+    # case 1 - per user limit skips user 1 once it has an active job
+    picked = [self.scheduler._pick()[:2] for i in range(3)]
+    self.assertEqual([(1, 0), (2, 10), (3, 20)], picked)
+
+    # case 2 - global limit reached
+    self.scheduler.max_per_user = 5
+    self.assertIsNone(self.scheduler._pick())
+
+    # case 3 - a finished job frees up a slot
+    self.scheduler._finished(2)
+    self.assertEqual((1, 1), self.scheduler._pick()[:2])
+
+  def test_z_fair_share(self):
+    self.scheduler = JobScheduler(self._dummy_job, workers=1)
+    self.release.set()
+    for j_id in range(10):
+      self.scheduler.submit(1, j_id, (1, j_id))
+    self.scheduler.submit(2, 0, (2, 0))
+    self.scheduler.start()
+    self.assertTrue(self._wait_for(lambda: len(self.finished) == 11))
+    # User 2 doesn't have to wait for all of user 1's jobs.
+    self.assertEqual((2, 0), self.finished[1])
+
+  def test_z_failing_job(self):
+    self.scheduler = JobScheduler(lambda: 1/0, workers=1)
+    self.scheduler.start()
+    self.scheduler.submit(1, 1)
+    self.scheduler.submit(1, 2)
+    # The worker survives the first failure and drains the queue.
+    self.assertTrue(self._wait_for(lambda: not self.scheduler.queues))
+    self.assertTrue(self.scheduler.workers[0].is_alive())
+
+
+
+if __name__ == '__main__':
+  unittest.main()
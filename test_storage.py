@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+import os, json, time, unittest, tempfile, shutil
+from unittest.mock import MagicMock, patch
+from app.storage import StorageManager
+
+
+class StorageManagerTestCases(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.on_evict = MagicMock()
+    self.storage = StorageManager(self.directory, max_bytes=3000, on_evict=self.on_evict)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _write(self, name, size=1000):
+    with open(os.path.join(self.directory, name), 'wb') as f:
+      f.write(b'x' * size)
+
+  def _files(self):
+    return sorted(os.listdir(self.directory))
+
+  def test_evict_lru(self):
+    for name in ('a.mp3', 'b.mp3', 'c.mp3'):
+      self._write(name)
+      self.assertEqual([], self.storage.add(name, [(1, name)]))
+    self.assertEqual(3000, self.storage.stats()['bytes'])
+
+    # case 1 - the least recently downloaded file goes first
+    self.storage.touch('a.mp3')
+    self._write('d.mp3')
+    self.assertEqual(['b.mp3'], self.storage.add('d.mp3'))
+    self.assertEqual(['a.mp3', 'c.mp3', 'd.mp3'], self._files())
+    self.on_evict.assert_called_once_with('b.mp3', {(1, 'b.mp3')})
+
+    # case 2 - as many as it takes
+    self._write('e.mp3', 2500)
+    self.assertEqual(['c.mp3', 'a.mp3', 'd.mp3'], self.storage.add('e.mp3'))
+    self.assertEqual(['e.mp3'], self._files())
+    expected = {'files': 1, 'bytes': 2500, 'max_bytes': 3000, 'evicted': 4, 'swept': 0}
+    self.assertEqual(expected, self.storage.stats())
+
+    # case 3 - a file bigger than the budget is still kept
+    self._write('f.mp3', 5000)
+    self.assertEqual(['e.mp3'], self.storage.add('f.mp3'))
+    self.assertEqual(['f.mp3'], self._files())
+
+  def test_owners(self):
+    self._write('a.mp3')
+    self.storage.add('a.mp3', [(1, '1')])
+    self.storage.add('a.mp3', [(2, '1')])
+    self.assertTrue(self.storage.claim('a.mp3', (3, '1')))
+    self.assertFalse(self.storage.claim('missing.mp3', (3, '1')))
+
+    self.storage.max_bytes = 0
+    self._write('b.mp3')
+    self.storage.add('b.mp3')
+    self.on_evict.assert_called_once_with('a.mp3', {(1, '1'), (2, '1'), (3, '1')})
+
+  def test_scan(self):
+    self._write('old.mp3')
+    self._write('older.mp3')
+    self._write('source.webm')
+    past = time.time() - 100
+    os.utime(os.path.join(self.directory, 'older.mp3'), (past, past))
+
+    # Only finished files count, oldest access first.
+    self.assertEqual(2, self.storage.scan())
+    self.storage.max_bytes = 1500
+    self._write('new.mp3', 100)
+    self.assertEqual(['older.mp3'], self.storage.add('new.mp3'))
+
+  def test_index(self):
+    index_path = os.path.join(self.directory, 'index.json')
+    storage = StorageManager(self.directory, index_path=index_path, save_interval=0)
+    self.assertFalse(storage.load())
+    self._write('a.mp3')
+    self._write('b.mp3', 500)
+    storage.add('a.mp3')
+    storage.add('b.mp3')
+    storage.touch('a.mp3')
+
+    # case 1 - a restart reads the index instead of the directory
+    restarted = StorageManager(self.directory, index_path=index_path)
+    with patch.object(os, 'walk') as mock_walk, patch.object(os, 'stat') as mock_stat:
+      self.assertTrue(restarted.load())
+    mock_walk.assert_not_called()
+    mock_stat.assert_not_called()
+    self.assertEqual(1500, restarted.stats()['bytes'])
+    self.assertGreater(restarted.entries['a.mp3']['last_access'], restarted.entries['b.mp3']['last_access'])
+
+    # case 2 - access times alone are saved at most every save_interval
+    restarted.save_interval = 3600
+    restarted.touch('b.mp3')
+    with open(index_path) as f:
+      self.assertEqual(storage.entries['b.mp3']['last_access'], json.load(f)['b.mp3'][1])
+    self.assertNotEqual(storage.entries['b.mp3']['last_access'], restarted.entries['b.mp3']['last_access'])
+
+    # case 3 - files finished after the last save are picked up when claimed
+    self._write('c.mp3')
+    self.assertTrue(restarted.claim('c.mp3', (1, '1')))
+    self.assertEqual(2500, restarted.stats()['bytes'])
+
+  def test_sweep(self):
+    self._write('a.mp3')
+    self._write('gone.mp3')
+    self.storage.add('a.mp3')
+    self.storage.add('gone.mp3')
+    os.remove(os.path.join(self.directory, 'gone.mp3'))
+    self._write('new.mp3')
+    self._write('old.webm')
+    self._write('old.webm.part')
+    self._write('old.webm.part.json', 10)
+    self._write('fresh.webm.part')
+    past = time.time() - 1000
+    for name in ('old.webm', 'old.webm.part', 'old.webm.part.json'):
+      os.utime(os.path.join(self.directory, name), (past, past))
+
+    # Finished files are reconciled, stale intermediate files deleted.
+    self.assertEqual(3, self.storage.sweep(max_age=100))
+    self.assertEqual(['a.mp3', 'fresh.webm.part', 'new.mp3'], self._files())
+    self.assertEqual({'a.mp3', 'new.mp3'}, set(self.storage.entries))
+    self.assertEqual(2000, self.storage.stats()['bytes'])
+    self.assertEqual(3, self.storage.stats()['swept'])
+
+  def test_sweeper_thread(self):
+    self._write('old.webm.part')
+    past = time.time() - 1000
+    os.utime(os.path.join(self.directory, 'old.webm.part'), (past, past))
+    self.assertTrue(self.storage.start(interval=3600, max_age=100))
+    self.assertFalse(self.storage.start(interval=3600, max_age=100))
+    for i in range(100):
+      if not self._files():
+        break
+      time.sleep(0.01)
+    self.storage.stop()
+    self.assertEqual([], self._files())
+    self.assertFalse(self.storage.thread.is_alive())
+
+  def test_discard(self):
+    self._write('source.webm')
+    self.assertTrue(self.storage.discard(os.path.join(self.directory, 'source.webm')))
+    self.assertFalse(self.storage.discard(os.path.join(self.directory, 'source.webm')))
+    self.assertEqual([], self._files())
+    # Unknown files are never recorded.
+    self.assertEqual([], self.storage.add('missing.mp3'))
+    self.assertFalse(self.storage.touch('missing.mp3'))
+
+  def test_evict_errors(self):
+    self._write('a.mp3')
+    self.storage.add('a.mp3', [(1, '1')])
+    os.remove(os.path.join(self.directory, 'a.mp3'))
+    self.on_evict.side_effect = Exception('boom')
+    self.storage.max_bytes = 0
+    self._write('b.mp3')
+    with self.assertLogs('app.storage', 'WARNING') as logs:
+      self.assertEqual(['a.mp3'], self.storage.add('b.mp3'))
+    self.assertEqual(2, len(logs.records))
+
+  def test_heap_stays_small(self):
+    self.storage.max_bytes = None
+    for i in range(100):
+      self._write('{}.mp3'.format(i), 10)
+      self.storage.add('{}.mp3'.format(i))
+    for i in range(10000):
+      self.storage.touch('{}.mp3'.format(i % 100))
+    self.assertLessEqual(len(self.storage.heap), 2 * 100 + 64)
+
+    # Stale heap items don't confuse eviction.
+    self.storage.max_bytes = 500
+    self._write('new.mp3', 10)
+    evicted = self.storage.add('new.mp3')
+    self.assertEqual(['{}.mp3'.format(i) for i in range(51)], evicted)
+
+  def test_z_eviction_speed(self):
+    num_files = 100000
+    self.storage.max_bytes = None
+    for i in range(num_files):
+      self.storage._record('{}.mp3'.format(i), 10, i)
+    self.storage.max_bytes = 10 * num_files
+    self._write('new.mp3', 10)
+
+    start = time.time()
+    for i in range(1000):
+      self.storage.touch('{}.mp3'.format(i))
+    evicted = self.storage.add('new.mp3')
+    elapsed = time.time() - start
+    print('\nTouched 1000 and evicted {} of {} files in {:.3f}s'.format(len(evicted), num_files, elapsed))
+    self.assertEqual(['1000.mp3'], evicted)
+    self.assertLess(elapsed, 0.1)
+
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import re, time, random, unittest
+from app import ripper, titles
+from app.titles import Normalizer
+
+
+# What ripper used to do, kept to check the rule tables against.
+def old_parsechannel(text):
+  t = re.sub('vevo$', '', text, flags=re.I)
+  t = re.sub('tv$', '', t, flags=re.I)
+  if not re.search('^UKF', t):
+    t = ' '.join(re.findall('[A-Z][^A-Z\\s]*', t))
+  return t
+
+def old_parsetitle(text):
+  bracket_keywords=('monstercat', 'release', 'official', 'music', 'video', 'audio')
+  splits = re.split(r'-', text)
+  for i in range(len(splits)):
+    splits[i] = re.sub('^\\[.*\\]\\s*', '', splits[i])
+    splits[i] = re.sub('\\s{0,1}[\\[\\(].*['+'|'.join(bracket_keywords)+'].*[\\]\\)]', '', splits[i], flags=re.I)
+    splits[i] = re.sub('^\\s+', '', splits[i])
+    splits[i] = re.sub('\\s+$', '', splits[i])
+  return ' - '.join(filter(None, splits))
+
+
+class TitleTestCases(unittest.TestCase):
+  titles = [
+    'Ellie Goulding - Burn (Official Video)',
+    '[Electro] - Pegboard Nerds - Hero (feat. Elizabeth Fay) [Monstercat Release]',
+    '[Dubstep] Rameses B - Keep You (Ft. Veela) [Free Download]',
+    'Adele - Hello',
+    '  Artist  -  Song  (Lyric Video)  ',
+    'Artist - Song (Audio)\n(Official Video)\nmore',
+    'Artist - Song\n(xyz)(Music)',
+    'Artist - Song [HQ] (Official) [Extra]',
+    '(((Official Audio',
+    'Song (xyz) ]',
+    'a (b) c (d) e',
+    '- - -',
+    '',
+  ]
+  channels = ['AdeleVEVO', 'MonstercatTV', 'UKFDubstep', 'ellie goulding', 'TaylorSwiftVEVO\n', 'tv', 'ABCtv\n']
+
+  def test_examples(self):
+    self.assertEqual('Ellie Goulding - Burn', titles.normalize_title(self.titles[0]))
+    self.assertEqual('Pegboard Nerds - Hero', titles.normalize_title(self.titles[1]))
+    self.assertEqual('Adele', titles.normalize_channel('AdeleVEVO'))
+    self.assertEqual('UKFDubstep', titles.normalize_channel('UKFDubstep'))
+    # ripper still goes by its old names.
+    self.assertEqual('Ellie Goulding - Burn', ripper.parsetitle(self.titles[0]))
+    self.assertEqual('Taylor Swift', ripper.parsechannel('TaylorSwiftVEVO'))
+
+  def test_same_as_regexes(self):
+    # case 1 - hand picked
+    for title in self.titles:
+      self.assertEqual(old_parsetitle(title), titles.normalize_title(title), repr(title))
+    for channel in self.channels:
+      self.assertEqual(old_parsechannel(channel), titles.normalize_channel(channel), repr(channel))
+
+    # case 2 - random text made of everything the rules care about, short
+    # enough for the old regexes to cope
+    rand = random.Random(1234)
+    alphabet = '[]()-  \n\t\x1cmxMZ|ſİVvEeOoTtUKF'
+    for i in range(20000):
+      text = ''.join(rand.choice(alphabet) for j in range(rand.randint(0, 24)))
+      self.assertEqual(old_parsetitle(text), titles.normalize_title(text), repr(text))
+      self.assertEqual(old_parsechannel(text), titles.normalize_channel(text), repr(text))
+
+  def test_batch(self):
+    batch = self.titles * 3
+    self.assertEqual([old_parsetitle(t) for t in batch], titles.normalize_titles(batch))
+    self.assertEqual([old_parsechannel(c) for c in self.channels], titles.normalize_channels(self.channels))
+    self.assertEqual([], titles.normalize_titles([]))
+
+  def test_rules(self):
+    # case 1 - no separator, rules run on the whole text in order
+    normalizer = Normalizer((('upper', str.upper), ('strip', str.strip)))
+    self.assertEqual('A - B', normalizer.normalize(' a - b '))
+
+    # case 2 - segments are normalized one by one, empty ones dropped
+    normalizer = Normalizer((('strip', str.strip),), separator='|', joiner='/')
+    self.assertEqual('a/b', normalizer.normalize(' a || b |'))
+    self.assertEqual(['a/b', ''], normalizer.normalize_many(['a|b', '|']))
+
+  def test_adversarial(self):
+    # Inputs that make the old bracket regex go quadratic (or worse) have to
+    # stay linear: doubling the input may not take much more than twice as long.
+    size = 20000
+    inputs = [
+      lambda n: '(' * n,
+      lambda n: '[' * n + 'x',
+      lambda n: '(m' * n,
+      lambda n: ' (' * n + ')',
+      lambda n: '[' + 'x]' * n,
+      lambda n: '(' + 'x' * n + 'm',
+      lambda n: ('(m)' * 50 + '\n') * (n // 50),
+      lambda n: '-(m)' * n,
+      lambda n: ' ' * n + 'x' + ' ' * n,
+    ]
+    for make in inputs:
+      elapsed = []
+      for n in (size, 4 * size):
+        text = make(n)
+        start = time.perf_counter()
+        titles.normalize_title(text)
+        elapsed.append(time.perf_counter() - start)
+      self.assertLess(elapsed[1], 0.5, repr(make(3)))
+      self.assertLess(elapsed[1], 20 * elapsed[0] + 0.01, repr(make(3)))
+
+  def test_z_benchmark(self):
+    batch = [t + ' ' + str(i) for i in range(1000) for t in self.titles]
+
+    start = time.perf_counter()
+    expected = [old_parsetitle(t) for t in batch]
+    old_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    results = titles.normalize_titles(batch)
+    elapsed = time.perf_counter() - start
+    print('\nNormalized {} titles in {:.3f}s, the old regexes took {:.3f}s'.format(len(batch), elapsed, old_elapsed))
+    self.assertEqual(expected, results)
+    self.assertLess(elapsed, old_elapsed)
+
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""Compare title normalizing with the old parsetitle() regexes and app.titles.
+
+Runs a batch of realistic titles through both, then times both on growing
+inputs full of brackets, where the old regex backtracks.
+
+usage: title_benchmark.py [batch size]
+"""
+import sys, time
+from app import titles
+from test_titles import TitleTestCases, old_parsetitle
+
+adversarial = [
+  ('open brackets', lambda n: '(' * n),
+  ('keyword brackets', lambda n: '(m' * n),
+  ('spaced brackets', lambda n: ' (' * n + ')'),
+]
+
+
+def timed(func, *args):
+  start = time.perf_counter()
+  func(*args)
+  return time.perf_counter() - start
+
+def batch(size):
+  texts = [TitleTestCases.titles[i % len(TitleTestCases.titles)] + ' ' + str(i) for i in range(size)]
+  old = timed(lambda: [old_parsetitle(t) for t in texts])
+  new = timed(titles.normalize_titles, texts)
+  print('{:17} {:8} titles   old {:8.3f}s   new {:8.3f}s'.format('batch', size, old, new))
+
+def scaling(name, make):
+  for n in (100, 200, 400, 800):
+    text = make(n)
+    old = timed(old_parsetitle, text)
+    new = timed(titles.normalize_title, text)
+    print('{:17} {:8} chars    old {:8.3f}s   new {:8.3f}s'.format(name, len(text), old, new))
+
+
+if __name__ == '__main__':
+  size = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  batch(size)
+  for name, make in adversarial:
+    scaling(name, make)